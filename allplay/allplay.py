@@ -4,10 +4,17 @@ import argparse
 import copy
 from .config import Config
 from .database import Database
-from .library import Library
+from .library import Library, cancel_on_interrupt
 import logging
 from .media import Media
 from .interface import Interface
+from .journal import store_from_config
+from .prefetch import Prefetcher
+from . import profiling
+from .tagquery import TagQuery, TagQueryError
+from . import syncworker
+from .tags import BulkTags
+from .watcher import Watcher
 import os
 import random
 import sys
@@ -15,52 +22,168 @@ import sys
 def main():
     parser = argparse.ArgumentParser(description="AllPlay media manager")
     parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose/debug logging')
+    parser.add_argument('-t', '--tag-query', metavar='QUERY',
+                        help='Print the media matching a tag query, e.g. "action AND NOT (horror OR gore*)", and exit. '
+                             'With a bulk tag option, select the media to change instead')
+    parser.add_argument('-s', '--search', action='append', metavar='STRING',
+                        help='With a bulk tag option, select media whose path matches STRING (repeatable, any match)')
+    parser.add_argument('--tag-add', metavar='TAG', help='Add TAG to every media selected by -t/-s, and exit')
+    parser.add_argument('--tag-remove', metavar='TAG', help='Remove TAG from every media selected by -t/-s, and exit')
+    parser.add_argument('--tag-rename', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Rename a tag on the media selected by -t/-s, or everywhere without them, and exit')
+    parser.add_argument('--tag-merge', nargs='+', metavar='TAG',
+                        help='Merge the given tags into the last one across the whole library, and exit')
+    parser.add_argument('--sync-upload', action='store_true',
+                        help='Upload the database to S3, once any running allplay has exited, and exit')
+    parser.add_argument('--profile', nargs='?', const='allplay_profile.json', metavar='REPORT',
+                        help='Time each phase and count filesystem calls and SQL statements, writing a JSON report '
+                             'at exit (default allplay_profile.json)')
+    parser.add_argument('--profile-cprofile', metavar='STATS',
+                        help='With --profile, also write cProfile stats for the main thread here (see pstats)')
     args = parser.parse_args()
     log_level = logging.DEBUG if args.verbose else logging.WARNING
     logging.basicConfig(stream=sys.stdout, level=log_level, format='%(message)s')
     logger = logging.getLogger()
+    if args.profile or args.profile_cprofile:
+        profiling.start(args.profile or 'allplay_profile.json', args.profile_cprofile)
     config = Config()
+    if args.sync_upload:
+        return syncworker.upload(config, database_from_config(config))
+    # One shot commands sync in the foreground, there's nothing to overlap
+    one_shot = bool(args.tag_add or args.tag_remove or args.tag_rename or args.tag_merge or args.tag_query is not None)
     #with Database(config.local_database) as db:
-    with Database(config.local_database, config.s3_database['bucket'], config.s3_database['filename'], config.s3_database['profile']) as db:
+    with database_from_config(config, background_sync=config.sync_background and not one_shot) as db:
         lib = Library(db)
-        lib.populate_from_db(config)
+        if args.tag_add or args.tag_remove or args.tag_rename or args.tag_merge:
+            return bulk_tag(config, db, lib, args)
+        if args.tag_query is not None:
+            return print_tag_query(config, db, lib, args.tag_query)
+        sync = None
+        if db.background_sync and db.lock.held and db.sync_configured():
+            sync = db.sync_worker = syncworker.SyncWorker(config, db)
+            sync.start()
+        lib.tag_index.load()
+        lib.populate_from_db(config, exclude_tags=config.default_exclusion_tags)
         # Check to see if local db is older than allowed delay
         if db.local_db_age_sec() > config.local_scan_delay:
-            for path_alias, path in config.media_sources.items():
-                lib.scan_source(config, path_alias, path)
+            lib.scan_sources(config)
             lib.scanned_to_library_and_db(config)
-            lib.update_missing_sizes(config)
-        library_list = list(lib.library)
-        orig_library_length = len(lib.library)
+            with cancel_on_interrupt() as cancel:
+                lib.update_missing_sizes(config, progress=lib.print_size_progress, cancel=cancel)
+        watcher = None
+        if config.watch_media_sources:
+            watcher = Watcher(config)
+            watcher.start()
         random.seed()
-        random.shuffle(library_list)
-        while len(library_list) > 0:
-            logger.warning("Media {0} of {1}".format(str(len(library_list)), str(orig_library_length)))
-            full_path = library_list.pop(0)
-            media = Media(config, lib, db, full_path)
-            media.tags.get_tags()
-            if set(config.default_exclusion_tags).intersection(set(media.tags.tags)):
+        playlist = Prefetcher(config, lib, lib.cursor)
+        # (playlist, full_path) of the item the last pass was working on
+        current = None
+        while True:
+            if current is not None:
+                # Done with it, the cursor can drop its library entry.  The
+                # playlist that handed it out, a replaced one ignores this
+                current[0].release(current[1])
+                current = None
+            if sync is not None and sync.safe_point(confirm):
+                logger.warning("Database synced from S3, using the updated library.")
+                lib.tag_index.load()
+                lib.populate_from_db(config, exclude_tags=config.default_exclusion_tags)
+                playlist.shutdown()
+                playlist = Prefetcher(config, lib, lib.cursor)
+            if watcher is not None:
+                for added_path in lib.apply_watch_events(config, watcher.pending_events()):
+                    playlist.push(added_path)
+            remaining = playlist.remaining()
+            (full_path, probe) = next(playlist, (None, None))
+            if full_path is None:
+                break
+            current = (playlist, full_path)
+            logger.warning("Media {0} of {1}".format(str(remaining), str(playlist.total())))
+            if full_path not in lib.library:
+                # Removed or renamed since it was paged in
+                continue
+            if lib.tag_index.has_any(lib.library[full_path]["media_id"], config.default_exclusion_tags):
+                continue
+            media = Media(config, lib, db, full_path, probe)
+            if not media.exists:
+                # Gone from disk, Media already dropped it from the library
+                continue
+            if lib.tag_index.has_any(media.media_id, config.default_exclusion_tags):
+                # Media tags empty directories as non media on the way in
                 continue
             menu = Interface(config, lib, db, media)
             print_media_summary(media, menu, lib)
             media.play_media()
+            profiling.count("media_played")
             print_media_summary(media, menu, lib)
-            menu_action = menu.media_menu()
+            # Timed here, media_menu calls itself for every action
+            with profiling.phase("menu"):
+                menu_action = menu.media_menu()
             logger.debug(menu_action)
             if menu_action == "next":
                 continue
-            elif menu_action == "library_update":
-                logger.warn("Library has been updated, using new library.")
-                library_list = list(lib.library)
-                orig_library_length = len(lib.library)
-                random.shuffle(library_list)
-                continue
-            elif menu_action == "library_update_no_shuffle":
+            elif menu_action in ("library_update", "library_update_no_shuffle"):
                 logger.warn("Library has been updated, using new library.")
-                library_list = lib.library_list
-                orig_library_length = len(lib.library_list)
+                playlist.shutdown()
+                playlist = Prefetcher(config, lib, lib.cursor)
                 continue
+        playlist.shutdown()
         logger.warning("No more media.")
+        if watcher is not None:
+            watcher.stop()
+
+def database_from_config(config, background_sync=False):
+    journal_store = store_from_config(config) if config.sync_mode == "journal" else None
+    s3_database = config.s3_database or dict()
+    return Database(config.local_database, s3_database.get('bucket'), s3_database.get('filename'), s3_database.get('profile'),
+                    slow_query_ms=config.slow_query_ms, pragmas=config.sqlite_pragmas,
+                    s3_lease_seconds=s3_database.get('lease_seconds'), s3_lease_holder=s3_database.get('lease_holder'),
+                    journal_store=journal_store, journal_snapshot_every=config.journal_snapshot_every,
+                    background_sync=background_sync, s3_compress=s3_database.get('compress'))
+
+def confirm(question):
+    return input("{0} (y/n) ".format(question)).strip().lower() in ("y", "yes")
+
+def print_tag_query(config, db, lib, query_text):
+    # Read only, nothing to push back to S3
+    db.s3_sync_toggle(enable=False)
+    try:
+        tag_query = TagQuery(query_text, aliases=config.quick_tags)
+    except TagQueryError as err:
+        sys.exit("Bad tag query: {0}".format(err))
+    lib.populate_from_db_search(config, tag_query=tag_query, sort_by="mtime", desc=True)
+    for full_path in lib.cursor:
+        print(full_path)
+        lib.cursor.release(full_path)
+
+def bulk_tag(config, db, lib, args):
+    media_ids = where = None
+    params = ()
+    if args.tag_query is not None or args.search:
+        tag_query = None
+        if args.tag_query is not None:
+            try:
+                tag_query = TagQuery(args.tag_query, aliases=config.quick_tags)
+            except TagQueryError as err:
+                sys.exit("Bad tag query: {0}".format(err))
+        lib.populate_from_db_search(config, tag_query=tag_query, search_strings=args.search or list())
+        (media_ids, where, params) = lib.current_selection()
+    elif args.tag_add or args.tag_remove:
+        sys.exit("--tag-add and --tag-remove need media to work on, select them with -t and/or -s")
+    bulk = BulkTags(config, db, lib.tag_index)
+    try:
+        if args.tag_add:
+            bulk.add(args.tag_add, media_ids, where, params)
+        if args.tag_remove:
+            bulk.remove(args.tag_remove, media_ids, where, params)
+        if args.tag_rename:
+            bulk.rename(args.tag_rename[0], args.tag_rename[1], media_ids, where, params)
+        if args.tag_merge:
+            if len(args.tag_merge) < 2:
+                sys.exit("--tag-merge needs at least one tag to merge and the tag to merge into")
+            bulk.merge(args.tag_merge[:-1], args.tag_merge[-1])
+    except ValueError as err:
+        sys.exit(str(err))
 
 def print_media_summary(media, menu, library):
     print("\n\nMedia Files:")
@@ -68,7 +191,7 @@ def print_media_summary(media, menu, library):
     print("Tags:")
     menu.print_list_indexes(media.tags.tags)
     print("Times Played: {0}".format(str(media.times_played)))
-    print("Modified Time: {0}".format(str(media.mtime)))
+    print("Modified Time: {0}".format(str(media.modified_time)))
     print("Size: {0}".format(str(media.media_size)))
     print("### MODE:\n### {0}".format(library.mode))
 
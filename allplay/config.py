@@ -3,11 +3,6 @@ from collections import defaultdict
 import logging
 import os
 import sys
-from yaml import load, dump, YAMLError
-try:
-    from yaml import CLoader as Loader, CDumper as Dumper
-except ImportError:
-    from yaml import Loader, Dumper
 
 
 class Config(object):
@@ -24,7 +19,31 @@ class Config(object):
                                                                                ".allplay",
                                                                                "allplay.sqlite3")
         self.local_scan_delay = int(self.raw_config.get("local_scan_delay") or 86400)
+        self.slow_query_ms = float(self.raw_config.get("slow_query_ms") or 0)
+        self.sqlite_pragmas = self.raw_config.get("sqlite_pragmas") or dict()
+        self.scan_workers = int(self.raw_config.get("scan_workers") or 8)
+        self.scan_mount_concurrency = int(self.raw_config.get("scan_mount_concurrency") or 4)
+        self.scan_mount_limits = self.raw_config.get("scan_mount_limits") or dict()
+        self.library_page_size = int(self.raw_config.get("library_page_size") or 500)
+        self.random_seed = self.raw_config.get("random_seed")
+        self.random_weights = self.raw_config.get("random_weights") or dict()
+        self.size_workers = int(self.raw_config.get("size_workers") or 4)
+        self.size_batch_size = int(self.raw_config.get("size_batch_size") or 500)
+        self.prefetch_count = int(self.raw_config.get("prefetch_count", 2) or 0)
+        self.watch_media_sources = bool(self.raw_config.get("watch_media_sources") or False)
+        self.watch_poll_interval = int(self.raw_config.get("watch_poll_interval") or 60)
+        self.watch_settle_seconds = int(self.raw_config.get("watch_settle_seconds") or 30)
+        self.watch_poll_sources = self.raw_config.get("watch_poll_sources") or list()
         self.s3_database = self.raw_config.get("s3_database") or None
+        self.sync_mode = self.raw_config.get("sync_mode") or "file"
+        self.journal_store_path = self.raw_config.get("journal_store_path") or None
+        self.journal_snapshot_every = int(self.raw_config.get("journal_snapshot_every") or 100)
+        self.sync_background = bool(self.raw_config.get("sync_background") or False)
+        self.sync_apply = self.raw_config.get("sync_apply") or "auto"
+        self.sync_exit = self.raw_config.get("sync_exit") or "handoff"
+        self.sync_interval = int(self.raw_config.get("sync_interval") or 300)
+        self.sync_debounce_seconds = int(self.raw_config.get("sync_debounce_seconds") or 120)
+        self.sync_retries = int(self.raw_config.get("sync_retries") or 5)
         self.default_exclusion_tags = self.raw_config.get("default_exclusion_tags") or list()
         self.quick_tags = self.raw_config.get("quick_tags") or None
         self.auto_tags = self.raw_config.get("auto_tags") or None
@@ -35,16 +54,23 @@ class Config(object):
 
     def loadConfig(self):
         if os.path.isfile(self.config_file):
+            # Imported here, there's no yaml to parse without a config file
+            from yaml import load, YAMLError
+            try:
+                from yaml import CLoader as Loader
+            except ImportError:
+                from yaml import Loader
             with open(self.config_file, 'r') as stream:
                 try:
                     raw_config = load(stream, Loader=Loader)
-                except yaml.YAMLError as exc:
+                except YAMLError as exc:
                     self.logger.error("Error loading yaml config file %s: %s" %
                                       (self.config_file, exc))
                     if hasattr(exc, 'problem_mark'):
                         mark = exc.problem_mark
                         self.logger.error("Error position: (%s:%s)" %
                                           (mark.line + 1, mark.column + 1))
+                    return {}
         else:
             self.logger.warning("No Config file found, using defaults: %s" %
                               self.config_file)
@@ -0,0 +1,213 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from collections import deque
+import logging
+import random
+from . import profiling
+from .sampler import WeightedSampler
+
+# Sort modes page on (expression, media_id).  media_size is NULL until
+# update_missing_sizes gets to it, keep those at the small end like
+# ORDER BY did.
+SORT_EXPRESSIONS = { "times_played": "times_played",
+                     "mtime": "mtime",
+                     "media_size": "IFNULL(media_size, -1)" }
+
+
+class LibraryCursor(object):
+    ''' Lazily pages the media rows for the current library mode.
+
+    Sort modes use keyset pagination on (sort expression, media_id), random
+    modes shuffle media_id ranges and then the rows inside each page (or,
+    with random_weights configured, draw each page from a WeightedSampler),
+    so only the rows still in use are held in lib.library no matter how big
+    the db is.  Iterating yields full paths; each page is loaded into
+    lib.library before its paths are handed out.  Every path loaded is
+    pinned until whoever iterates calls release() on it, once it's done
+    with the entry, and it's dropped from lib.library then.  Paths waiting
+    in the current page or queued ahead by a Prefetcher stay pinned, so
+    however far ahead anything reads, handed out entries are still there.
+    '''
+    def __init__(self, lib, config, where=None, params=(), sort_by=None, desc=False, paths=None):
+        self.lib = lib
+        self.db = lib.db
+        self.config = config
+        self.logger = logging.getLogger()
+        self.where = where
+        self.params = tuple(params)
+        self.sort_expression = SORT_EXPRESSIONS[sort_by] if sort_by is not None else None
+        self.desc = desc
+        self.page_size = max(config.library_page_size, 1)
+        self.paths = list(paths) if paths is not None else None
+        # The explicit paths as given, self.paths is emptied into the page
+        self.selection = list(paths) if paths is not None else None
+        self._total = None
+        self._consumed = 0
+        self._page = deque()
+        self._tail = list()
+        self._extra = 0
+        # full path -> times it was handed out (or is waiting to be) and
+        # not released yet
+        self._pins = dict()
+        self._last_key = None
+        self._blocks = None
+        self._exhausted = False
+        self._sampler = None
+        # random_seed makes the random order repeatable
+        self.rng = random.Random(config.random_seed)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self._page:
+            self._fill()
+        if not self._page:
+            raise StopIteration
+        self._consumed += 1
+        return self._page.popleft()
+
+    next = __next__
+
+    def __len__(self):
+        return self.total()
+
+    def total(self):
+        if self._total is None:
+            if self.selection is not None:
+                self._total = len(self.selection)
+            else:
+                sql = '''SELECT COUNT(*) FROM media'''
+                if self.where:
+                    sql += " WHERE " + self.where
+                self._total = self.db.db_read_iterator(sql, self.params).fetchone()[0]
+        return self._total + self._extra
+
+    def remaining(self):
+        return max(self.total() - self._consumed, 0)
+
+    def push(self, full_path):
+        # Media that showed up mid session; random modes mix it into the
+        # current page, sort modes play it after everything else.
+        self._extra += 1
+        self._pin(full_path)
+        if self.sort_expression is None and self.paths is None:
+            self._page.insert(self.rng.randint(0, len(self._page)), full_path)
+        else:
+            self._tail.append(full_path)
+
+    @profiling.timed("cursor_page")
+    def _fill(self):
+        while not self._page and not self._exhausted:
+            if self.paths is not None:
+                rows = None
+                self._page.extend(self.paths)
+                self.paths = []
+            elif self.sort_expression is not None:
+                rows = self._next_sorted_page()
+            elif self.config.random_weights:
+                rows = self._next_weighted_page()
+            else:
+                rows = self._next_random_page()
+            if rows is None:
+                self._exhausted = True
+                break
+            page_paths = list()
+            for (media_id, mount_alias, path, mtime, times_played, media_size) in rows:
+                if mount_alias not in self.config.media_sources:
+                    continue
+                entry = self.lib.library.add(media_id, mount_alias, path, mtime, times_played, media_size)
+                page_paths.append(self.lib.library.full_path(entry))
+            if self.sort_expression is None and self._sampler is None:
+                self.rng.shuffle(page_paths)
+            for full_path in page_paths:
+                self._pin(full_path)
+            self._page.extend(page_paths)
+        if self._exhausted and self._tail:
+            self._page.extend(self._tail)
+            self._tail = []
+
+    def _pin(self, full_path):
+        self._pins[full_path] = self._pins.get(full_path, 0) + 1
+
+    def release(self, full_path):
+        # The caller is done with a path it was handed, drops its library
+        # entry once nothing else holds it.  Paths this cursor didn't load
+        # (an explicit paths list, or after close()) are left alone.
+        count = self._pins.get(full_path)
+        if count is None:
+            return
+        if count > 1:
+            self._pins[full_path] = count - 1
+            return
+        del self._pins[full_path]
+        self.lib.library.pop(full_path, None)
+
+    def close(self):
+        # Replaced by a new cursor, which shares lib.library; anything still
+        # released here must not take out the new cursor's entries
+        self._pins.clear()
+        self._page.clear()
+
+    def _next_sorted_page(self):
+        conditions = [ self.where ] if self.where else []
+        params = list(self.params)
+        if self._last_key is not None:
+            # A row value comparison lets sqlite seek the sort index, the
+            # extra bound on the sort expression alone is needed for the
+            # media_size expression index to seek too
+            operator = "<" if self.desc else ">"
+            conditions.append("%s %s= ? AND (%s, media_id) %s (?, ?)" % (self.sort_expression, operator,
+                                                                        self.sort_expression, operator))
+            params.extend([ self._last_key[0], self._last_key[0], self._last_key[1] ])
+        direction = " DESC" if self.desc else " ASC"
+        sql = self.lib.sql.replace("SELECT ", "SELECT %s, " % self.sort_expression, 1)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY " + self.sort_expression + direction + ", media_id" + direction
+        sql += " LIMIT ?"
+        params.append(self.page_size)
+        rows = self.db.db_read_iterator(sql, tuple(params)).fetchall()
+        if not rows:
+            return None
+        self._last_key = (rows[-1][0], rows[-1][1])
+        return [ row[1:] for row in rows ]
+
+    def _next_random_page(self):
+        if self._blocks is None:
+            (min_id, max_id) = self.db.db_read_iterator('''SELECT MIN(media_id), MAX(media_id) FROM media''').fetchone()
+            self._blocks = list()
+            if min_id is not None:
+                # Several smaller id ranges per page so neighbouring ids don't
+                # always end up playing back to back.
+                block_size = max(self.page_size // 4, 1)
+                self._blocks = list(range(min_id, max_id + 1, block_size))
+                self._block_size = block_size
+                self.rng.shuffle(self._blocks)
+        if not self._blocks:
+            return None
+        blocks = self._blocks[:4]
+        del self._blocks[:4]
+        ranges = " OR ".join("media_id BETWEEN ? AND ?" for _ in blocks)
+        params = list()
+        for block_start in blocks:
+            params.extend([ block_start, block_start + self._block_size - 1 ])
+        sql = self.lib.sql + " WHERE (" + ranges + ")"
+        if self.where:
+            sql += " AND " + self.where
+        params.extend(self.params)
+        return self.db.db_read_iterator(sql, tuple(params)).fetchall()
+
+    def _next_weighted_page(self):
+        if self._sampler is None:
+            self._sampler = WeightedSampler.from_db(self.db, self.config, self.where, self.params, self.rng)
+        media_ids = self._sampler.draw_many(self.page_size)
+        if not media_ids:
+            return None
+        # Keep the draw order, rows deleted since the sampler was built drop out
+        rows_by_id = dict()
+        for start in range(0, len(media_ids), 500):
+            chunk = media_ids[start:start + 500]
+            sql = self.lib.sql + " WHERE media_id IN (" + ",".join("?" for _ in chunk) + ")"
+            for row in self.db.db_read_iterator(sql, tuple(chunk)):
+                rows_by_id[row[0]] = row
+        return [ rows_by_id[media_id] for media_id in media_ids if media_id in rows_by_id ]
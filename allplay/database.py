@@ -1,82 +1,211 @@
 from __future__ import (absolute_import, division, print_function, unicode_literals)
-import boto3
-from botocore.exceptions import ClientError
 import datetime
+import json
 import logging
 import os
+import re
+import socket
 import sqlite3
-import subprocess
 import sys
-from tzlocal import get_localzone
+import tempfile
+import time
+import urllib.parse
+from .journal import ChangeJournal, JournalGap
+from .locking import DatabaseLock, S3Lease
+from . import profiling
+from .sqlstats import InstrumentedConnection
+from . import transfer
 
+# Set on every connection, sqlite_pragmas in the config overrides them.
+# WAL lets readers and a writer use the db at the same time and with
+# synchronous normal a commit no longer waits on an fsync.
+DEFAULT_PRAGMAS = { "journal_mode": "wal",
+                    "synchronous": "normal",
+                    "mmap_size": 268435456,
+                    "cache_size": -20000,
+                    "busy_timeout": 5000 }
+# Only these make sense on a read only connection
+READER_PRAGMAS = ("mmap_size", "cache_size", "busy_timeout")
 
 
 class Database(object):
-    def __init__(self, local_database=None, s3_database_bucket=None, s3_database_filename=None, s3_database_profile="default"):
+    def __init__(self, local_database=None, s3_database_bucket=None, s3_database_filename=None, s3_database_profile="default",
+                 slow_query_ms=0, pragmas=None, s3_lease_seconds=0, s3_lease_holder=None, journal_store=None,
+                 journal_snapshot_every=100, background_sync=False, s3_compress=False):
         self.logger = logging.getLogger()
         self.local_database = local_database
         self.s3_database_bucket = s3_database_bucket
         self.s3_database_filename = s3_database_filename
         self.s3_database_profile = s3_database_profile
         self._s3_sync_enable = True
+        self.fts5_enabled = False
+        self.slow_query_ms = slow_query_ms
+        self.pragmas = dict(DEFAULT_PRAGMAS)
+        self.pragmas.update(pragmas or dict())
+        self.read_conn = None
+        self.sqlite_conn = None
+        # 0 leaves the S3 lease out
+        self.s3_lease_seconds = int(s3_lease_seconds or 0)
+        self.s3_lease_holder = s3_lease_holder or socket.gethostname()
+        self.lease = None
+        self.lock = None
+        # Gzipped uploads can only be read by versions that know to unpack
+        # them, so they're off until every machine has been upgraded
+        self.s3_compress = bool(s3_compress)
+        # With a journal store the db syncs through a ChangeJournal instead
+        # of copying the whole file (sync_mode: journal)
+        self.journal = ChangeJournal(self, journal_store, journal_snapshot_every) if journal_store is not None else None
+        # With background_sync the db opens without syncing and a
+        # syncworker.SyncWorker, set as sync_worker, takes care of S3
+        self.background_sync = background_sync
+        self.sync_worker = None
+        self.changes_at_open = 0
+        self.mtime_before_open = None
+        self.main_mtime_at_open = None
 
     def __enter__(self):
-        if self._s3_sync_enable:
-            self.s3_to_local()
-        self.sqlite_conn = self.db_connect()
-        self.sqlite_cursor = self.sqlite_conn.cursor()
-        self.initialize_schema()
+        # Only one allplay syncs a local db with S3, see DatabaseLock
+        if not self.acquire_lock() and self._s3_sync_enable:
+            self.logger.warning("%s is in use by another allplay, not syncing from S3" % self.local_database)
+        # A journal db that has never synced starts from a snapshot, which
+        # can't happen with it open
+        if self._s3_sync_enable and self.lock.held and self.background_sync and not self.journal_needs_bootstrap():
+            # Opening writes to the db, S3 is compared with it as it was
+            self.mtime_before_open = self.local_mtime()
+            self.open_connection()
+            if self.journal is not None:
+                self.journal.enable()
+            return self
+        if self._s3_sync_enable and self.lock.held and self.journal is not None:
+            with profiling.phase("journal_pull"):
+                self.journal_start()
+            return self
+        if self._s3_sync_enable and self.lock.held:
+            with profiling.phase("s3_download"):
+                self.s3_to_local()
+                self.s3_lease_acquire()
+        self.open_connection()
         return self
 
     def __exit__(self, type, value, traceback):
+        if self.sync_worker is not None:
+            # Uploads or hands off what's left, see SyncWorker.finish
+            self.sync_worker.finish()
+            self.close_connection()
+        elif self._s3_sync_enable and self.journal is not None:
+            with profiling.phase("journal_push"):
+                self.journal_finish()
+            self.close_connection()
+        else:
+            self.close_connection()
+            if self._s3_sync_enable:
+                with profiling.phase("s3_upload"):
+                    self.local_to_s3()
+        self.s3_lease_release()
+        self.lock.release()
+
+    def acquire_lock(self, wait=0):
+        # wait is how long to wait for another allplay to let go, in seconds
+        if self.lock is None:
+            self.lock = DatabaseLock(self.local_database + ".lock")
+        deadline = time.time() + wait
+        while not self.lock.acquire():
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.5)
+        return True
+
+    def sync_configured(self):
+        # Whether there's anywhere to sync to
+        return self.journal is not None or bool(self.s3_database_bucket and self.s3_database_filename)
+
+    def open_connection(self):
+        # Connecting creates or touches the -wal file, and a journal pull
+        # writes, so how old the db is has to be read before either
+        self.main_mtime_at_open = os.path.getmtime(self.local_database) if os.path.isfile(self.local_database) else None
+        self.sqlite_conn = self.db_connect()
+        profiling.trace_connection(self.sqlite_conn)
+        self.sqlite_cursor = self.sqlite_conn.cursor()
+        with profiling.phase("schema"):
+            self.initialize_schema()
+        self.changes_at_open = self.sqlite_conn.total_changes
+
+    def local_changes(self):
+        # Rows this process has changed since the db was opened
+        return self.sqlite_conn.total_changes - self.changes_at_open
+
+    def close_connection(self):
         self.sqlite_cursor.close()
+        if self.read_conn is not None:
+            self.read_conn.close()
+            self.read_conn = None
         self.db_close()
-        if self._s3_sync_enable:
-            self.local_to_s3()
+        self.sqlite_conn = None
+
+    def s3_sync_reload(self):
+        # Sync from S3 with the db open, the connections are closed around
+        # the download since the file is swapped out from under them
+        if not self.lock.acquire():
+            self.logger.warning("%s is in use by another allplay, not syncing from S3" % self.local_database)
+            return False
+        if self.journal is not None:
+            return self.journal_sync()
+        self.close_connection()
+        try:
+            return self.s3_to_local()
+        finally:
+            self.open_connection()
 
     def s3_sync_toggle(self, enable=False):
         self._s3_sync_enable = enable
 
-    def local_db_modified(self, delta_minutes=1):
+    def local_mtime(self):
+        # Last write to the db, None if there's no db yet.  In WAL mode
+        # commits land in the -wal file until a checkpoint
+        if not os.path.isfile(self.local_database):
+            return None
+        mtime = os.path.getmtime(self.local_database)
+        if os.path.isfile(self.local_database + "-wal"):
+            mtime = max(mtime, os.path.getmtime(self.local_database + "-wal"))
+        return mtime
+
+    def local_db_modified(self, delta_minutes=1, mtime=None):
+        # mtime overrides the db's current one.  tzlocal (like botocore
+        # below) is imported where it's used, only S3 syncs need it
+        from tzlocal import get_localzone
         timezone = get_localzone()
-        if os.path.isfile(self.local_database):
-            local_last_modified = datetime.datetime.fromtimestamp(os.path.getmtime(self.local_database)) + datetime.timedelta(minutes=delta_minutes)
+        if mtime is None:
+            mtime = self.local_mtime()
+        if mtime:
+            local_last_modified = datetime.datetime.fromtimestamp(mtime) + datetime.timedelta(minutes=delta_minutes)
         else:
             local_last_modified = datetime.datetime.min + datetime.timedelta(minutes=30000)
         return local_last_modified.replace(tzinfo=timezone)
 
     def local_db_age_sec(self):
-        # Currently unused, can't remember why I wrote this
-        # Remove if I really don't remember
-        timezone = get_localzone()
-        local_last_modified = self.local_db_modified()
-        delta = datetime.datetime.now(timezone) - local_last_modified
-        return int(delta.total_seconds())
+        # Seconds since the db was last modified before this allplay opened
+        # it, less the minute local_db_modified adds.  Only the main file,
+        # the last connection to close checkpoints the -wal into it.
+        # Checked at every start, so plain epoch math without tzlocal
+        mtime = self.main_mtime_at_open
+        if not mtime:
+            return sys.maxsize
+        return int(time.time() - mtime) - 60
 
     def s3_to_local(self):
-        # Check to see if DB is opened by any processes, if so, skip
-        try:
-            if os.path.isfile(self.local_database):
-                fuser = subprocess.run(["/bin/fuser", self.local_database])
-                if fuser.returncode == 0:
-                    # Something has the sqlite file open
-                    self.logger.debug("Skipping sync from S3, {0} is opened: {1}".format(self.local_database, fuser.stdout))
-                    return False
-        except:
+        # Replacing the file is only safe with no connections to it, ours
+        # included (see s3_sync_reload) or another allplay's (the lock)
+        if self.sqlite_conn is not None or self.lock is None or not self.lock.held:
+            self.logger.debug("Skipping sync from S3, %s is open" % self.local_database)
             return False
         if self.s3_database_bucket and self.s3_database_filename:
-            timezone = get_localzone()
-            local_last_modified = self.local_db_modified()
             self.logger.warning("Begining s3 to local sync.  Bucket: %s File: %s" % (self.s3_database_bucket, self.s3_database_filename))
+            from botocore.exceptions import ClientError
             try:
-                session = boto3.session.Session(profile_name=self.s3_database_profile)
-                s3 = session.resource('s3')
-                s3file = s3.Object(self.s3_database_bucket, self.s3_database_filename)
-                if s3file.last_modified > local_last_modified:
-                    self.logger.warning("Downloading from S3( %s ) to Local + 1min( %s ) due to modification date: " % (str(s3file.last_modified), str(local_last_modified)))
-                    s3file.download_file(self.local_database)
-                else:
-                    self.logger.warning("Not downloading from S3( %s ) to Local + 1min( %s ) due to modification date: " % (str(s3file.last_modified), str(local_last_modified)))
+                fetched = self.s3_fetch()
+                if fetched is not None:
+                    self.swap_in_fetched(fetched)
+                    return True
             except (KeyboardInterrupt, SystemExit):
                 raise
             except (ClientError, TypeError) as cerr:
@@ -88,50 +217,391 @@ class Database(object):
         else:
             self.logger.debug("Skipping sync from S3, s3 config options incomplete.")
 
-    def local_to_s3(self, force=False):
+    def s3_fetch(self, local_mtime=None):
+        ''' Downloads the S3 db next to the local one if it should replace it.
+
+        Returns (path, sha256) of the download, None when there's nothing
+        newer in S3 than the local db, or than local_mtime (0 for no db).
+        Nothing local is touched, so this is safe off the main thread;
+        swap_in_fetched puts the download in place.
+        '''
+        local_last_modified = self.local_db_modified(mtime=local_mtime)
+        head = self.s3_head()
+        if head is None:
+            self.logger.warning("Not downloading from S3, there's no database there yet")
+            return None
+        remote_digest = head["Metadata"].get("sha256")
+        if remote_digest is not None and remote_digest == self.synced_digest():
+            self.logger.warning("Not downloading from S3, it hasn't changed since the last sync")
+            return None
+        if not head["LastModified"] > local_last_modified:
+            self.logger.warning("Not downloading from S3( %s ) to Local + 1min( %s ) due to modification date: " % (str(head["LastModified"]), str(local_last_modified)))
+            return None
+        self.logger.warning("Downloading from S3( %s ) to Local + 1min( %s ) due to modification date: " % (str(head["LastModified"]), str(local_last_modified)))
+        (fd, download_path) = tempfile.mkstemp(prefix=".allplay-download-", dir=os.path.dirname(os.path.abspath(self.local_database)))
+        os.close(fd)
+        try:
+            self.s3_download(head, download_path)
+        except:
+            os.unlink(download_path)
+            raise
+        return (download_path, remote_digest)
+
+    def swap_in_fetched(self, fetched):
+        # Connections closed, replaces the db with an s3_fetch download
+        (download_path, digest) = fetched
+        try:
+            self.replace_local_database(lambda path: os.replace(download_path, path))
+            self.save_synced_digest(digest)
+        finally:
+            if os.path.exists(download_path):
+                os.unlink(download_path)
+
+    def s3_apply_fetched(self, fetched):
+        # swap_in_fetched with the db open, between items
+        self.close_connection()
+        try:
+            self.swap_in_fetched(fetched)
+        finally:
+            self.open_connection()
+
+    def local_to_s3(self, force=False, raise_errors=False):
+        # True once S3 is up to date, False if it wasn't uploaded.  Errors
+        # are logged unless raise_errors, for callers that retry
+        if self.journal is not None:
+            return self.journal_finish(raise_errors)
         if self.s3_database_bucket and self.s3_database_filename:
             if os.path.isfile(self.local_database):
+                # A second allplay that outlives the first can take over
+                if self.lock is None or not self.lock.acquire():
+                    self.logger.warning("Not uploading to S3, %s is in use by another allplay" % self.local_database)
+                    return False
+                from botocore.exceptions import ClientError
+                from tzlocal import get_localzone
                 timezone = get_localzone()
                 local_last_modified = self.local_db_modified(delta_minutes=0)
                 try:
-                    session = boto3.session.Session(profile_name=self.s3_database_profile)
-                    s3 = session.resource('s3')
-                    s3file = s3.Object(self.s3_database_bucket, self.s3_database_filename)
-                    s3_last_modified = s3file.last_modified.astimezone(timezone)
-                    if s3_last_modified < local_last_modified or force:
+                    lease = self.s3_lease()
+                    if lease is not None and not lease.check():
+                        return False
+                    head = self.s3_head()
+                    s3_last_modified = head["LastModified"].astimezone(timezone) if head is not None else None
+                    if head is None or s3_last_modified < local_last_modified or force:
                         self.logger.warning("Uploading from Local ( %s ) to S3 ( %s ) due to modification date: " % (str(local_last_modified), str(s3_last_modified)))
-                        s3file.upload_file(self.local_database)
+                        self.upload_snapshot(lambda path: self.s3_upload(head, path))
                     else:
                         self.logger.warning("Not uploading from Local ( %s ) to S3 ( %s ) due to modification date: " % (str(local_last_modified), str(s3_last_modified)))
+                    return True
                 except (KeyboardInterrupt, SystemExit):
                     raise
                 except (ClientError) as cerr:
+                    if raise_errors:
+                        raise
                     self.logger.warning("Error attempting to sync to s3: %s" % cerr)
-                    pass
+                    return False
                 except:
+                    if raise_errors:
+                        raise
                     self.logger.warning("Error attempting to sync to s3: %s" % sys.exc_info()[0])
-                    pass
+                    return False
             else:
                 self.logger.warning("Cannot sync to s3, %s is not a file" % self.local_database)
+        return False
+
+    def s3_head(self):
+        # The S3 db's LastModified and Metadata, None if it isn't there yet
+        from botocore.exceptions import ClientError
+        try:
+            return transfer.client(self.s3_database_profile).head_object(Bucket=self.s3_database_bucket, Key=self.s3_database_filename)
+        except ClientError as err:
+            if err.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise
+
+    def s3_download(self, head, path):
+        # Plain unless it was uploaded with compress on
+        s3 = transfer.client(self.s3_database_profile)
+        download = lambda target: s3.download_file(self.s3_database_bucket, self.s3_database_filename, target)
+        if head["Metadata"].get("compression") == "gzip":
+            transfer.download_compressed(download, path, head["Metadata"].get("sha256"))
+        else:
+            download(path)
+
+    def s3_upload(self, head, path):
+        # path is a fresh snapshot, which is byte for byte the same while
+        # the db doesn't change, so matching digests mean nothing to send
+        digest = transfer.sha256_file(path)
+        if head is not None and head["Metadata"].get("sha256") == digest:
+            self.logger.warning("Not uploading to S3, it already has this db")
+            self.save_synced_digest(digest)
+            return False
+        s3 = transfer.client(self.s3_database_profile)
+        metadata = { "sha256": digest }
+        upload = lambda source: s3.upload_file(source, self.s3_database_bucket, self.s3_database_filename,
+                                               ExtraArgs={ "Metadata": metadata })
+        if self.s3_compress:
+            metadata["compression"] = "gzip"
+            transfer.upload_compressed(upload, path)
+        else:
+            upload(path)
+        self.save_synced_digest(digest)
+        return True
+
+    def synced_digest(self):
+        # sha256 of the db as of the last transfer either way, in <db>.sync
+        try:
+            with open(self.local_database + ".sync") as sync_file:
+                return json.load(sync_file).get("sha256")
+        except (OSError, ValueError):
+            return None
+
+    def save_synced_digest(self, digest):
+        if digest is None:
+            return
+        try:
+            with open(self.local_database + ".sync", "w") as sync_file:
+                json.dump({ "sha256": digest }, sync_file)
+        except OSError as err:
+            self.logger.warning("Could not save the sync state: %s" % err)
+
+    def s3_lease(self):
+        # The S3Lease, or None when s3_lease_seconds is 0
+        if self.lease is None and self.s3_lease_seconds and self.s3_database_bucket and self.s3_database_filename:
+            self.lease = S3Lease(transfer.client(self.s3_database_profile), self.s3_database_bucket,
+                                 self.s3_database_filename + ".lease", self.s3_lease_holder, self.s3_lease_seconds)
+        return self.lease
+
+    def s3_lease_acquire(self):
+        try:
+            lease = self.s3_lease()
+            if lease is not None and lease.acquire():
+                self.logger.debug("Holding the S3 lease as %s" % self.s3_lease_holder)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.logger.warning("Error attempting to take the S3 lease: %s" % sys.exc_info()[1])
+
+    def s3_lease_release(self):
+        try:
+            if self.lease is not None:
+                self.lease.release()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.logger.warning("Error attempting to release the S3 lease: %s" % sys.exc_info()[1])
+
+    def journal_start(self):
+        # Journal mode's side of __enter__, catches up on the changes made
+        # elsewhere.  A machine new to the journal starts from the latest
+        # snapshot, and so does one that's fallen too far behind, once its
+        # own changes are shipped.
+        try:
+            (manifest, etag) = self.journal.read_manifest()
+            (origin, shipped_seq) = ChangeJournal.local_state(self.local_database)
+            if origin is None and manifest is not None:
+                self.journal_bootstrap(manifest, None, 0)
+            else:
+                self.open_connection()
+                self.journal.enable()
+            try:
+                self.journal.pull()
+            except JournalGap as gap:
+                self.logger.warning("Too far behind the change journal, starting over from a snapshot: %s" % gap)
+                self.journal_rebootstrap()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.logger.warning("Error attempting to sync the change journal: %s" % sys.exc_info()[1])
+        # Whatever happened above, changes from here on get recorded
+        if self.sqlite_conn is None:
+            self.open_connection()
+        self.journal.enable()
+
+    def journal_needs_bootstrap(self):
+        return self.journal is not None and ChangeJournal.local_state(self.local_database)[0] is None
+
+    def journal_rebootstrap(self):
+        # Ships our changes, then starts over from the latest snapshot
+        self.journal.push()
+        (origin, shipped_seq) = self.journal.state()
+        self.close_connection()
+        try:
+            self.journal_bootstrap(self.journal.read_manifest()[0], origin, shipped_seq)
+        finally:
+            if self.sqlite_conn is None:
+                self.open_connection()
+        self.journal.pull()
+
+    def journal_bootstrap(self, manifest, origin, shipped_seq):
+        # Connections closed, replaces the db with the manifest's snapshot
+        self.logger.warning("Replacing %s with the journal snapshot %s" % (self.local_database, manifest["key"]))
+        self.replace_local_database(lambda path: self.journal.download_snapshot(manifest, path))
+        self.open_connection()
+        self.journal.adopt_snapshot(manifest, origin or ChangeJournal.new_origin(), shipped_seq)
+
+    def journal_sync(self):
+        # Ships what's been recorded and applies what's new, True if
+        # anything came in
+        try:
+            self.journal.push()
+            return self.journal.pull() > 0
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.logger.warning("Error attempting to sync the change journal: %s" % sys.exc_info()[1])
+            return False
+
+    def journal_finish(self, raise_errors=False):
+        # Journal mode's side of __exit__: ship everything, then snapshot if
+        # it's due.  Snapshots are skipped while another machine holds the
+        # S3 lease, so with a lease there's one machine compacting.
+        if self.lock is None or not self.lock.acquire():
+            self.logger.warning("Not shipping the change journal, %s is in use by another allplay" % self.local_database)
+            return False
+        try:
+            self.journal.push()
+            lease = self.s3_lease()
+            if lease is None or lease.check():
+                self.journal.snapshot()
+            return True
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            if raise_errors:
+                raise
+            self.logger.warning("Error attempting to ship the change journal: %s" % sys.exc_info()[1])
+            return False
+
+    def replace_local_database(self, download):
+        # download(path) fetches the db to path.  It goes next to the local
+        # db and is swapped in once complete; a -wal or -shm left by the old
+        # file belongs to it and would be replayed into the new one.
+        (fd, download_path) = tempfile.mkstemp(prefix=".allplay-download-", dir=os.path.dirname(os.path.abspath(self.local_database)))
+        os.close(fd)
+        try:
+            download(download_path)
+            for suffix in ("-wal", "-shm"):
+                if os.path.exists(self.local_database + suffix):
+                    os.unlink(self.local_database + suffix)
+            os.replace(download_path, self.local_database)
+        finally:
+            if os.path.exists(download_path):
+                os.unlink(download_path)
+
+    def upload_snapshot(self, upload):
+        # upload(path) sends the file at path, which is a snapshot rather
+        # than the live db
+        (fd, snapshot_path) = tempfile.mkstemp(prefix=".allplay-snapshot-", dir=os.path.dirname(os.path.abspath(self.local_database)))
+        os.close(fd)
+        try:
+            self.snapshot(snapshot_path)
+            upload(snapshot_path)
+        finally:
+            os.unlink(snapshot_path)
+
+    def snapshot(self, snapshot_path):
+        ''' Writes a consistent copy of the db to snapshot_path.
+
+        The copy is made with the sqlite backup API on its own connection,
+        so it includes everything committed so far, even what's still in
+        the -wal file, and is safe to take while this or another allplay has
+        the db open.  The copy is a single rollback journal mode file.
+        '''
+        source = sqlite3.connect(self.local_database, timeout=self._busy_timeout_sec())
+        try:
+            target = sqlite3.connect(snapshot_path)
+            try:
+                source.backup(target)
+                target.execute('''PRAGMA journal_mode = DELETE''')
+            finally:
+                target.close()
+        finally:
+            source.close()
+
+    def _busy_timeout_sec(self):
+        return int(self.pragmas.get("busy_timeout") or 0) / 1000
+
+    def apply_pragmas(self, sqlite_conn, names=None):
+        # Sorted, so busy_timeout is set before anything that might wait
+        for (name, value) in sorted(self.pragmas.items()):
+            if value is None or (names is not None and name not in names):
+                continue
+            if not re.match(r"^\w+$", name) or not re.match(r"^-?\w+$", str(value)):
+                self.logger.warning("Ignoring sqlite pragma %s: %s" % (name, value))
+                continue
+            try:
+                result = sqlite_conn.execute('''PRAGMA %s = %s''' % (name, value)).fetchall()
+            except sqlite3.OperationalError as err:
+                self.logger.warning("Could not set sqlite pragma %s to %s: %s" % (name, value, err))
+                continue
+            if name == "journal_mode" and result and result[0][0].lower() != str(value).lower():
+                # e.g. wal on a filesystem without shared memory support
+                self.logger.warning("sqlite journal_mode is %s, %s is not available here" % (result[0][0], value))
+
+    def reader(self, check_same_thread=True):
+        ''' Opens a read only connection to the db, the caller closes it.
+
+        With WAL, readers see everything committed and neither block nor
+        wait on the main connection's writes.  Used for the library
+        cursor's pages and searches (db_read_iterator) and on background
+        threads, which can't share the main connection.
+        '''
+        uri = "file:%s?mode=ro" % urllib.parse.quote(os.path.abspath(self.local_database))
+        sqlite_conn = sqlite3.connect(uri, uri=True, factory=InstrumentedConnection, check_same_thread=check_same_thread,
+                                      timeout=self._busy_timeout_sec())
+        self.apply_pragmas(sqlite_conn, READER_PRAGMAS)
+        sqlite_conn.execute('''PRAGMA query_only = 1''')
+        return sqlite_conn
 
     def db_connect(self):
         try:
-            sqlite_conn = sqlite3.connect(self.local_database)
+            sqlite_conn = sqlite3.connect(self.local_database, factory=InstrumentedConnection, timeout=self._busy_timeout_sec())
+            sqlite_conn.stats.slow_query_ms = self.slow_query_ms
+            self.apply_pragmas(sqlite_conn)
         except sqlite3.Error as err:
             self.logger.warning("Error attempting to connect to the sqlite database: %s" % err)
         return sqlite_conn
 
+    @property
+    def sql_stats(self):
+        # SqlStats for everything run on the connection
+        return self.sqlite_conn.stats
+
     def db_close(self):
         self.sqlite_conn.commit()
         self.sqlite_conn.close()
 
     def initialize_schema(self):
+        # Migrations run in order and once each, PRAGMA user_version holds
+        # the last one applied.
+        migrations = [ self.migrate_base_schema, self.migrate_integer_mtime, self.migrate_sort_indexes,
+                       self.migrate_media_files, self.migrate_change_journal ]
+        version = self.sqlite_cursor.execute('''PRAGMA user_version''').fetchone()[0]
+        if version > len(migrations):
+            self.logger.warning("Database schema version %s is newer than this allplay knows about (%s)" % (version, len(migrations)))
+        for (index, migration) in enumerate(migrations[version:], start=version + 1):
+            self.logger.warning("Migrating database schema to version %s" % index)
+            self.sqlite_cursor.execute('''BEGIN''')
+            try:
+                migration()
+                self.sqlite_cursor.execute('''PRAGMA user_version = %d''' % index)
+                self.sqlite_conn.commit()
+            except:
+                self.sqlite_conn.rollback()
+                raise
+        # Not a migration, FTS5 depends on the sqlite of the machine running
+        self.initialize_fts()
+        self.sqlite_conn.commit()
+
+    def migrate_base_schema(self):
+        # Version 1, everything from before schema versions
         self.sqlite_cursor.execute('''CREATE TABLE IF NOT EXISTS media (
                           media_id INTEGER PRIMARY KEY AUTOINCREMENT,
                           mount_alias VARCHAR(64),
                           path VARCHAR(255),
                           mtime VARCHAR(18) DEFAULT (datetime('now')),
                           times_played INT DEFAULT 0,
+                          media_size INTEGER DEFAULT NULL,
                           UNIQUE(mount_alias, path)
                           )''')
         self.sqlite_cursor.execute('''CREATE INDEX IF NOT EXISTS idx_mount_alias ON media (mount_alias)''')
@@ -149,13 +619,184 @@ class Database(object):
                           FOREIGN KEY(media_id) REFERENCES media(media_id),
                           FOREIGN KEY(tag_id) REFERENCES tags(tag_id)
                           )''')
-        # Add media_size column to existing databases
-        try:
+        # Per directory results of the last scan, see scan_state.ScanState
+        self.sqlite_cursor.execute('''CREATE TABLE IF NOT EXISTS scan_state (
+                          mount_alias VARCHAR(64),
+                          path VARCHAR(255),
+                          parent VARCHAR(255),
+                          mtime INTEGER,
+                          entry_count INTEGER,
+                          has_media INTEGER DEFAULT 0,
+                          scan_generation INTEGER,
+                          PRIMARY KEY (mount_alias, path)
+                          )''')
+        self.sqlite_cursor.execute('''CREATE INDEX IF NOT EXISTS idx_scan_state_parent ON scan_state (mount_alias, parent)''')
+        # Databases from before media_size
+        columns = [ row[1] for row in self.sqlite_cursor.execute('''PRAGMA table_info(media)''') ]
+        if "media_size" not in columns:
             self.sqlite_cursor.execute('''ALTER TABLE media ADD COLUMN media_size INTEGER DEFAULT NULL''')
-        except sqlite3.OperationalError:
-            # Column already exists
-            pass
-        self.sqlite_conn.commit()
+
+    def migrate_integer_mtime(self):
+        # Version 2, mtime becomes epoch seconds.  The old column held
+        # str(datetime) from the scanner (local time, nearly always with
+        # microseconds) and datetime('now') defaults (UTC, no fraction), so
+        # a '.' is taken to mean local time.  sqlite can't change a column
+        # type, so the table is rebuilt keeping the media_ids.
+        last_id = self.sqlite_cursor.execute('''SELECT seq FROM sqlite_sequence WHERE name = 'media' ''').fetchone()
+        self.sqlite_cursor.execute('''CREATE TABLE media_migrate (
+                          media_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                          mount_alias VARCHAR(64),
+                          path VARCHAR(255),
+                          mtime INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+                          times_played INT DEFAULT 0,
+                          media_size INTEGER DEFAULT NULL,
+                          UNIQUE(mount_alias, path)
+                          )''')
+        self.sqlite_cursor.execute('''INSERT INTO media_migrate (media_id, mount_alias, path, mtime, times_played, media_size)
+                          SELECT media_id, mount_alias, path,
+                                 COALESCE(CASE WHEN typeof(mtime) IN ('integer', 'real') THEN CAST(mtime AS INTEGER)
+                                               WHEN instr(mtime, '.') > 0 THEN CAST(strftime('%s', mtime, 'utc') AS INTEGER)
+                                               ELSE CAST(strftime('%s', mtime) AS INTEGER)
+                                          END, 0),
+                                 times_played, media_size
+                          FROM media''')
+        self.sqlite_cursor.execute('''DROP TABLE media''')
+        self.sqlite_cursor.execute('''ALTER TABLE media_migrate RENAME TO media''')
+        if last_id is not None:
+            # Don't hand out ids of deleted media again
+            self.sqlite_cursor.execute('''UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'media' ''', last_id)
+        self.sqlite_cursor.execute('''CREATE INDEX IF NOT EXISTS idx_mount_alias ON media (mount_alias)''')
+        self.sqlite_cursor.execute('''CREATE INDEX IF NOT EXISTS idx_media_path ON media (mount_alias, path)''')
+
+    def migrate_sort_indexes(self):
+        # Version 3, one covering index per sort mode, keyed like the
+        # library cursor pages (sort expression, media_id), so ordered loads
+        # never touch the table itself.
+        self.sqlite_cursor.execute('''CREATE INDEX IF NOT EXISTS idx_media_times_played
+                          ON media (times_played, media_id, mount_alias, path, mtime, media_size)''')
+        self.sqlite_cursor.execute('''CREATE INDEX IF NOT EXISTS idx_media_mtime
+                          ON media (mtime, media_id, mount_alias, path, times_played, media_size)''')
+        self.sqlite_cursor.execute('''CREATE INDEX IF NOT EXISTS idx_media_size
+                          ON media (IFNULL(media_size, -1), media_id, mount_alias, path, mtime, times_played, media_size)''')
+
+    def migrate_media_files(self):
+        # Version 4, cached file lists for directory media, see
+        # file_cache.MediaFileCache
+        self.sqlite_cursor.execute('''CREATE TABLE IF NOT EXISTS media_files (
+                          media_id INTEGER,
+                          rel_path VARCHAR(255),
+                          is_dir INTEGER DEFAULT 0,
+                          size INTEGER,
+                          mtime INTEGER,
+                          PRIMARY KEY (media_id, rel_path),
+                          FOREIGN KEY(media_id) REFERENCES media(media_id)
+                          )''')
+        self.sqlite_cursor.execute('''CREATE TRIGGER IF NOT EXISTS media_files_delete AFTER DELETE ON media BEGIN
+                          DELETE FROM media_files WHERE media_id = old.media_id;
+                          END''')
+
+    def migrate_change_journal(self):
+        # Version 5, the change journal for sync_mode journal, see
+        # journal.ChangeJournal.  The triggers only record while
+        # journal_state.recording is 1, which nothing sets in file mode.
+        self.sqlite_cursor.execute('''CREATE TABLE IF NOT EXISTS change_journal (
+                          seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                          op VARCHAR(16),
+                          mount_alias VARCHAR(64),
+                          path VARCHAR(255),
+                          tag_name VARCHAR(64),
+                          new_mount_alias VARCHAR(64),
+                          new_path VARCHAR(255),
+                          new_tag_name VARCHAR(64),
+                          number INTEGER,
+                          size INTEGER,
+                          created INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+                          )''')
+        self.sqlite_cursor.execute('''CREATE TABLE IF NOT EXISTS journal_state (
+                          id INTEGER PRIMARY KEY CHECK (id = 0),
+                          origin VARCHAR(64),
+                          shipped_seq INTEGER DEFAULT 0,
+                          recording INTEGER DEFAULT 0
+                          )''')
+        self.sqlite_cursor.execute('''INSERT OR IGNORE INTO journal_state (id) VALUES (0)''')
+        # How far into each machine's journal this db has been brought
+        self.sqlite_cursor.execute('''CREATE TABLE IF NOT EXISTS journal_origins (
+                          origin VARCHAR(64) PRIMARY KEY,
+                          applied_seq INTEGER DEFAULT 0
+                          )''')
+        recording = '''(SELECT recording FROM journal_state WHERE id = 0) = 1'''
+        triggers = (
+            ('''journal_media_insert AFTER INSERT ON media''', '''1''',
+             '''INSERT INTO change_journal (op, mount_alias, path, number, size)
+                VALUES ('media_insert', new.mount_alias, new.path, new.mtime, new.media_size)'''),
+            ('''journal_media_delete AFTER DELETE ON media''', '''1''',
+             '''INSERT INTO change_journal (op, mount_alias, path) VALUES ('media_delete', old.mount_alias, old.path)'''),
+            ('''journal_media_move AFTER UPDATE OF mount_alias, path ON media''',
+             '''(new.mount_alias IS NOT old.mount_alias OR new.path IS NOT old.path)''',
+             '''INSERT INTO change_journal (op, mount_alias, path, new_mount_alias, new_path)
+                VALUES ('media_move', old.mount_alias, old.path, new.mount_alias, new.path)'''),
+            # Plays as a delta, so plays on two machines add up
+            ('''journal_media_played AFTER UPDATE OF times_played ON media''',
+             '''new.times_played IS NOT old.times_played''',
+             '''INSERT INTO change_journal (op, mount_alias, path, number)
+                VALUES ('media_played', new.mount_alias, new.path, IFNULL(new.times_played, 0) - IFNULL(old.times_played, 0))'''),
+            ('''journal_media_update AFTER UPDATE OF mtime, media_size ON media''',
+             '''(new.mtime IS NOT old.mtime OR new.media_size IS NOT old.media_size)''',
+             '''INSERT INTO change_journal (op, mount_alias, path, number, size)
+                VALUES ('media_update', new.mount_alias, new.path, new.mtime, new.media_size)'''),
+            ('''journal_tag_rename AFTER UPDATE OF tag_name ON tags''', '''new.tag_name IS NOT old.tag_name''',
+             '''INSERT INTO change_journal (op, tag_name, new_tag_name) VALUES ('tag_rename', old.tag_name, new.tag_name)'''),
+            ('''journal_tag_delete AFTER DELETE ON tags''', '''1''',
+             '''INSERT INTO change_journal (op, tag_name) VALUES ('tag_delete', old.tag_name)'''),
+            ('''journal_media_tag_add AFTER INSERT ON media_tags''', '''1''',
+             '''INSERT INTO change_journal (op, mount_alias, path, tag_name)
+                SELECT 'media_tag_add', m.mount_alias, m.path, t.tag_name FROM media m, tags t
+                WHERE m.media_id = new.media_id AND t.tag_id = new.tag_id'''),
+            ('''journal_media_tag_remove AFTER DELETE ON media_tags''', '''1''',
+             '''INSERT INTO change_journal (op, mount_alias, path, tag_name)
+                SELECT 'media_tag_remove', m.mount_alias, m.path, t.tag_name FROM media m, tags t
+                WHERE m.media_id = old.media_id AND t.tag_id = old.tag_id'''))
+        for (trigger, condition, statement) in triggers:
+            self.sqlite_cursor.execute('''CREATE TRIGGER IF NOT EXISTS ''' + trigger + '''
+                          WHEN ''' + recording + ''' AND ''' + condition + ''' BEGIN
+                          ''' + statement + ''';
+                          END''')
+
+    def initialize_fts(self):
+        # Full text index over media paths for searching, only if this
+        # sqlite was built with FTS5.  The db is synced between machines, so
+        # one without FTS5 drops the triggers (inserts would fail otherwise)
+        # and the next one with FTS5 rebuilds the stale index.
+        fts_triggers = ("media_fts_insert", "media_fts_delete", "media_fts_update")
+        existing = set(row[0] for row in self.sqlite_cursor.execute(
+            '''SELECT name FROM sqlite_master WHERE name = 'media_fts' OR name IN (?,?,?)''', fts_triggers))
+        try:
+            self.sqlite_cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS media_fts USING fts5(
+                              path,
+                              content='media',
+                              content_rowid='media_id',
+                              tokenize="unicode61 separators '._-'"
+                              )''')
+        except sqlite3.OperationalError as err:
+            self.logger.debug("FTS5 not available, searching paths with LIKE: %s" % err)
+            for trigger in fts_triggers:
+                self.sqlite_cursor.execute('''DROP TRIGGER IF EXISTS ''' + trigger)
+            self.fts5_enabled = False
+            return
+        self.sqlite_cursor.execute('''CREATE TRIGGER IF NOT EXISTS media_fts_insert AFTER INSERT ON media BEGIN
+                          INSERT INTO media_fts (rowid, path) VALUES (new.media_id, new.path);
+                          END''')
+        self.sqlite_cursor.execute('''CREATE TRIGGER IF NOT EXISTS media_fts_delete AFTER DELETE ON media BEGIN
+                          INSERT INTO media_fts (media_fts, rowid, path) VALUES ('delete', old.media_id, old.path);
+                          END''')
+        self.sqlite_cursor.execute('''CREATE TRIGGER IF NOT EXISTS media_fts_update AFTER UPDATE OF path ON media BEGIN
+                          INSERT INTO media_fts (media_fts, rowid, path) VALUES ('delete', old.media_id, old.path);
+                          INSERT INTO media_fts (rowid, path) VALUES (new.media_id, new.path);
+                          END''')
+        if not existing.issuperset(("media_fts",) + fts_triggers):
+            self.logger.warning("Building the media path search index")
+            self.sqlite_cursor.execute('''INSERT INTO media_fts (media_fts) VALUES ('rebuild')''')
+        self.fts5_enabled = True
 
     def insert_test_data(self):
         self.sqlite_cursor.execute('''INSERT INTO media (mount_alias, path) VALUES (?,?)''', ('td', 'testing123.mp4'))
@@ -177,6 +818,18 @@ class Database(object):
             self.logger.warning(err)
             raise
 
+    def db_read_iterator(self, query="SELECT * FROM media", parameters=()):
+        # SELECTs that only need committed data, on the read only connection
+        if self.read_conn is None:
+            self.read_conn = self.reader()
+            self.read_conn.stats = self.sqlite_conn.stats
+            profiling.trace_connection(self.read_conn)
+        try:
+            return self.read_conn.execute(query, parameters)
+        except (ValueError, sqlite3.OperationalError) as err:
+            self.logger.warning(err)
+            raise
+
     def db_insert(self, query=None, parameters=()):
         ''' Returns a tuple of (rowcount, lastrowid) '''
         try:
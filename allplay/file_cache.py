@@ -0,0 +1,57 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import logging
+
+
+class MediaFileCache(object):
+    ''' The media_files table: each directory media item's files and sizes.
+
+    Rows are keyed by (media_id, rel_path), rel_path being relative to the
+    media item.  Media files have is_dir 0 and their size, directories
+    (including '' for the item itself) have is_dir 1 and their mtime in
+    nanoseconds.  Adding, removing or renaming a file changes its
+    directory's mtime, so when a stat of every cached directory still
+    matches, the cached list can be used without walking anything (see
+    Media.probe).  Writes only happen on the main thread.
+    '''
+    def __init__(self, db):
+        self.db = db
+        self.logger = logging.getLogger()
+
+    def load(self, media_id, sqlite_conn=None):
+        ''' Returns {"dirs": {rel_dir: mtime}, "files": [(rel_path, size)]} or None
+
+        Off the main thread, pass a connection from Database.reader().
+        '''
+        sql = '''SELECT rel_path, is_dir, size, mtime FROM media_files WHERE media_id = ?'''
+        if sqlite_conn is not None:
+            rows = sqlite_conn.execute(sql, (media_id,))
+        else:
+            rows = self.db.db_query_qmark_iterator(sql, (media_id,))
+        listing = { "dirs": dict(), "files": list() }
+        for (rel_path, is_dir, size, mtime) in rows:
+            if is_dir:
+                listing["dirs"][rel_path] = mtime
+            else:
+                listing["files"].append((rel_path, size))
+        if '' not in listing["dirs"]:
+            return None
+        return listing
+
+    def store(self, media_id, listing, commit=True):
+        rows = [ (media_id, rel_dir, 1, None, mtime) for (rel_dir, mtime) in listing["dirs"].items() ]
+        rows.extend((media_id, rel_path, 0, size, None) for (rel_path, size) in listing["files"])
+        self.db.sqlite_cursor.execute('''DELETE FROM media_files WHERE media_id = ?''', (media_id,))
+        self.db.sqlite_cursor.executemany('''INSERT INTO media_files (media_id, rel_path, is_dir, size, mtime)
+                                             VALUES (?,?,?,?,?)''', rows)
+        if commit:
+            self.db.sqlite_conn.commit()
+
+    def remove_file(self, media_id, rel_path, rel_dir, dir_mtime):
+        # A file deleted from inside allplay, keep the rest of the cache
+        # valid by recording its directory's new mtime too.
+        self.db.sqlite_cursor.execute('''DELETE FROM media_files WHERE media_id = ? AND rel_path = ? AND is_dir = 0''',
+                                      (media_id, rel_path))
+        if dir_mtime is not None:
+            self.db.sqlite_cursor.execute('''UPDATE media_files SET mtime = ? WHERE media_id = ? AND rel_path = ? AND is_dir = 1''',
+                                          (dir_mtime, media_id, rel_dir))
+        self.db.sqlite_conn.commit()
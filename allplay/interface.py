@@ -1,7 +1,9 @@
 from __future__ import (absolute_import, division, print_function, unicode_literals)
-from builtins import input
+import shlex
 import sys
-from .tags import Tags
+from .library import cancel_on_interrupt
+from .tagquery import TagQuery, TagQueryError
+from .tags import BulkTags
 
 class Interface(object):
     def __init__(self, config, lib, db, media):
@@ -9,7 +11,7 @@ class Interface(object):
         self.db = db
         self.lib = lib
         self.media = media
-        self.tags = Tags(self.config, self.db, self.media.media_id)
+        self.tags = self.media.tags
 
     def media_menu(self):
         menu_text = ("Media Actions:\n"
@@ -51,7 +53,7 @@ class Interface(object):
                 print("media_id: '{0}'".format(self.media.media_id))
                 print("mount_alias: '{0}'".format(self.media.mount_alias))
                 print("path: '{0}'".format(self.media.path))
-                print("mtime: '{0}'".format(self.media.mtime))
+                print("mtime: '{0}' ({1})".format(self.media.mtime, self.media.modified_time))
                 print("times_played: '{0}'".format(self.media.times_played))
                 print("tags: '{0}'".format(self.tags.tags))
                 print("files: '{0}'".format(self.media.files))
@@ -72,7 +74,8 @@ class Interface(object):
     def media_delete_single_file(self):
         self.print_list_indexes(self.media.files)
         delete_indexes = input("Input the indexes to delete (space separated), or 'c' to cancel: ").split()
-        for delete_index in delete_indexes:
+        # Highest first, deleting a file shifts the ones after it
+        for delete_index in sorted(set(delete_indexes), key=lambda index: int(index) if index.isdigit() else -1, reverse=True):
             if delete_index.isdigit():
                 if int(delete_index) > len(self.media.files) - 1 or int(delete_index) < 0:
                     print('{0} is an invalid index'.format(delete_index))
@@ -122,7 +125,9 @@ class Interface(object):
                      "(r) Rescan\n"
                      "(st) Search Tags\n"
                      "(ss) Search String\n"
+                     "(sr) Search String, Best Matches First\n"
                      "(sb) Search Both Tags and Strings\n"
+                     "(bt) Bulk Tag Everything in the Current Mode\n"
                      "Or Jump to:\n"
                      "(m) Media Actions\n"
                      "(db) Database Actions\n"
@@ -161,78 +166,136 @@ class Interface(object):
             return self.library_search_tags()
         elif action == "ss":
             return self.library_search_strings()
+        elif action == "sr":
+            return self.library_search_strings(ranked=True)
         elif action == "sb":
             return self.library_search_tags_and_strings()
+        elif action == "bt":
+            return self.library_bulk_tags()
         elif action == "m":
             return "menu"
         elif action == "db":
-            return self.db_menu()
+            return self.database_menu()
         elif action == "x":
             self.exit()
         else:
             return self.library_menu()
 
     def library_search_get_tags(self):
+        # Returns a TagQuery, or None to cancel
         if self.config.quick_tags is not None:
             print("Select from the following quick tags:")
             for quick_tag, full_tag in self.config.quick_tags.items():
                 print ('({0}) {1}'.format(quick_tag, full_tag))
             print("Or...")
-        input_tags = input("Input the tags to search (space separated), or 'c' to cancel: ").split()
-        for input_index, input_tag in enumerate(input_tags):
-            if self.config.quick_tags is not None:
-                # Check if tag matches a quick tag
-                if input_tag in self.config.quick_tags.keys():
-                    input_tags[input_index] = self.config.quick_tags[input_tag]
-                    continue
-        return input_tags
+        print("Tags can be combined with AND, OR, NOT and (), sci* matches tags starting with sci.")
+        query_text = input("Input the tags to search (space separated tags must all match), or 'c' to cancel: ")
+        if query_text.strip() in ("", "c"):
+            return None
+        try:
+            return TagQuery(query_text, aliases=self.config.quick_tags)
+        except TagQueryError as err:
+            print("Bad tag search: {0}".format(err))
+            return self.library_search_get_tags()
 
     def library_search_get_strings(self):
-        input_strings = input("Input the strings to search (space separated), or 'c' to cancel: ").split()
+        raw_input = input("Input the strings to search (space separated, \"quote\" phrases), or 'c' to cancel: ")
+        try:
+            input_strings = shlex.split(raw_input)
+        except ValueError:
+            # Unbalanced quotes
+            input_strings = raw_input.split()
         return input_strings
 
     def library_search_tags(self):
-        input_tags = self.library_search_get_tags()
-        if "c" in input_tags:
+        tag_query = self.library_search_get_tags()
+        if tag_query is None:
             return "menu"
-        self.lib.populate_from_db_search(self.config, tags=input_tags)
-        self.lib.mode = "Search Tags: {0}".format(", ".join(input_tags))
+        self.lib.populate_from_db_search(self.config, tag_query=tag_query, exclude_tags=self.config.default_exclusion_tags)
+        self.lib.mode = "Search Tags: {0}".format(tag_query)
         return "library_update"
 
-    def library_search_strings(self):
+    def library_search_strings(self, ranked=False):
         input_strings = self.library_search_get_strings()
         if "c" in input_strings:
             return "menu"
-        self.lib.populate_from_db_search(self.config, search_strings=input_strings)
-        self.lib.mode = "Search strings: {0}".format(", ".join(input_strings))
+        self.lib.populate_from_db_search(self.config, search_strings=input_strings, exclude_tags=self.config.default_exclusion_tags,
+                                         ranked=ranked)
+        self.lib.mode = "Search strings{0}: {1}".format(" (best matches first)" if ranked else "", ", ".join(input_strings))
         return "library_update"
 
 
     def library_search_tags_and_strings(self):
-        input_tags = self.library_search_get_tags()
-        if "c" in input_tags:
+        tag_query = self.library_search_get_tags()
+        if tag_query is None:
             return "menu"
         input_strings = self.library_search_get_strings()
         if "c" in input_strings:
             return "menu"
-        self.lib.populate_from_db_search(self.config, tags=input_tags, search_strings=input_strings)
-        self.lib.mode = "Search tags and strings: \n  tags: {0}\n  strings: {1}".format(", ".join(input_tags), ", ".join(input_strings))
+        self.lib.populate_from_db_search(self.config, tag_query=tag_query, search_strings=input_strings,
+                                        exclude_tags=self.config.default_exclusion_tags)
+        self.lib.mode = "Search tags and strings: \n  tags: {0}\n  strings: {1}".format(tag_query, ", ".join(input_strings))
         return "library_update"
 
+    def library_bulk_tags(self):
+        (media_ids, where, params) = self.lib.current_selection()
+        if media_ids is not None:
+            count = len(media_ids)
+        else:
+            count = self.lib.cursor.total() if self.lib.cursor is not None else 0
+        menu_text = ("Bulk Tag Actions, {0} media in {1}:\n"
+                     "(a)  Add tags to all of them\n"
+                     "(r)  Remove tags from all of them\n"
+                     "(n)  Rename a tag on them\n"
+                     "(mg) Merge tags across the whole library\n"
+                     "(c)  Cancel\n"
+                     "Please make a selection: ").format(count, self.lib.mode)
+        action = input(menu_text)
+        bulk = BulkTags(self.config, self.db, self.lib.tag_index)
+        try:
+            if action == "a":
+                for tag in self.expand_quick_tags(input("Input the tags to add (space separated): ").split()):
+                    bulk.add(tag, media_ids, where, params)
+            elif action == "r":
+                for tag in self.expand_quick_tags(input("Input the tags to remove (space separated): ").split()):
+                    bulk.remove(tag, media_ids, where, params)
+            elif action == "n":
+                old_tag = input("Tag to rename: ")
+                new_tag = input("Rename {0} to: ".format(old_tag))
+                bulk.rename(old_tag, new_tag, media_ids, where, params)
+            elif action == "mg":
+                source_tags = input("Tags to merge (space separated): ").split()
+                target_tag = input("Merge them into: ")
+                bulk.merge(source_tags, target_tag)
+        except ValueError as err:
+            print(err)
+        return "menu"
+
+    def expand_quick_tags(self, input_tags):
+        if self.config.quick_tags is None:
+            return input_tags
+        return [ self.config.quick_tags.get(input_tag, input_tag) for input_tag in input_tags ]
+
     def library_rescan(self):
-        for path_alias, path in self.config.media_sources.items():
-            self.lib.scan_source(config=self.config, path_alias=path_alias, path=path)
+        self.lib.scan_sources(self.config)
         self.lib.scanned_to_library_and_db(self.config)
-        self.lib.update_missing_sizes(self.config)
+        with cancel_on_interrupt() as cancel:
+            self.lib.update_missing_sizes(self.config, progress=self.lib.print_size_progress, cancel=cancel)
+        self.lib.populate_from_db(self.config, exclude_tags=self.config.default_exclusion_tags)
         self.lib.mode = "random"
         return "library_update"
 
 
     def database_menu(self):
+        if self.db.sync_worker is not None:
+            for line in self.db.sync_worker.status():
+                print(line)
         menu_text = ("DB Actions:\n"
                      "(s) Sync from S3\n"
                      "(p) Push to S3\n"
                      "(d) Disable Automatic Push to S3\n"
+                     "(q) Query Stats\n"
+                     "(qr) Reset Query Stats\n"
                      "Or Jump to:\n"
                      "(m) Media Actions\n"
                      "(l) Library Actions\n"
@@ -241,13 +304,19 @@ class Interface(object):
         action = input(menu_text)
         return_action = "menu"
         if action == "s":
-            self.db.s3_to_local()
-            self.lib.populate_from_db(self.config)
+            self.db.s3_sync_reload()
+            self.lib.tag_index.load()
+            self.lib.populate_from_db(self.config, exclude_tags=self.config.default_exclusion_tags)
             return "library_update"
         elif action == "p":
             self.db.local_to_s3(force=True)
         elif action == "d":
             self.db.s3_sync_toggle(enable=False)
+        elif action == "q":
+            for line in self.db.sql_stats.summary():
+                print(line)
+        elif action == "qr":
+            self.db.sql_stats.reset()
         elif action == "x":
             self.exit()
         return return_action
@@ -0,0 +1,487 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import fcntl
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+from . import transfer
+
+JOURNAL_FORMAT = 1
+JOURNAL_PREFIX = "journal/"
+SNAPSHOT_PREFIX = "snapshot/"
+MANIFEST_KEY = SNAPSHOT_PREFIX + "manifest.json"
+# Entries per shipped object
+OBJECT_ENTRIES = 20000
+# The change_journal columns shipped for each entry, in order
+JOURNAL_COLUMNS = ("seq", "op", "mount_alias", "path", "tag_name", "new_mount_alias", "new_path", "new_tag_name", "number", "size")
+JOURNAL_KEY = re.compile(r"^" + JOURNAL_PREFIX + r"([^/]+)/(\d+)-(\d+)\.json\.gz$")
+
+
+class StoreConflict(Exception):
+    ''' A conditional put lost to another writer. '''
+
+
+class JournalGap(Exception):
+    ''' Journal objects this db still needs have been compacted away. '''
+
+
+class LocalStore(object):
+    ''' Journal storage in a local directory.
+
+    Same interface as S3Store, so the journal can be tried out and tested
+    without S3, or shipped through a folder some other tool syncs.  Keys
+    map to files under root.
+    '''
+    def __init__(self, root):
+        self.root = root
+        self.logger = logging.getLogger()
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    @staticmethod
+    def _etag(data):
+        return '"%s"' % hashlib.md5(data).hexdigest()
+
+    def get(self, key):
+        ''' Returns (data, etag), (None, None) if there's no such key '''
+        try:
+            with open(self._path(key), "rb") as stored:
+                data = stored.read()
+        except FileNotFoundError:
+            return (None, None)
+        return (data, self._etag(data))
+
+    def put(self, key, data, if_match=None, if_none_match=False):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(os.path.join(self.root, ".lock"), "a") as lock_file:
+            # Conditional puts are checked and written under one lock
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if if_match is not None or if_none_match:
+                (current, etag) = self.get(key)
+                if (if_none_match and current is not None) or (if_match is not None and etag != if_match):
+                    raise StoreConflict(key)
+            (fd, temp_path) = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as temp_file:
+                temp_file.write(data)
+            os.replace(temp_path, path)
+        return self._etag(data)
+
+    def list(self, prefix):
+        keys = list()
+        for (dir_path, dir_names, file_names) in os.walk(self.root):
+            for file_name in file_names:
+                key = os.path.relpath(os.path.join(dir_path, file_name), self.root).replace(os.sep, "/")
+                if key.startswith(prefix) and not file_name.startswith("."):
+                    keys.append(key)
+        return sorted(keys)
+
+    def delete(self, key):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def upload(self, path, key):
+        os.makedirs(os.path.dirname(self._path(key)), exist_ok=True)
+        shutil.copyfile(path, self._path(key))
+
+    def download(self, key, path):
+        shutil.copyfile(self._path(key), path)
+
+
+class S3Store(object):
+    ''' Journal storage under a prefix of an S3 bucket. '''
+    def __init__(self, profile, bucket, prefix):
+        self.profile = profile
+        self.bucket = bucket
+        self.prefix = prefix
+        self.logger = logging.getLogger()
+
+    @property
+    def client(self):
+        # Not made up front, that would import boto3 before the first sync
+        return transfer.client(self.profile)
+
+    def get(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)
+        except ClientError as err:
+            if err.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return (None, None)
+            raise
+        return (response["Body"].read(), response["ETag"])
+
+    def put(self, key, data, if_match=None, if_none_match=False):
+        condition = dict()
+        if if_match is not None:
+            condition["IfMatch"] = if_match
+        elif if_none_match:
+            condition["IfNoneMatch"] = "*"
+        from botocore.exceptions import ClientError
+        try:
+            response = self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data, **condition)
+        except ClientError as err:
+            if err.response.get("Error", {}).get("Code") in ("PreconditionFailed", "ConditionalRequestConflict", "412", "409"):
+                raise StoreConflict(key)
+            raise
+        return response.get("ETag")
+
+    def list(self, prefix):
+        keys = list()
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + prefix):
+            keys.extend(item["Key"][len(self.prefix):] for item in page.get("Contents", ()))
+        return sorted(keys)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def upload(self, path, key):
+        self.client.upload_file(path, self.bucket, self.prefix + key)
+
+    def download(self, key, path):
+        self.client.download_file(self.bucket, self.prefix + key, path)
+
+
+def store_from_config(config):
+    # journal_store_path wins over S3, None when neither is set up
+    if config.journal_store_path:
+        return LocalStore(os.path.expanduser(config.journal_store_path))
+    if config.s3_database and config.s3_database.get("bucket") and config.s3_database.get("filename"):
+        return S3Store(config.s3_database.get("profile"), config.s3_database["bucket"],
+                       config.s3_database["filename"] + ".journal/")
+    return None
+
+
+class ChangeJournal(object):
+    ''' Replicates the db as a journal of changes instead of whole files.
+
+    Triggers on media, tags and media_tags (see Database.migrate_change_journal)
+    append to change_journal while journal_state.recording is set.  Entries
+    use natural keys (mount_alias and path, tag_name) since media_ids differ
+    between machines, and plays are recorded as a delta of times_played so
+    plays on two machines at once add up.
+
+    Each machine has an origin id and ships its new entries as sequenced
+    objects, journal/<origin>/<first seq>-<last seq>.json.gz.  Pulling applies
+    every other origin's objects past what journal_origins says has been
+    applied, in order, with recording off so replayed changes aren't
+    journaled again; applying is idempotent, so an object shipped twice
+    or overlapping another does no harm.
+
+    Every snapshot_every objects a machine uploads a snapshot of its db and
+    snapshot/manifest.json, which records the snapshot and how far into
+    each origin's journal it goes.  A new machine starts from the latest
+    snapshot, and the objects the previous snapshot covered are deleted,
+    so a machine that's been away longer than a snapshot interval starts
+    over from a snapshot too (after shipping its own changes).
+    '''
+    def __init__(self, db, store, snapshot_every=100):
+        self.db = db
+        self.store = store
+        self.snapshot_every = max(int(snapshot_every), 1)
+        self.logger = logging.getLogger()
+
+    @staticmethod
+    def local_state(local_database):
+        # (origin, shipped_seq) of a db file without opening it for real,
+        # (None, 0) if it doesn't exist or has never journaled
+        if not os.path.isfile(local_database):
+            return (None, 0)
+        sqlite_conn = sqlite3.connect(local_database)
+        try:
+            row = sqlite_conn.execute('''SELECT origin, shipped_seq FROM journal_state WHERE id = 0''').fetchone()
+        except sqlite3.OperationalError:
+            row = None
+        finally:
+            sqlite_conn.close()
+        if row is None or row[0] is None:
+            return (None, 0)
+        return (row[0], row[1] or 0)
+
+    @staticmethod
+    def parse_key(key):
+        # (origin, first_seq, last_seq) of a journal object key, or None
+        match = JOURNAL_KEY.match(key)
+        if match is None:
+            return None
+        return (match.group(1), int(match.group(2)), int(match.group(3)))
+
+    def read_manifest(self):
+        ''' Returns (manifest, etag), (None, None) if nothing has been snapshotted yet '''
+        (data, etag) = self.store.get(MANIFEST_KEY)
+        if data is None:
+            return (None, None)
+        return (json.loads(data.decode("utf-8")), etag)
+
+    def state(self):
+        return self.db.sqlite_cursor.execute('''SELECT origin, shipped_seq FROM journal_state WHERE id = 0''').fetchone()
+
+    def applied(self):
+        return dict(self.db.sqlite_cursor.execute('''SELECT origin, applied_seq FROM journal_origins''').fetchall())
+
+    @staticmethod
+    def new_origin():
+        return "%x-%s" % (int(time.time()), os.urandom(6).hex())
+
+    def enable(self):
+        # Start recording, giving this db an origin the first time
+        (origin, shipped_seq) = self.state()
+        if origin is None:
+            origin = self.new_origin()
+            self.logger.warning("Starting the change journal as origin %s" % origin)
+        self.db.sqlite_cursor.execute('''UPDATE journal_state SET origin = ?, recording = 1 WHERE id = 0''', (origin,))
+        self.db.sqlite_cursor.execute('''INSERT OR IGNORE INTO journal_origins (origin, applied_seq) VALUES (?, ?)''',
+                                      (origin, shipped_seq))
+        self.db.sqlite_conn.commit()
+        return origin
+
+    def push(self):
+        ''' Ships the entries recorded since the last push, returns how many objects '''
+        objects = self.pending_objects()
+        for (key, data, first_seq, last_seq) in objects:
+            self.store.put(key, data)
+            self.mark_shipped(last_seq)
+        return len(objects)
+
+    def pending_objects(self):
+        ''' The entries recorded since the last push as (key, data, first_seq, last_seq) objects.
+
+        push() ships them right away, a SyncWorker ships them off the main
+        thread and reports back for mark_shipped.
+        '''
+        (origin, shipped_seq) = self.state()
+        objects = list()
+        if origin is None:
+            return objects
+        columns = ", ".join(JOURNAL_COLUMNS)
+        while True:
+            rows = self.db.sqlite_cursor.execute('''SELECT ''' + columns + ''' FROM change_journal
+                                                    WHERE seq > ? ORDER BY seq LIMIT ?''',
+                                                 (shipped_seq, OBJECT_ENTRIES)).fetchall()
+            if not rows:
+                return objects
+            (first_seq, last_seq) = (rows[0][0], rows[-1][0])
+            body = { "format": JOURNAL_FORMAT, "origin": origin, "first_seq": first_seq, "last_seq": last_seq,
+                     "columns": JOURNAL_COLUMNS, "entries": rows }
+            objects.append(("%s%s/%012d-%012d.json.gz" % (JOURNAL_PREFIX, origin, first_seq, last_seq),
+                            gzip.compress(json.dumps(body, separators=(",", ":")).encode("utf-8")), first_seq, last_seq))
+            shipped_seq = last_seq
+
+    def mark_shipped(self, last_seq):
+        # Everything up to last_seq is in the store
+        (origin, shipped_seq) = self.state()
+        if last_seq <= shipped_seq:
+            return
+        # Our own entries count as applied as long as nothing of ours is
+        # still waiting to be replayed (see adopt_snapshot)
+        self.db.sqlite_cursor.execute('''UPDATE journal_origins SET applied_seq = ?
+                                         WHERE origin = ? AND applied_seq >= ?''', (last_seq, origin, shipped_seq))
+        self.db.sqlite_cursor.execute('''UPDATE journal_state SET shipped_seq = ? WHERE id = 0''', (last_seq,))
+        self.db.sqlite_cursor.execute('''DELETE FROM change_journal WHERE seq <= ?''', (last_seq,))
+        self.db.sqlite_conn.commit()
+        self.logger.debug("Shipped journal entries up to %s" % last_seq)
+
+    def pending_count(self):
+        return self.db.sqlite_cursor.execute('''SELECT COUNT(*) FROM change_journal
+                                                WHERE seq > (SELECT shipped_seq FROM journal_state WHERE id = 0)''').fetchone()[0]
+
+    def pull(self):
+        ''' Applies everything new from the store, returns how many entries.
+
+        Raises JournalGap when this db is too far behind to catch up from
+        the journal objects that are left.
+        '''
+        return self.apply_fetched(self.fetch(self.applied()))
+
+    def fetch(self, applied, skip_origin=None):
+        ''' Downloads the journal objects past applied, as (origin, entries, last_seq) batches in order.
+
+        Only the store is touched, so this can run off the main thread with
+        a copy of applied().  Raises JournalGap like pull().
+        '''
+        applied = dict(applied)
+        batches = list()
+        for key in self.store.list(JOURNAL_PREFIX):
+            parsed = self.parse_key(key)
+            if parsed is None or parsed[0] == skip_origin:
+                continue
+            (origin, first_seq, last_seq) = parsed
+            done = applied.get(origin, 0)
+            if last_seq <= done:
+                continue
+            if first_seq > done + 1:
+                raise JournalGap("%s has entries %s to %s left, this db has applied up to %s" % (origin, first_seq, last_seq, done))
+            (data, etag) = self.store.get(key)
+            if data is None:
+                # Compacted away since the listing, picked up next time
+                continue
+            body = json.loads(gzip.decompress(data).decode("utf-8"))
+            batches.append((origin, [ entry for entry in body["entries"] if entry[0] > done ], last_seq))
+            applied[origin] = last_seq
+        return batches
+
+    def apply_fetched(self, batches):
+        # Whatever has been applied since the fetch is dropped, so batches
+        # fetched in the background are safe to apply late
+        applied = self.applied()
+        pulled = 0
+        for (origin, entries, last_seq) in batches:
+            done = applied.get(origin, 0)
+            if last_seq <= done:
+                continue
+            entries = [ entry for entry in entries if entry[0] > done ]
+            self.apply(origin, entries, last_seq)
+            applied[origin] = last_seq
+            pulled += len(entries)
+        if pulled:
+            self.logger.warning("Applied %s changes from other machines" % pulled)
+        return pulled
+
+    def apply(self, origin, entries, last_seq):
+        # One transaction per object, with the journal triggers off
+        if self.db.sqlite_conn.in_transaction:
+            self.db.sqlite_conn.commit()
+        cursor = self.db.sqlite_cursor
+        cursor.execute('''BEGIN''')
+        try:
+            cursor.execute('''UPDATE journal_state SET recording = 0 WHERE id = 0''')
+            for entry in entries:
+                self.apply_entry(cursor, dict(zip(JOURNAL_COLUMNS, entry)))
+            cursor.execute('''INSERT OR REPLACE INTO journal_origins (origin, applied_seq) VALUES (?, ?)''', (origin, last_seq))
+            cursor.execute('''UPDATE journal_state SET recording = 1 WHERE id = 0''')
+            self.db.sqlite_conn.commit()
+        except:
+            self.db.sqlite_conn.rollback()
+            raise
+
+    def apply_entry(self, cursor, entry):
+        op = entry["op"]
+        media_key = (entry["mount_alias"], entry["path"])
+        if op == "media_insert":
+            cursor.execute('''INSERT OR IGNORE INTO media (mount_alias, path, mtime, media_size) VALUES (?,?,?,?)''',
+                           media_key + (entry["number"], entry["size"]))
+        elif op == "media_delete":
+            cursor.execute('''DELETE FROM media_tags WHERE media_id IN (
+                                  SELECT media_id FROM media WHERE mount_alias = ? AND path = ?)''', media_key)
+            cursor.execute('''DELETE FROM media WHERE mount_alias = ? AND path = ?''', media_key)
+        elif op == "media_move":
+            cursor.execute('''UPDATE OR IGNORE media SET mount_alias = ?, path = ? WHERE mount_alias = ? AND path = ?''',
+                           (entry["new_mount_alias"], entry["new_path"]) + media_key)
+        elif op == "media_played":
+            cursor.execute('''UPDATE media SET times_played = IFNULL(times_played, 0) + ? WHERE mount_alias = ? AND path = ?''',
+                           (entry["number"],) + media_key)
+        elif op == "media_update":
+            cursor.execute('''UPDATE media SET mtime = ?, media_size = ? WHERE mount_alias = ? AND path = ?''',
+                           (entry["number"], entry["size"]) + media_key)
+        elif op == "media_tag_add":
+            if entry["path"] is None or entry["tag_name"] is None:
+                return
+            cursor.execute('''INSERT OR IGNORE INTO tags (tag_name) VALUES (?)''', (entry["tag_name"],))
+            cursor.execute('''INSERT OR IGNORE INTO media_tags (tag_id, media_id)
+                              SELECT t.tag_id, m.media_id FROM tags t, media m
+                              WHERE t.tag_name = ? AND m.mount_alias = ? AND m.path = ?''', (entry["tag_name"],) + media_key)
+        elif op == "media_tag_remove":
+            cursor.execute('''DELETE FROM media_tags
+                              WHERE tag_id = (SELECT tag_id FROM tags WHERE tag_name = ?)
+                              AND media_id = (SELECT media_id FROM media WHERE mount_alias = ? AND path = ?)''',
+                           (entry["tag_name"],) + media_key)
+        elif op == "tag_rename":
+            new_tag = cursor.execute('''SELECT tag_id FROM tags WHERE tag_name = ?''', (entry["new_tag_name"],)).fetchone()
+            if new_tag is None:
+                cursor.execute('''UPDATE tags SET tag_name = ? WHERE tag_name = ?''', (entry["new_tag_name"], entry["tag_name"]))
+            else:
+                # Already there, e.g. created here meanwhile, so merge
+                cursor.execute('''INSERT OR IGNORE INTO media_tags (tag_id, media_id)
+                                  SELECT ?, media_id FROM media_tags
+                                  WHERE tag_id = (SELECT tag_id FROM tags WHERE tag_name = ?)''', (new_tag[0], entry["tag_name"]))
+                cursor.execute('''DELETE FROM media_tags WHERE tag_id = (SELECT tag_id FROM tags WHERE tag_name = ?)''',
+                               (entry["tag_name"],))
+                cursor.execute('''DELETE FROM tags WHERE tag_name = ?''', (entry["tag_name"],))
+        elif op == "tag_delete":
+            # Only if nothing here still uses it
+            cursor.execute('''DELETE FROM tags WHERE tag_name = ?
+                              AND NOT EXISTS (SELECT 1 FROM media_tags mt WHERE mt.tag_id = tags.tag_id)''',
+                           (entry["tag_name"],))
+        else:
+            self.logger.warning("Skipping unknown journal entry %s" % op)
+
+    def snapshot(self, force=False):
+        ''' Uploads a snapshot and a new manifest if enough has been shipped since the last one.
+
+        Returns True if a snapshot was written.
+        '''
+        (manifest, etag) = self.read_manifest()
+        covered = manifest["applied"] if manifest is not None else dict()
+        keys = list()
+        for key in self.store.list(JOURNAL_PREFIX):
+            parsed = self.parse_key(key)
+            if parsed is not None:
+                keys.append((key, parsed))
+        newer = [ key for (key, (origin, first_seq, last_seq)) in keys if last_seq > covered.get(origin, 0) ]
+        if manifest is not None and not force and len(newer) < self.snapshot_every:
+            return False
+        # The snapshot has to hold exactly what applied says, so everything
+        # of ours is shipped first and nothing's written until it's copied
+        self.push()
+        (origin, shipped_seq) = self.state()
+        applied = self.applied()
+        if origin is None or applied.get(origin, 0) != shipped_seq:
+            self.logger.debug("Not snapshotting, our own journal isn't fully replayed yet")
+            return False
+        snapshot_key = "%s%d-%s-%d.sqlite3.gz" % (SNAPSHOT_PREFIX, int(time.time()), origin, shipped_seq)
+        digests = list()
+        def upload(path):
+            digests.append(transfer.sha256_file(path))
+            transfer.upload_compressed(lambda gz_path: self.store.upload(gz_path, snapshot_key), path)
+        self.db.upload_snapshot(upload)
+        body = { "format": JOURNAL_FORMAT, "key": snapshot_key, "sha256": digests[0], "created": int(time.time()),
+                 "origin": origin, "applied": applied }
+        try:
+            self.store.put(MANIFEST_KEY, json.dumps(body, indent=1, sort_keys=True).encode("utf-8"),
+                           if_match=etag, if_none_match=manifest is None)
+        except StoreConflict:
+            self.logger.warning("Another machine wrote a snapshot at the same time, keeping theirs")
+            self.store.delete(snapshot_key)
+            return False
+        self.logger.warning("Wrote a journal snapshot %s" % snapshot_key)
+        if manifest is not None:
+            # What the previous snapshot covered has had a whole interval
+            # to be picked up, anyone further behind starts from this one
+            for (key, (key_origin, first_seq, last_seq)) in keys:
+                if last_seq <= covered.get(key_origin, 0):
+                    self.store.delete(key)
+            if manifest["key"] != snapshot_key:
+                self.store.delete(manifest["key"])
+        return True
+
+    def download_snapshot(self, manifest, path):
+        transfer.download_compressed(lambda gz_path: self.store.download(manifest["key"], gz_path), path, manifest["sha256"])
+
+    def adopt_snapshot(self, manifest, origin, shipped_seq):
+        # Right after the db was replaced with a snapshot: it carries the
+        # journal state of whoever took it, make it ours again
+        cursor = self.db.sqlite_cursor
+        cursor.execute('''DELETE FROM change_journal''')
+        cursor.execute('''DELETE FROM journal_origins''')
+        cursor.executemany('''INSERT INTO journal_origins (origin, applied_seq) VALUES (?, ?)''',
+                           [ item for item in manifest["applied"].items() if item[0] != origin ])
+        # Anything of ours the snapshot doesn't have is replayed from our
+        # own journal objects, and our sequence carries on where it was
+        cursor.execute('''INSERT INTO journal_origins (origin, applied_seq) VALUES (?, ?)''',
+                       (origin, manifest["applied"].get(origin, 0)))
+        next_seq = max(shipped_seq, manifest["applied"].get(origin, 0))
+        cursor.execute('''DELETE FROM sqlite_sequence WHERE name = 'change_journal' ''')
+        cursor.execute('''INSERT INTO sqlite_sequence (name, seq) VALUES ('change_journal', ?)''', (next_seq,))
+        cursor.execute('''UPDATE journal_state SET origin = ?, shipped_seq = ?, recording = 1 WHERE id = 0''',
+                       (origin, next_seq))
+        self.db.sqlite_conn.commit()
@@ -1,137 +1,217 @@
 from __future__ import (absolute_import, division, print_function, unicode_literals)
-from builtins import print
-import datetime
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 import logging
 import os
+import re
+import signal
+import stat
 import sys
-import types
-from .tags import Tags
+import threading
+from .cursor import LibraryCursor
+from .file_cache import MediaFileCache
+from . import profiling
+from .scan_state import ScanState
+from .store import LibraryStore
+from .tagquery import TagQuery
+from .tags import TagIndex
+
+
+@contextmanager
+def cancel_on_interrupt():
+    # Yields an Event that Ctrl-C sets instead of raising KeyboardInterrupt,
+    # for long runs that can stop somewhere they keep what they finished.
+    # A second Ctrl-C interrupts as usual.  Only the main thread can take
+    # signals, anywhere else the Event is never set.
+    cancel = threading.Event()
+    if threading.current_thread() is not threading.main_thread():
+        yield cancel
+        return
+    def interrupted(signum, frame):
+        if cancel.is_set():
+            raise KeyboardInterrupt
+        cancel.set()
+    previous = signal.signal(signal.SIGINT, interrupted)
+    try:
+        yield cancel
+    finally:
+        signal.signal(signal.SIGINT, previous)
+
 
 class Library(object):
     def __init__(self, db):
-        self.library = defaultdict()
-        self.library_list = []
+        self.library = LibraryStore()
         self.library_scanned = {}
         self.library_non_media = {}
+        self._scan_lock = threading.Lock()
         self.logger = logging.getLogger()
         self.db = db
+        self.scan_state = ScanState(db)
+        self.tag_index = TagIndex(db)
+        self.file_cache = MediaFileCache(db)
+        self.known_paths = set()
+        self.cursor = None
         self.mode = "random"
         self.sql = '''SELECT media_id, mount_alias, path, mtime, times_played, media_size FROM media'''
 
 
-    def populate_from_db(self, config, sql=None, sql_params=None):
+    def populate_from_db(self, config, sql=None, sql_params=None, exclude_tags=None):
+        if sql is None:
+            conditions = list()
+            params = list()
+            if exclude_tags:
+                (exclusion_sql, exclusion_params) = self.exclusion_clause(exclude_tags)
+                conditions.append(exclusion_sql)
+                params.extend(exclusion_params)
+            self.open_cursor(config, conditions, params)
+            return
+        # An explicit query is still loaded in one go
+        self.close_cursor()
         self.library.clear()
-        del self.library_list[:]
-        if sql is not None:
-            if sql_params is None:
-                iterator = self.db.db_query_iterator(sql)
-            else:
-                iterator = self.db.db_query_qmark_iterator(query=sql, parameters=sql_params)
-        else:
-            iterator = self.db.db_query_iterator(self.sql)
-        
+        self.library.set_sources(config.media_sources)
+        iterator = self.db.db_read_iterator(sql, sql_params if sql_params is not None else ())
         for entry in iterator:
             (media_id, mount_alias, path, mtime, times_played, media_size) = entry
-            full_path = os.path.join(config.media_sources[mount_alias], path)
-            self.logger.debug("Adding entry for {0}.".format(full_path))
-            self.library_list.append(full_path)
-            self.library[full_path] = { "media_id": media_id,
-                                        "mount_alias": mount_alias,
-                                        "path": path,
-                                        "mtime": mtime,
-                                        "times_played": times_played,
-                                        "media_size": media_size
-                                      }
+            if mount_alias not in config.media_sources:
+                continue
+            self.library.add(media_id, mount_alias, path, mtime, times_played, media_size)
         self.db.sqlite_conn.commit()
-        self.logger.debug("populate_from_db Library: %s" % self.library)
+        self.logger.debug("populate_from_db loaded %s entries" % len(self.library))
+        self.cursor = LibraryCursor(self, config, paths=list(self.library))
+
+
+    def open_cursor(self, config, conditions=None, params=(), sort_by=None, desc=False):
+        # Start a new lazily paged selection, nothing is read until the
+        # first item is asked for.
+        self.close_cursor()
+        self.library.clear()
+        self.library.set_sources(config.media_sources)
+        where = " AND ".join(conditions) if conditions else None
+        self.logger.debug("Library cursor: where %s %s, sort by %s" % (where, params, sort_by))
+        self.cursor = LibraryCursor(self, config, where, params, sort_by, desc)
+
+
+    def close_cursor(self):
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+
+
+    @property
+    def library_list(self):
+        # Full paths in the order they were loaded, e.g. sort order
+        return list(self.library)
+
+
+    def current_selection(self):
+        # What the cursor is going through as (media_ids, where, params),
+        # for BulkTags.  Loads of an explicit query (ranked searches) have
+        # their media_ids, paged ones a condition on media.
+        if self.cursor is None:
+            return (None, None, ())
+        if self.cursor.selection is not None:
+            return ([ self.library[full_path]["media_id"] for full_path in self.cursor.selection if full_path in self.library ], None, ())
+        return (None, self.cursor.where, self.cursor.params)
+
+
+    def exclusion_clause(self, exclude_tags):
+        # Anti-join against the excluded tags, returns (sql, params)
+        placeholders = ",".join("?" for _ in exclude_tags)
+        sql = '''NOT EXISTS (SELECT 1
+                   FROM media_tags mt, tags t
+                   WHERE mt.media_id = media.media_id
+                   AND mt.tag_id = t.tag_id
+                   AND t.tag_name IN (''' + placeholders + '))'
+        return (sql, list(exclude_tags))
 
 
     def populate_from_db_sort(self, config, sort_by=None, desc=None, exclude_tags=None):
-        sql = self.sql
-        sql_params = []
+        conditions = list()
+        params = list()
         if exclude_tags:
-            placeholders = ",".join("?" for _ in exclude_tags)
-            sql += ''' WHERE media_id NOT IN (SELECT mt.media_id
-                       FROM media_tags mt, tags t
-                       WHERE mt.tag_id = t.tag_id
-                       AND t.tag_name IN (''' + placeholders + '))'
-            sql_params.extend(exclude_tags)
-        sql += ' ORDER BY '
-        sql += sort_by
-        if desc:
-            sql += ' DESC'
-        else:
-            sql += ' ASC'
-        self.logger.warning(sql)
-        self.populate_from_db(config=config, sql=sql, sql_params=tuple(sql_params) if sql_params else None)
+            (exclusion_sql, exclusion_params) = self.exclusion_clause(exclude_tags)
+            conditions.append(exclusion_sql)
+            params.extend(exclusion_params)
+        self.open_cursor(config, conditions, params, sort_by=sort_by, desc=bool(desc))
 
 
-    def populate_from_db_search(self, config, tags=list(), tag_andor="and", search_strings=list(), search_strings_andor="or"):
-        sql = self.sql
+    def populate_from_db_search(self, config, tags=list(), tag_andor="and", search_strings=list(), search_strings_andor="or",
+                                exclude_tags=None, ranked=False, tag_query=None, sort_by=None, desc=False):
+        sql = ""
         sql_params = list()
-        if len(tags) > 0 or len(search_strings) > 0:
-            sql += " WHERE "
-            if tag_andor == "or" and len(tags) > 0:
-                # Search for media with any of the listed tags
-                sql += ''' media_id IN (SELECT mt.media_id
-                           FROM tags t, media_tags mt
-                           WHERE t.tag_id = mt.tag_id
-                           AND t.tag_name IN ('''
-                for idx, tag in enumerate(tags):
-                    if idx > 0:
-                        sql += ","
-                    sql += "?"
-                    sql_params.append(tag)
-                sql += "))"
-            elif tag_andor == "and" and len(tags) > 0:
-                # Search for media with all of the listed tags
-                tag_ids = list()
-                tag_sql = "SELECT tag_id FROM tags WHERE tag_name IN ("
-                for idx, tag in enumerate(tags):
-                    # First get a list of tag ids
-                    if idx > 0:
-                        tag_sql += ","
-                    tag_sql += "?"
-                tag_sql += " )"
-                self.logger.debug(tag_sql)
-                self.logger.debug(tags)
-                iterator = self.db.db_query_qmark_iterator(query=tag_sql, parameters=tags)
-
-                # Now get media ids that match all tagids
-                sql += ''' media_id IN (SELECT media_id
-                           FROM media_tags
-                           WHERE
-                           tag_id in ('''
-                iterator_idx = 0
-                for tag_id in iterator:
-                    if iterator_idx > 0:
-                        sql += ","
-                    sql += "?"
-                    sql_params.append(tag_id[0])
-                    iterator_idx += 1
-                sql += ''')
-                          GROUP BY media_id
-                          HAVING COUNT(media_id) = ?
-                          )'''
-                sql_params.append(iterator_idx)
-
-            if len(search_strings) > 0:
+        if tag_query is None and len(tags) > 0:
+            tag_query = TagQuery.from_tags(tags, tag_andor)
+        if tag_query is not None:
+            unknown = tag_query.unknown_terms(self.db)
+            if unknown:
+                self.logger.warning("No tags match: %s" % ", ".join(unknown))
+        fts_query = None
+        if ranked:
+            fts_query = self.fts_query(search_strings, search_strings_andor) if self.db.fts5_enabled else None
+            if fts_query is None:
+                self.logger.warning("Ranked search needs FTS5 and something to match, searching unranked")
+                ranked = False
+        # Ranked searches match the strings in the join instead
+        where_strings = list() if ranked else search_strings
+        if tag_query is not None or len(where_strings) > 0:
+            sql += "("
+            if tag_query is not None:
+                (tags_sql, tags_params) = tag_query.to_sql()
+                sql += tags_sql
+                sql_params.extend(tags_params)
+
+            if len(where_strings) > 0:
                 # Build portion of query for search strings in path
-                if len(sql_params) > 0:
-                    param_end = ")"
-                    sql += " AND ("
-                else:
-                    param_end = ""
-                for idx, search_string in enumerate(search_strings):
-                    if idx > 0:
-                        sql += " " + search_strings_andor + " "
-                    sql += " path LIKE ?"
-                    sql_params.append('%' + search_string + '%')
-                sql += param_end
-        self.logger.debug(sql)
+                if tag_query is not None:
+                    sql += " AND "
+                (strings_sql, strings_params) = self.search_strings_clause(where_strings, search_strings_andor)
+                sql += strings_sql
+                sql_params.extend(strings_params)
+            sql += ")"
+        conditions = [ sql ] if sql else []
+        if exclude_tags:
+            (exclusion_sql, exclusion_params) = self.exclusion_clause(exclude_tags)
+            conditions.append(exclusion_sql)
+            sql_params.extend(exclusion_params)
+        self.logger.debug(conditions)
         self.logger.debug(sql_params)
-        self.populate_from_db(config, sql, tuple(sql_params))
+        if ranked:
+            # Best matches first, loaded in one go since bm25 can't be paged
+            # on like the other sort orders
+            sql = '''SELECT media.media_id, media.mount_alias, media.path, media.mtime, media.times_played, media.media_size
+                     FROM media
+                     JOIN (SELECT rowid AS fts_rowid, rank FROM media_fts WHERE media_fts MATCH ?) AS fts
+                     ON fts.fts_rowid = media.media_id'''
+            if conditions:
+                sql += " WHERE " + " AND ".join(conditions)
+            sql += " ORDER BY fts.rank"
+            self.populate_from_db(config, sql=sql, sql_params=[ fts_query ] + sql_params)
+            return
+        self.open_cursor(config, conditions, sql_params, sort_by=sort_by, desc=desc)
+
+
+    def fts_query(self, search_strings, search_strings_andor="or"):
+        # Each search string becomes a phrase split on the same separators
+        # as the media_fts tokenizer, with the last word matched as a prefix,
+        # e.g. "star.wa" -> "star wa" *  Returns None if nothing is left.
+        phrases = list()
+        for search_string in search_strings:
+            words = re.findall(r"[^\W_]+", search_string)
+            if words:
+                phrases.append('"' + " ".join(words) + '" *')
+        if not phrases:
+            return None
+        return (" " + search_strings_andor.upper() + " ").join(phrases)
+
+
+    def search_strings_clause(self, search_strings, search_strings_andor="or"):
+        # Path search condition, returns (sql, params)
+        fts_query = self.fts_query(search_strings, search_strings_andor) if self.db.fts5_enabled else None
+        if fts_query is not None:
+            return ("media_id IN (SELECT rowid FROM media_fts WHERE media_fts MATCH ?)", [ fts_query ])
+        # No FTS5, scan the paths
+        sql = "(" + (" " + search_strings_andor + " ").join("path LIKE ?" for _ in search_strings) + ")"
+        return (sql, [ '%' + search_string + '%' for search_string in search_strings ])
 
 
     def decode_name(self, name):
@@ -144,123 +224,169 @@ class Library(object):
         return name
 
 
+    @profiling.timed("scan")
+    def scan_sources(self, config, media_sources=None):
+        # Scan every media source at once.  Each mount gets its own small
+        # worker pool (scan_mount_concurrency / scan_mount_limits) and all
+        # of them share scan_workers slots, so a slow NAS mount can only
+        # tie up its own workers instead of starving the other mounts.
+        if media_sources is None:
+            media_sources = config.media_sources
+        self.known_paths = self.known_full_paths(config)
+        self.scan_state.load()
+        if config.scan_workers <= 1 or len(media_sources) <= 1:
+            for path_alias, path in media_sources.items():
+                self._scan_source(config, path_alias, path)
+        else:
+            scan_slots = threading.BoundedSemaphore(config.scan_workers)
+            with ThreadPoolExecutor(max_workers=len(media_sources)) as source_pool:
+                futures = [ source_pool.submit(self._scan_source, config, path_alias, path, scan_slots)
+                            for path_alias, path in media_sources.items() ]
+                for future in as_completed(futures):
+                    future.result()
+        self.scan_state.save()
+        self.known_paths = set()
+
+
     def scan_source(self, config, path_alias='here', path='.'):
-        self.populate_from_db(config=config)
-        #with os.scandir(path) as dir_entries:
+        self.known_paths = self.known_full_paths(config)
+        self.scan_state.load()
+        self._scan_source(config, path_alias, path)
+        self.scan_state.save()
+        self.known_paths = set()
+
+
+    def known_full_paths(self, config):
+        # Every entry in the db, including ones the current mode filters out
+        # of self.library, so scans don't pick excluded entries up again.
+        known_paths = set()
+        for (mount_alias, path) in self.db.db_query_iterator('''SELECT mount_alias, path FROM media'''):
+            if mount_alias in config.media_sources:
+                known_paths.add(os.path.join(config.media_sources[mount_alias], path))
+        return known_paths
+
+
+    def _scan_source(self, config, path_alias, path, scan_slots=None):
+        if scan_slots is None:
+            scan_slots = threading.BoundedSemaphore(max(config.scan_workers, 1))
+        mount_workers = max(int(config.scan_mount_limits.get(path_alias, config.scan_mount_concurrency)), 1)
         try:
-            if sys.version_info[0] < 3:
-                for entry in os.listdir(path):
-                    entry = self.decode_name(entry)
-                    basename = os.path.basename(entry)
-                    full_entry = self.decode_name(os.path.join(path, entry))
-                    self.logger.warning(full_entry)
-                    if basename.startswith('.'):
-                        # skip
-                        continue
-                    elif full_entry in self.library:
-                        # skip, it's already in the library
-                        continue
-                    elif os.path.isfile(full_entry):
-                        if basename.split('.')[-1].lower() in config.media_extensions:
-                            self.library_scanned[basename] = { "mount_alias": path_alias,
-                                                               "path": basename,
-                                                               "mtime": datetime.datetime.fromtimestamp(os.path.getmtime(full_entry)),
-                                                               "times_played": 0
-                                                             }
-                    elif os.path.isdir(full_entry):
-                        # Find files in dir and ensure at last one match the media_extensions
-                        self.logger.warning("Scanning possible media dir %s" % full_entry)
-                        media_files = self.scan_for_media_files(config, full_entry)
-                        try:
-                            # If the generator is empty, StopIteration should be captured
-                            # We also check to see if the returned type from next is a generator,
-                            # This occurs as we use yield to recurse so if there are sub directories
-                            # It'll recurse and return another generator instead of a file or empty generator.
-                            # I'm sure there's a better way to recurse without a generator in a generator.
-                            media_file = next(media_files)
-                            while isinstance(media_file, types.GeneratorType):
-                                media_file = next(media_files)
-                            self.logger.warning("Found media file %s" % media_file)
-                            self.library_scanned[basename] = { "mount_alias": path_alias,
-                                                               "path": basename,
-                                                               "mtime": datetime.datetime.fromtimestamp(os.path.getmtime(full_entry)),
-                                                               "times_played": 0
-                                                             }
-                            del media_files
-                        except StopIteration:
-                            self.logger.warning("No media found in dir %s" % full_entry)
-                            self.library_non_media[basename] = { "mount_alias": path_alias,
-                                                                 "path": basename,
-                                                                 "mtime": datetime.datetime.fromtimestamp(os.path.getmtime(full_entry)),
-                                                                 "times_played": 0
-                                                               }
-                            del media_files
-                            pass
-                    else:
-                        self.logger.warning("Nothing matches: %s" % full_entry)
+            with scan_slots:
+                root_mtime = os.stat(path).st_mtime_ns
+                if self.scan_state.unchanged(path_alias, '', root_mtime):
+                    # Nothing was added or removed at the top of the mount, so only
+                    # the directories that didn't hold media last time need a look.
+                    self.logger.debug("%s unchanged since last scan" % path)
+                    candidates = [ (name, None) for name in self.scan_state.child_dirs(path_alias, '')
+                                   if os.path.join(path, name) not in self.known_paths ]
+                else:
+                    dir_entries = [ entry for entry in os.scandir(path) if not entry.name.startswith('.') ]
+                    self.scan_state.record(path_alias, '', root_mtime, len(dir_entries), False,
+                                           [ entry.name for entry in dir_entries if entry.is_dir() ])
+                    candidates = [ (entry.name, entry) for entry in dir_entries if entry.path not in self.known_paths ]
+            if mount_workers == 1:
+                for name, entry in candidates:
+                    self._scan_entry(config, path_alias, path, name, entry, scan_slots)
             else:
-                dir_entries = os.scandir(path)
-                for entry in dir_entries:
-                    if entry.name.startswith('.'):
-                        # skip
-                        continue
-                    elif entry.path in self.library:
-                        # skip, it's already in the library
-                        continue
-                    elif entry.is_file():
-                        if entry.name.split('.')[-1].lower() in config.media_extensions:
-                            self.library_scanned[entry.path] = { "mount_alias": path_alias,
-                                                                 "path": entry.name,
-                                                                 "mtime": datetime.datetime.fromtimestamp(entry.stat().st_mtime),
-                                                                 "times_played": 0
-                                                               }
-                    elif entry.is_dir():
-                        # Find files in dir and ensure at last one match the media_extensions
-                        self.logger.warning("Scanning possible media dir %s" % entry.path)
-                        media_files = self.scan_for_media_files(config, entry.path)
-                        try:
-                            media_file = next(media_files)
-                            while isinstance(media_file, types.GeneratorType):
-                                media_file = next(media_files)
-                            self.logger.warning("Found media file %s" % media_file)
-                            self.library_scanned[entry.path] = { "mount_alias": path_alias,
-                                                                 "path": entry.name,
-                                                                 "mtime": datetime.datetime.fromtimestamp(entry.stat().st_mtime),
-                                                                 "times_played": 0
-                                                               }
-                            del media_files
-                        except StopIteration:
-                            self.logger.warning("No media found in dir %s" % entry.path)
-                            self.library_non_media[entry.path] = { "mount_alias": path_alias,
-                                                                 "path": entry.name,
-                                                                 "mtime": datetime.datetime.fromtimestamp(entry.stat().st_mtime),
-                                                                 "times_played": 0
-                                                               }
-                            del media_files
-                            pass
+                with ThreadPoolExecutor(max_workers=mount_workers) as mount_pool:
+                    futures = [ mount_pool.submit(self._scan_entry, config, path_alias, path, name, entry, scan_slots)
+                                for name, entry in candidates ]
+                    for future in as_completed(futures):
+                        future.result()
         except (KeyboardInterrupt, SystemExit):
             raise
         except (AttributeError, Exception) as err:
             print("Passing exception: {0}".format(err))
             pass
-        self.logger.debug("scan_source Scanned Library updates: %s" % self.library_scanned)
+        self.logger.debug("scan_source %s: %s scanned, %s non media" % (path_alias,
+                                                                        len(self.library_scanned),
+                                                                        len(self.library_non_media)))
 
 
-    def scan_for_media_files(self, config, path):
+    def _scan_entry(self, config, path_alias, path, name, entry, scan_slots):
+        # Classify a single top level entry.  Runs on a scan worker thread,
+        # so this must only touch the filesystem; results are merged into
+        # library_scanned/library_non_media under _scan_lock.
+        full_entry = os.path.join(path, name)
+        with scan_slots:
+            if entry is None:
+                entry_stat = os.stat(full_entry)
+                is_file = stat.S_ISREG(entry_stat.st_mode)
+                is_dir = stat.S_ISDIR(entry_stat.st_mode)
+            else:
+                entry_stat = None
+                is_file = entry.is_file()
+                is_dir = entry.is_dir()
+            if is_file:
+                if name.split('.')[-1].lower() not in config.media_extensions:
+                    return
+                target = self.library_scanned
+            elif is_dir:
+                # Find files in dir and ensure at last one match the media_extensions
+                self.logger.warning("Scanning possible media dir %s" % full_entry)
+                if entry_stat is None:
+                    entry_stat = entry.stat()
+                media_file = self.first_media_file(config, full_entry, path_alias, name, entry_stat.st_mtime_ns)
+                if media_file is not None:
+                    self.logger.warning("Found media file %s" % media_file)
+                    target = self.library_scanned
+                else:
+                    self.logger.warning("No media found in dir %s" % full_entry)
+                    target = self.library_non_media
+            else:
+                self.logger.warning("Nothing matches: %s" % full_entry)
+                return
+            if entry_stat is None:
+                entry_stat = entry.stat()
+            mtime = int(entry_stat.st_mtime)
+        with self._scan_lock:
+            target[full_entry] = { "mount_alias": path_alias,
+                                   "path": name,
+                                   "mtime": mtime,
+                                   "times_played": 0
+                                 }
+
+
+    def first_media_file(self, config, path, path_alias=None, rel_path=None, dir_mtime=None):
+        media_files = self.scan_for_media_files(config, path, path_alias, rel_path, dir_mtime)
+        try:
+            return next(media_files)
+        except StopIteration:
+            return None
+        finally:
+            media_files.close()
+
+
+    def scan_for_media_files(self, config, path, path_alias=None, rel_path=None, dir_mtime=None):
         # Just scan for files in a dir that match the configured media extensions
         # I'm hoping this will be lighter weight than an os.walk()
+        # With a path_alias, a directory whose mtime matches scan_state is not
+        # listed again: if it held media files last time the directory itself
+        # is yielded, otherwise only its recorded sub directories are checked.
         try:
-            for entry in os.listdir(path):
-                if sys.version_info[0] < 3:
-                    full_path = self.decode_name(os.path.join(path, entry))
-                else:
-                    full_path = os.path.join(path, entry)
-                if os.path.isdir(full_path):
-                    yield self.scan_for_media_files(config, full_path)
-                elif os.path.isfile(full_path):
-                    if entry.split('.')[-1].lower() in config.media_extensions:
-                        self.logger.debug("Extension Match!: %s" % full_path)
-                        yield full_path
+            if path_alias is not None:
+                if dir_mtime is None:
+                    dir_mtime = os.stat(path).st_mtime_ns
+                if self.scan_state.unchanged(path_alias, rel_path, dir_mtime):
+                    if self.scan_state.has_media(path_alias, rel_path):
+                        yield path
+                    for child in self.scan_state.child_dirs(path_alias, rel_path):
+                        yield from self.scan_for_media_files(config, os.path.join(path, os.path.basename(child)),
+                                                             path_alias, child)
+                    return
+            self.logger.debug("Listing %s" % path)
+            dir_entries = list(os.scandir(path))
+            media_files = [ entry.path for entry in dir_entries
+                            if entry.is_file() and entry.name.split('.')[-1].lower() in config.media_extensions ]
+            child_dirs = [ entry.name for entry in dir_entries if entry.is_dir() ]
+            if path_alias is not None:
+                self.scan_state.record(path_alias, rel_path, dir_mtime, len(dir_entries), bool(media_files), child_dirs)
+            for media_file in media_files:
+                self.logger.debug("Extension Match!: %s" % media_file)
+                yield media_file
+            for child in child_dirs:
+                yield from self.scan_for_media_files(config, os.path.join(path, child), path_alias,
+                                                     ScanState.relative_path(rel_path, child) if path_alias is not None else None)
         except (KeyboardInterrupt, SystemExit):
             raise
         except GeneratorExit:
@@ -270,68 +396,168 @@ class Library(object):
             pass
 
 
+    @profiling.timed("ingest")
     def scanned_to_library_and_db(self, config):
-        from .media import Media
-        self.library.update(self.library_scanned)
-        for full_path, value_dict in self.library_scanned.items():
-            # TODO: Check db to ensure we don't attempt to add an entry that already exists
-            # This can happen if the current running instance of the script has an older version
-            # of the library in memory.
-            media_size = Media.calculate_media_size(config, full_path)
-            self.logger.warning("Adding entry to db: %s %s" % (full_path, value_dict))
-            self.db.sqlite_cursor.execute('''INSERT OR IGNORE INTO media (mount_alias, path, mtime, times_played, media_size) VALUES(?,?,?,?,?)''', (value_dict["mount_alias"],
-                                                                                                                                                     value_dict["path"],
-                                                                                                                                                     value_dict["mtime"],
-                                                                                                                                                     value_dict["times_played"],
-                                                                                                                                                     media_size))
-
+        # Bulk ingest everything the scan found in a single transaction:
+        # one executemany for the media rows, one set based insert to tag
+        # the non media entries and one commit.  media_size is left NULL,
+        # update_missing_sizes fills it in on its worker pool.
+        # Returns a dict of inserted/ignored/tagged row counts.
+        counts = { "inserted": 0, "ignored": 0, "tagged": 0 }
+        scanned = [ (value_dict["mount_alias"], value_dict["path"], value_dict["mtime"], value_dict["times_played"], 0)
+                    for value_dict in self.library_scanned.values() ]
         # Load non media items so future scans don't rescan them.
         # Instead lets just tag them as non media types so we can
         # add to default exclusion tag in the config or just skip
         # by default in code.
-        self.library.update(self.library_non_media)
-        for full_path, value_dict in self.library_non_media.items():
-            self.logger.warning("Adding non media entry to db: %s %s" % (full_path, value_dict))
-            self.db.sqlite_cursor.execute('''INSERT OR IGNORE INTO media (mount_alias, path, mtime, times_played) VALUES(?,?,?,?)''', (value_dict["mount_alias"],
-                                                                                                                                       value_dict["path"],
-                                                                                                                                       value_dict["mtime"],
-                                                                                                                                       value_dict["times_played"]))
-            insert_media_id = self.db.last_row_id()
-            media_tags = Tags(config, self.db, insert_media_id)
-            media_tags.add_tag(config.non_media_tag)
+        scanned.extend((value_dict["mount_alias"], value_dict["path"], value_dict["mtime"], value_dict["times_played"], 1)
+                       for value_dict in self.library_non_media.values())
+        if not scanned:
+            return counts
+        cursor = self.db.sqlite_cursor
+        # rowcount rather than total_changes, which counts trigger writes too
+        cursor.executemany('''INSERT OR IGNORE INTO media (mount_alias, path, mtime, times_played) VALUES(?,?,?,?)''',
+                           [ row[:4] for row in scanned ])
+        counts["inserted"] = cursor.rowcount
+        counts["ignored"] = len(scanned) - counts["inserted"]
+        cursor.execute('''CREATE TEMP TABLE IF NOT EXISTS scanned_paths (
+                          mount_alias VARCHAR(64),
+                          path VARCHAR(255),
+                          non_media INTEGER
+                          )''')
+        cursor.execute('''DELETE FROM scanned_paths''')
+        cursor.executemany('''INSERT INTO scanned_paths (mount_alias, path, non_media) VALUES (?,?,?)''',
+                           [ (row[0], row[1], row[4]) for row in scanned ])
+        if self.library_non_media:
+            cursor.execute('''INSERT OR IGNORE INTO tags (tag_name) VALUES (?)''', (config.non_media_tag,))
+            cursor.execute('''INSERT OR IGNORE INTO media_tags (tag_id, media_id)
+                              SELECT t.tag_id, m.media_id
+                              FROM scanned_paths s, media m, tags t
+                              WHERE s.non_media = 1
+                              AND m.mount_alias = s.mount_alias
+                              AND m.path = s.path
+                              AND t.tag_name = ?''', (config.non_media_tag,))
+            counts["tagged"] = cursor.rowcount
+            if self.tag_index.loaded:
+                for (media_id,) in cursor.execute('''SELECT m.media_id
+                                                     FROM scanned_paths s, media m
+                                                     WHERE s.non_media = 1
+                                                     AND m.mount_alias = s.mount_alias
+                                                     AND m.path = s.path''').fetchall():
+                    self.tag_index.add(media_id, config.non_media_tag)
+        skip_non_media = config.non_media_tag in config.default_exclusion_tags
+        iterator = cursor.execute('''SELECT m.media_id, m.mount_alias, m.path, m.mtime, m.times_played, m.media_size
+                                     FROM scanned_paths s, media m
+                                     WHERE m.mount_alias = s.mount_alias
+                                     AND m.path = s.path
+                                     AND (s.non_media = 0 OR ? = 0)''', (int(skip_non_media),))
+        for (media_id, mount_alias, path, mtime, times_played, media_size) in iterator.fetchall():
+            full_path = os.path.join(config.media_sources[mount_alias], path)
+            self.library[full_path] = { "media_id": media_id,
+                                        "mount_alias": mount_alias,
+                                        "path": path,
+                                        "mtime": mtime,
+                                        "times_played": times_played,
+                                        "media_size": media_size
+                                      }
+        cursor.execute('''DELETE FROM scanned_paths''')
         self.db.sqlite_conn.commit()
+        self.logger.warning("Added scanned entries to db: %s inserted, %s already present, %s tagged %s" %
+                            (counts["inserted"], counts["ignored"], counts["tagged"], config.non_media_tag))
+        self.library_scanned.clear()
+        self.library_non_media.clear()
+        return counts
 
 
-    def update_missing_sizes(self, config):
-        from .media import Media
-        iterator = self.db.db_query_iterator(
-            '''SELECT media_id, mount_alias, path FROM media WHERE media_size IS NULL''')
-        entries = list(iterator)
+    @profiling.timed("media_sizes")
+    def update_missing_sizes(self, config, progress=None, cancel=None, media_ids=None):
+        # Sizes are calculated on a pool of size_workers threads and written
+        # back size_batch_size rows per transaction, so an interrupted run
+        # keeps what it finished and the next run resumes with whatever is
+        # still NULL.  progress is called with (done, total) and setting the
+        # cancel Event stops the run after the current batch is written.
+        # media_ids limits it to those rows, e.g. just what the watcher
+        # added, instead of every NULL in the table.
+        sql = '''SELECT media_id, mount_alias, path FROM media WHERE media_size IS NULL'''
+        if media_ids is None:
+            entries = list(self.db.db_query_iterator(sql))
+        else:
+            media_ids = list(media_ids)
+            entries = list()
+            for start in range(0, len(media_ids), 500):
+                chunk = media_ids[start:start + 500]
+                entries.extend(self.db.db_query_qmark_iterator(sql + " AND media_id IN (" + ",".join("?" for _ in chunk) + ")",
+                                                               tuple(chunk)))
         self.logger.warning("Found %s entries missing media_size" % len(entries))
+        if not entries:
+            return
         updates = []
+        listings = []
+        updated = 0
         skipped = 0
-        for idx, entry in enumerate(entries):
-            (media_id, mount_alias, path) = entry
+        done = 0
+        size_pool = ThreadPoolExecutor(max_workers=max(config.size_workers, 1))
+        futures = {}
+        for (media_id, mount_alias, path) in entries:
             if mount_alias not in config.media_sources:
                 self.logger.debug("Skipping media_id %s: mount_alias '%s' not in config" % (media_id, mount_alias))
                 skipped += 1
                 continue
             full_path = os.path.join(config.media_sources[mount_alias], path)
-            if not os.path.exists(full_path):
-                self.logger.debug("Skipping media_id %s: path does not exist: %s" % (media_id, full_path))
-                skipped += 1
-                continue
-            media_size = Media.calculate_media_size(config, full_path)
-            updates.append((media_size, media_id))
-            if (idx + 1) % 100 == 0:
-                self.logger.warning("Calculated size for %s/%s entries..." % (idx + 1, len(entries)))
-        self.logger.warning("Updating media_size for %s entries (%s skipped)" % (len(updates), skipped))
-        for media_size, media_id in updates:
-            self.db.sqlite_cursor.execute(
-                '''UPDATE media SET media_size = ? WHERE media_id = ?''',
-                (media_size, media_id))
-        if updates:
-            self.db.sqlite_conn.commit()
+            futures[size_pool.submit(self._missing_media_size, config, full_path)] = media_id
+        total = len(futures)
+        try:
+            for future in as_completed(futures):
+                probe = future.result()
+                done += 1
+                if not probe["exists"]:
+                    skipped += 1
+                else:
+                    updates.append((probe["media_size"], futures[future]))
+                    if probe["listing"] is not None:
+                        listings.append((futures[future], probe["listing"]))
+                if len(updates) >= config.size_batch_size:
+                    updated += self._write_media_sizes(updates, listings)
+                if progress is not None:
+                    progress(done, total)
+                if cancel is not None and cancel.is_set():
+                    self.logger.warning("Size calculation cancelled after %s/%s entries" % (done, total))
+                    break
+        finally:
+            size_pool.shutdown(wait=False, cancel_futures=True)
+            updated += self._write_media_sizes(updates, listings)
+            self.logger.warning("Updated media_size for %s entries (%s skipped, %s left for the next run)" % (updated, skipped, total - done))
+
+
+    def print_size_progress(self, done, total):
+        # update_missing_sizes progress for the terminal
+        if done % 100 == 0:
+            self.logger.warning("Calculated size for %s/%s entries, Ctrl-C stops and the rest is done next run..." % (done, total))
+
+
+    def _missing_media_size(self, config, full_path):
+        # Runs on a size worker thread, filesystem only.  The same walk
+        # fills the media_files cache, so the first play doesn't walk again.
+        from .media import Media
+        probe = Media.probe(config, full_path)
+        if not probe["exists"]:
+            self.logger.debug("Skipping, path does not exist: %s" % full_path)
+        return probe
+
+
+    def _write_media_sizes(self, updates, listings=None):
+        if not updates:
+            return 0
+        count = len(updates)
+        self.db.sqlite_cursor.executemany(
+            '''UPDATE media SET media_size = ? WHERE media_id = ?''', updates)
+        for (media_id, listing) in listings or ():
+            self.file_cache.store(media_id, listing, commit=False)
+        self.db.sqlite_conn.commit()
+        del updates[:]
+        if listings:
+            del listings[:]
+        return count
 
 
     def delete_from_library_and_db(self, media_entry):
@@ -340,4 +566,92 @@ class Library(object):
                                           (self.library[media_entry]["mount_alias"],
                                           self.library[media_entry]["path"]))
             self.db.sqlite_conn.commit()
+            self.tag_index.remove_media(self.library[media_entry]["media_id"])
             del(self.library[media_entry])
+
+
+    def forget_media(self, config, mount_alias, path):
+        # Drop an entry that went away outside of allplay.  Unlike
+        # Media.delete() this never touches the filesystem.
+        full_path = os.path.join(config.media_sources[mount_alias], path)
+        self.logger.warning("Removing %s from the library, it no longer exists" % full_path)
+        for (media_id,) in self.db.db_query_qmark_iterator('''SELECT media_id FROM media WHERE mount_alias = ? AND path = ?''',
+                                                           (mount_alias, path)).fetchall():
+            self.tag_index.remove_media(media_id)
+        self.db.sqlite_cursor.execute('''DELETE FROM media_tags
+                                         WHERE media_id IN (
+                                             SELECT media_id
+                                             FROM media
+                                             WHERE mount_alias = ?
+                                             AND path = ?)''', (mount_alias, path))
+        self.db.sqlite_cursor.execute('''DELETE FROM media WHERE mount_alias = ? AND path = ?''', (mount_alias, path))
+        self.db.sqlite_cursor.execute('''DELETE FROM tags WHERE tag_id NOT IN (SELECT tag_id FROM media_tags)''')
+        self.db.sqlite_conn.commit()
+        self.library.pop(full_path, None)
+
+
+    def rename_media(self, config, mount_alias, path, new_mount_alias, new_path):
+        # Follow a rename/move so play counts and tags stay with the media.
+        # Returns False if the old entry wasn't known or the new name is taken.
+        self.db.sqlite_cursor.execute('''UPDATE OR IGNORE media
+                                         SET mount_alias = ?, path = ?
+                                         WHERE mount_alias = ?
+                                         AND path = ?''', (new_mount_alias, new_path, mount_alias, path))
+        renamed = self.db.sqlite_cursor.rowcount == 1
+        self.db.sqlite_conn.commit()
+        if not renamed:
+            self.forget_media(config, mount_alias, path)
+            return False
+        full_path = os.path.join(config.media_sources[mount_alias], path)
+        new_full_path = os.path.join(config.media_sources[new_mount_alias], new_path)
+        self.logger.warning("Renamed %s to %s" % (full_path, new_full_path))
+        if full_path in self.library:
+            entry = self.library.pop(full_path)
+            entry["mount_alias"] = new_mount_alias
+            entry["path"] = new_path
+            self.library[new_full_path] = entry
+        return True
+
+
+    def apply_watch_events(self, config, events):
+        # Apply Watcher events on the main thread, the sqlite connection
+        # can't be shared with the watcher threads.  Returns the full paths
+        # of media that were added to the library.
+        created = list()
+        for event in events:
+            self.logger.debug("Applying %r" % event)
+            if event.action == "delete":
+                self.forget_media(config, event.mount_alias, event.path)
+            elif event.action == "rename":
+                if not self.rename_media(config, event.mount_alias, event.path, event.new_mount_alias, event.new_path):
+                    created.append((event.new_mount_alias, event.new_path))
+            elif event.action == "create":
+                created.append((event.mount_alias, event.path))
+        if not created:
+            return []
+        scan_slots = threading.BoundedSemaphore(1)
+        # Like scan_sources, so the directories listed here are skipped by
+        # the next full scan instead of being listed again
+        self.scan_state.load()
+        for (path_alias, name) in created:
+            path = config.media_sources[path_alias]
+            full_path = os.path.join(path, name)
+            if not os.path.exists(full_path):
+                continue
+            known = self.db.db_query_qmark_iterator('''SELECT 1 FROM media WHERE mount_alias = ? AND path = ?''',
+                                                    (path_alias, name)).fetchall()
+            if known:
+                continue
+            try:
+                self._scan_entry(config, path_alias, path, name, None, scan_slots)
+            except OSError as err:
+                self.logger.warning("Could not scan %s: %s" % (full_path, err))
+        self.scan_state.save()
+        added = list(self.library_scanned)
+        self.scanned_to_library_and_db(config)
+        added = [ full_path for full_path in added if full_path in self.library ]
+        if added:
+            # Only what was just added, the rest of the NULLs are left for
+            # the next full scan
+            self.update_missing_sizes(config, media_ids=[ self.library[full_path]["media_id"] for full_path in added ])
+        return added
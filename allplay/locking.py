@@ -0,0 +1,143 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import datetime
+import fcntl
+import json
+import logging
+import os
+import time
+
+# What S3 answers when a conditional write loses to another writer
+LOST_RACE_CODES = ("PreconditionFailed", "ConditionalRequestConflict", "412", "409")
+
+
+class DatabaseLock(object):
+    ''' Advisory lock saying this process owns the local db, held while it's open.
+
+    An flock on <db>.lock rather than on the db itself: sqlite uses POSIX
+    locks on the db file, and closing any descriptor of a file drops all of
+    the process's POSIX locks on it.  Only the holder syncs with S3, so a
+    second allplay (or a script) using the same db never has the file
+    replaced by a download underneath it.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.logger = logging.getLogger()
+        self.fd = None
+
+    @property
+    def held(self):
+        return self.fd is not None
+
+    def acquire(self):
+        # Never waits, returns whether the lock is held
+        if self.fd is not None:
+            return True
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as err:
+            self.logger.warning("Cannot open lock file %s: %s" % (self.path, err))
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        # For anyone wondering who has it
+        os.ftruncate(fd, 0)
+        os.write(fd, ("%d\n" % os.getpid()).encode())
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+
+class S3Lease(object):
+    ''' Write ownership of the S3 database, held by one machine at a time.
+
+    A small JSON object next to the database records the holder and when
+    the lease expires.  It's taken with a conditional put (If-None-Match
+    when there's no lease, If-Match on the lease that was read otherwise),
+    so when two machines start at once only one of them gets it.  Uploads
+    call check(), which renews the lease if it's still ours and refuses if
+    another machine holds an unexpired one.  An expired lease can be taken
+    over, so a machine that crashed only blocks the others until then.
+    '''
+    def __init__(self, client, bucket, key, holder, seconds):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.holder = holder
+        self.seconds = seconds
+        self.logger = logging.getLogger()
+        self.held = False
+        self.etag = None
+
+    def acquire(self):
+        (lease, etag) = self._read()
+        if self._held_elsewhere(lease):
+            self.held = False
+            return False
+        return self._write(etag)
+
+    def check(self):
+        # Before an upload: renews the lease if it's still ours, takes it
+        # if it has become free, False if another machine holds it
+        return self.acquire()
+
+    def release(self):
+        if not self.held:
+            return
+        (lease, etag) = self._read()
+        if lease is not None and lease.get("holder") == self.holder:
+            from botocore.exceptions import ClientError
+            try:
+                self.client.delete_object(Bucket=self.bucket, Key=self.key, IfMatch=etag)
+            except ClientError as err:
+                self.logger.warning("Could not release the S3 lease %s: %s" % (self.key, err))
+        self.held = False
+        self.etag = None
+
+    def _held_elsewhere(self, lease):
+        if lease is None or lease.get("holder") == self.holder or lease.get("expires", 0) <= time.time():
+            return False
+        self.logger.warning("S3 database is leased to %s until %s, not uploading from here" % (
+            lease.get("holder"), datetime.datetime.fromtimestamp(lease["expires"]).strftime("%Y-%m-%d %H:%M:%S")))
+        return True
+
+    def _read(self):
+        # Returns (lease, etag), (None, None) if there's no lease
+        from botocore.exceptions import ClientError
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.key)
+        except ClientError as err:
+            if err.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return (None, None)
+            raise
+        try:
+            lease = json.loads(response["Body"].read().decode("utf-8"))
+        except ValueError:
+            self.logger.warning("Ignoring unreadable S3 lease %s" % self.key)
+            lease = None
+        return (lease, response["ETag"])
+
+    def _write(self, etag):
+        now = int(time.time())
+        body = json.dumps({ "holder": self.holder, "acquired": now, "expires": now + self.seconds })
+        condition = { "IfMatch": etag } if etag is not None else { "IfNoneMatch": "*" }
+        from botocore.exceptions import ClientError
+        try:
+            response = self.client.put_object(Bucket=self.bucket, Key=self.key, Body=body.encode("utf-8"),
+                                              ContentType="application/json", **condition)
+        except ClientError as err:
+            if err.response.get("Error", {}).get("Code") in LOST_RACE_CODES:
+                self.logger.warning("Another machine took the S3 lease %s first" % self.key)
+                self.held = False
+                return False
+            raise
+        self.etag = response.get("ETag")
+        self.held = True
+        return True
@@ -1,13 +1,17 @@
 from __future__ import (absolute_import, division, print_function, unicode_literals)
+import datetime
 import logging
 import os
 import shutil
+import stat
 import subprocess
+from . import profiling
 from .tags import Tags
 
 
 class Media(object):
-    def __init__(self, config, library_object, db, full_path):
+    @profiling.timed("media_build")
+    def __init__(self, config, library_object, db, full_path, probe=None):
         self.db = db
         self.config = config
         self.lib = library_object
@@ -23,28 +27,43 @@ class Media(object):
             self.logger.error(f"Error accessing Library media Key: {err}")
             self.logger.error(self.lib.library[self.full_path])
             raise
-        self.tags = Tags(self.config, self.db, self.media_id)
+        self.tags = Tags(self.config, self.db, self.media_id, self.lib.tag_index)
         self.media_size_bytes = self.lib.library[self.full_path].get("media_size")
-        self.exists = os.path.exists(self.full_path)
+        if probe is None:
+            probe = self.probe(self.config, self.full_path, self.lib.file_cache.load(self.media_id))
+        self.exists = probe["exists"]
+        self.is_dir = probe["is_dir"]
+        self.media_size = self.format_media_size(self.media_size_bytes)
         if self.exists:
-            self.files = self.get_files()
-            if os.path.isdir(self.full_path) and len(self.files) == 0:
+            self.files = probe["files"]
+            if probe["listing"] is not None:
+                self.lib.file_cache.store(self.media_id, probe["listing"])
+            if probe["media_size"] is not None and probe["media_size"] != self.media_size_bytes:
+                self.set_media_size(probe["media_size"])
+            if self.is_dir and len(self.files) == 0:
                 self.logger.warning("No media found at {0}, tagging as {1}".format(self.full_path, self.config.non_media_tag))
                 self.tags.add_tag(config.non_media_tag)
         else:
+            # Removed outside of allplay, drop it without trying to delete it
             self.files = list()
-            self.delete()
-        self.media_size = self.format_media_size(self.media_size_bytes)
+            self.lib.forget_media(self.config, self.mount_alias, self.path)
+        self.modified_time = datetime.datetime.fromtimestamp(self.mtime) if self.mtime is not None else None
 
     def increment_times_played(self):
+        # Increment the row rather than write our count back, plays applied
+        # from other machines since we loaded it would be lost otherwise
+        # (and the journal would record no play of ours)
         sql = '''UPDATE media
-                 SET times_played = ?
+                 SET times_played = IFNULL(times_played, 0) + 1
                  WHERE media_id = ?
                  LIMIT 1'''
-        self.times_played += 1
-        params = (self.times_played, self.media_id)
+        params = (self.media_id,)
         (assoc_rowcount, assoc_lastrowid) = self.db.db_insert(sql, params)
         if assoc_rowcount == 1:
+            self.times_played = self.db.db_query_qmark_iterator('''SELECT times_played FROM media WHERE media_id = ?''',
+                                                                (self.media_id,)).fetchone()[0]
+            if self.full_path in self.lib.library:
+                self.lib.library[self.full_path]["times_played"] = self.times_played
             self.logger.debug("Successfully incremented times_played to {0} for media_id {1}".format(self.times_played, self.media_id))
             return True
         else:
@@ -53,33 +72,87 @@ class Media(object):
 
     def get_files(self):
         # Get the files if full_path is a directory
-        media_files = list()
-        for path, dirs, files in os.walk(self.full_path):
-            for found_file in files:
-                if found_file.split('.')[-1].lower() in self.config.media_extensions:
-                    self.logger.debug("Extension Match!: %s in %s" % (found_file, path))
-                    media_files.append(os.path.join(path, found_file))
-        return sorted(media_files)
+        return self.probe(self.config, self.full_path)["files"]
+
+    @staticmethod
+    @profiling.timed("media_probe")
+    def probe(config, full_path, cached=None):
+        """Filesystem checks Media needs before it can be played.
 
+        Returns whether full_path exists and is a directory, its media files
+        and their total size.  For a directory, cached is its media_files
+        listing from the db: if a stat of every cached directory still
+        matches, the files come from the cache without walking anything,
+        otherwise the directory is walked once for both the files and their
+        sizes and "listing" holds the new cache contents.  Only touches the
+        filesystem, so it's safe to run on the prefetch and size threads.
+        """
+        probe = { "exists": False, "is_dir": False, "files": list(), "media_size": None, "listing": None }
+        try:
+            root_stat = os.stat(full_path)
+        except OSError:
+            return probe
+        probe["exists"] = True
+        if not stat.S_ISDIR(root_stat.st_mode):
+            # files is only for directories, a single file plays full_path
+            probe["media_size"] = root_stat.st_size
+            return probe
+        probe["is_dir"] = True
+        listing = cached
+        if listing is None or not Media.listing_current(full_path, listing, root_stat):
+            listing = Media.walk_media_files(config, full_path, root_stat)
+            probe["listing"] = listing
+        probe["files"] = sorted(os.path.join(full_path, rel_path) for (rel_path, size) in listing["files"])
+        probe["media_size"] = sum(size for (rel_path, size) in listing["files"])
+        return probe
 
     @staticmethod
-    def calculate_media_size(config, full_path):
-        """Calculate total media size in bytes for a given path."""
-        file_size_total = 0
-        if os.path.isfile(full_path):
+    def listing_current(full_path, listing, root_stat):
+        for (rel_dir, mtime) in listing["dirs"].items():
+            try:
+                dir_mtime = root_stat.st_mtime_ns if not rel_dir else os.stat(os.path.join(full_path, rel_dir)).st_mtime_ns
+            except OSError:
+                return False
+            if dir_mtime != mtime:
+                return False
+        return True
+
+    @staticmethod
+    def walk_media_files(config, full_path, root_stat=None):
+        # One pass collecting the media files, their sizes and the mtime of
+        # every directory.  Like os.walk, symlinked directories aren't
+        # followed.  The mtime is taken before listing, so anything changing
+        # mid walk just makes the next probe walk again.
+        listing = { "dirs": dict(), "files": list() }
+        pending = [ '' ]
+        while pending:
+            rel_dir = pending.pop()
+            dir_path = os.path.join(full_path, rel_dir) if rel_dir else full_path
             try:
-                file_size_total += os.path.getsize(full_path)
+                if rel_dir or root_stat is None:
+                    listing["dirs"][rel_dir] = os.stat(dir_path).st_mtime_ns
+                else:
+                    listing["dirs"][rel_dir] = root_stat.st_mtime_ns
+                entries = os.scandir(dir_path)
             except OSError:
-                pass
-        elif os.path.isdir(full_path):
-            for path, dirs, files in os.walk(full_path):
-                for found_file in files:
-                    if found_file.split('.')[-1].lower() in config.media_extensions:
-                        try:
-                            file_size_total += os.path.getsize(os.path.join(path, found_file))
-                        except OSError:
-                            pass
-        return file_size_total
+                continue
+            with entries:
+                for entry in entries:
+                    rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                    try:
+                        if entry.is_dir():
+                            if not entry.is_symlink():
+                                pending.append(rel_path)
+                        elif entry.name.split('.')[-1].lower() in config.media_extensions:
+                            listing["files"].append((rel_path, entry.stat().st_size))
+                    except OSError:
+                        pass
+        return listing
+
+    @staticmethod
+    def calculate_media_size(config, full_path):
+        """Calculate total media size in bytes for a given path."""
+        return Media.probe(config, full_path)["media_size"] or 0
 
     @staticmethod
     def format_media_size(size_bytes):
@@ -127,9 +200,33 @@ class Media(object):
             return False
 
     def delete_file(self, index):
-        self.logger.warning("Deleting %s" % self.files[index])
-        if os.unlink(self.files[index]):
-            del(self.files[index])
+        file_path = self.files[index]
+        self.logger.warning("Deleting %s" % file_path)
+        try:
+            file_size = os.path.getsize(file_path)
+            os.unlink(file_path)
+        except OSError as err:
+            self.logger.warning("Could not delete %s: %s" % (file_path, err))
+            return False
+        del(self.files[index])
+        if self.is_dir:
+            rel_path = os.path.relpath(file_path, self.full_path)
+            rel_dir = os.path.dirname(rel_path)
+            try:
+                dir_mtime = os.stat(os.path.dirname(file_path)).st_mtime_ns
+            except OSError:
+                dir_mtime = None
+            self.lib.file_cache.remove_file(self.media_id, rel_path, rel_dir, dir_mtime)
+        if self.media_size_bytes is not None:
+            self.set_media_size(max(self.media_size_bytes - file_size, 0))
+        return True
+
+    def set_media_size(self, media_size):
+        self.db.db_insert('''UPDATE media SET media_size = ? WHERE media_id = ?''', (media_size, self.media_id))
+        if self.full_path in self.lib.library:
+            self.lib.library[self.full_path]["media_size"] = media_size
+        self.media_size_bytes = media_size
+        self.media_size = self.format_media_size(media_size)
 
     def move_to_new_mount_alias(self, new_mount_alias):
         new_mount = self.config.media_sources[new_mount_alias]
@@ -150,12 +247,13 @@ class Media(object):
             self.logger.warning("Cannot move %s to %s, path does not exist" % (self.full_path, new_mount))
             return False
 
+    @profiling.timed("playback")
     def play_media(self):
         command = [ self.config.media_handler ]
         if self.config.media_handler_arguments:
             for argument in self.config.media_handler_arguments:
                 command.append(argument)
-        if os.path.isfile(self.full_path):
+        if not self.is_dir:
             #formatted_full_path = '"' + self.full_path + '"'
             #command.append(formatted_full_path)
             command.append(self.full_path)
@@ -0,0 +1,98 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from .media import Media
+
+
+class Prefetcher(object):
+    ''' Runs the filesystem side of the next few playlist items ahead of time.
+
+    While one title plays, the next prefetch_count paths are pulled from the
+    playlist and Media.probe (exists, isdir and the media file walk) runs for
+    them on a background thread, so on a network mount the next title is
+    ready as soon as the player exits.  Only the filesystem is touched in
+    the background, plus a read of the media_files cache over a read only
+    connection; building the Media and anything that writes to the db
+    (non media tagging, forgetting missing media, the media_files cache)
+    still happens on the main thread.  Iterating yields (full_path, probe)
+    and the playlist interface (push, release, remaining, total) is passed
+    through.  Queued paths are only pulled from the playlist, not released,
+    so their library entries stay put until the main loop is done with them.
+    '''
+    def __init__(self, config, lib, playlist):
+        self.config = config
+        self.lib = lib
+        self.playlist = playlist
+        self.logger = logging.getLogger()
+        self.count = max(config.prefetch_count, 0)
+        self.pending = deque()
+        self.pool = ThreadPoolExecutor(max_workers=1) if self.count else None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self._fill()
+        if not self.pending:
+            raise StopIteration
+        (full_path, future) = self.pending.popleft()
+        probe = None
+        if future is not None:
+            try:
+                probe = future.result()
+            except OSError as err:
+                # Let Media probe it again on the main thread
+                self.logger.warning("Prefetch of %s failed: %s" % (full_path, err))
+        self._fill()
+        return (full_path, probe)
+
+    next = __next__
+
+    def _fill(self):
+        # Keep one item queued even with prefetching off
+        while len(self.pending) < max(self.count, 1):
+            full_path = next(self.playlist, None)
+            if full_path is None:
+                return
+            future = None
+            if self.pool is not None and self._wanted(full_path):
+                future = self.pool.submit(self._probe, full_path, self.lib.library[full_path]["media_id"])
+            self.pending.append((full_path, future))
+
+    def _probe(self, full_path, media_id):
+        # On the worker thread, the cached file list is read over a read
+        # only connection of its own; opening one is nothing next to a
+        # walk of a network mount
+        reader = self.lib.db.reader()
+        try:
+            cached = self.lib.file_cache.load(media_id, reader)
+        finally:
+            reader.close()
+        return Media.probe(self.config, full_path, cached)
+
+    def _wanted(self, full_path):
+        # Don't walk things the main loop is about to skip anyway
+        if full_path not in self.lib.library:
+            return False
+        media_id = self.lib.library[full_path]["media_id"]
+        return not self.lib.tag_index.has_any(media_id, self.config.default_exclusion_tags)
+
+    def push(self, full_path):
+        self.playlist.push(full_path)
+
+    def release(self, full_path):
+        self.playlist.release(full_path)
+
+    def remaining(self):
+        return self.playlist.remaining() + len(self.pending)
+
+    def total(self):
+        return self.playlist.total()
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+        for (full_path, future) in self.pending:
+            self.playlist.release(full_path)
+        self.pending.clear()
@@ -0,0 +1,194 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import atexit
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+# Set by start(), everything here is a no-op while it's None
+profiler = None
+_NO_PHASE = contextlib.nullcontext()
+
+
+class Profiler(object):
+    ''' Where a session's time goes, turned on by allplay --profile.
+
+    Records wall time and call counts per named phase (s3 sync, schema,
+    scan, ingest, media sizes, cursor pages, Media construction and so on),
+    filesystem calls by patching a few os functions, SQL statements through
+    the sqlite trace callback and, optionally, a cProfile of the main
+    thread.  Phases can overlap, e.g. media_probe runs inside media_build
+    and on the prefetch thread while something plays, so the totals are
+    not meant to add up to the session's wall time.  A JSON report is
+    written when the profiler stops.
+    '''
+    FS_CALLS = ("stat", "lstat", "scandir", "listdir", "unlink", "rename")
+
+    def __init__(self, report_path, cprofile_path=None):
+        self.logger = logging.getLogger()
+        self.report_path = report_path
+        self.cprofile_path = cprofile_path
+        self.lock = threading.Lock()
+        self.phases = dict()
+        self.counters = dict()
+        self.fs_calls = dict((name, 0) for name in self.FS_CALLS)
+        self.fs_calls["scandir_entries"] = 0
+        self.sql = { "statements": 0, "trigger_statements": 0, "by_verb": dict() }
+        self._os_originals = dict()
+        self._cprofile = None
+        self.started = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        for name in self.FS_CALLS:
+            original = getattr(os, name)
+            self._os_originals[name] = original
+            setattr(os, name, self._counting(name, original))
+        if self.cprofile_path:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def stop(self):
+        for (name, original) in self._os_originals.items():
+            setattr(os, name, original)
+        self._os_originals.clear()
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self.cprofile_path)
+            self._cprofile = None
+        self.write_report()
+
+    def _counting(self, name, original):
+        # os.path.isfile/isdir/exists/getsize all end up in os.stat, so
+        # they're counted as stats
+        def counted(*args, **kwargs):
+            with self.lock:
+                self.fs_calls[name] += 1
+            result = original(*args, **kwargs)
+            if name == "scandir":
+                return _CountingScandir(self, result)
+            return result
+        return counted
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                (seconds, calls) = self.phases.get(name, (0.0, 0))
+                self.phases[name] = (seconds + elapsed, calls + 1)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def trace_sql(self, statement):
+        # Called by sqlite for every statement run, statements run by
+        # triggers come through as "-- TRIGGER name"
+        if statement.startswith("--"):
+            self.sql["trigger_statements"] += 1
+            return
+        self.sql["statements"] += 1
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+        self.sql["by_verb"][verb] = self.sql["by_verb"].get(verb, 0) + 1
+
+    def report(self):
+        with self.lock:
+            phases = dict((name, { "seconds": round(seconds, 6), "calls": calls })
+                          for (name, (seconds, calls)) in self.phases.items())
+            return { "wall_seconds": round(time.perf_counter() - self.started, 6),
+                     "phases": phases,
+                     "counters": dict(self.counters),
+                     "fs_calls": dict(self.fs_calls),
+                     "sql": dict(self.sql, by_verb=dict(self.sql["by_verb"])),
+                     "cprofile": self.cprofile_path }
+
+    def write_report(self):
+        try:
+            with open(self.report_path, "w") as report_file:
+                json.dump(self.report(), report_file, indent=2, sort_keys=True)
+            self.logger.warning("Profile written to %s" % self.report_path)
+        except OSError as err:
+            self.logger.warning("Could not write the profile to %s: %s" % (self.report_path, err))
+
+
+class _CountingScandir(object):
+    # Wraps a scandir iterator to count the entries it returns
+    def __init__(self, profiler, iterator):
+        self.profiler = profiler
+        self.iterator = iterator
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        entry = next(self.iterator)
+        with self.profiler.lock:
+            self.profiler.fs_calls["scandir_entries"] += 1
+        return entry
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.iterator.close()
+
+
+def start(report_path, cprofile_path=None):
+    ''' Turns profiling on for the rest of the process, the report is written at exit. '''
+    global profiler
+    if profiler is not None:
+        return profiler
+    profiler = Profiler(report_path, cprofile_path)
+    profiler.start()
+    atexit.register(stop)
+    return profiler
+
+
+def stop():
+    global profiler
+    if profiler is None:
+        return
+    (active, profiler) = (profiler, None)
+    active.stop()
+
+
+def phase(name):
+    # with profiling.phase("scan"): ...  costs a global lookup when off
+    if profiler is None:
+        return _NO_PHASE
+    return profiler.phase(name)
+
+
+def timed(name):
+    # Decorator form of phase() for whole functions
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if profiler is None:
+                return func(*args, **kwargs)
+            with profiler.phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, amount=1):
+    if profiler is not None:
+        profiler.count(name, amount)
+
+
+def trace_connection(sqlite_conn):
+    # Count the statements run on a connection while profiling
+    if profiler is not None:
+        sqlite_conn.set_trace_callback(profiler.trace_sql)
@@ -0,0 +1,166 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from array import array
+import logging
+import time
+# Weights are kept as integers so removing a drawn item from the tree is
+# exact, this is the resolution of a weight of 1.0
+WEIGHT_SCALE = 1 << 20
+SECONDS_PER_DAY = 86400
+# Importing numpy takes longer than the Python loops do on anything
+# smaller, so it's only loaded for libraries of at least this size
+NUMPY_MIN_SIZE = 25000
+# False until the first import attempt, then the module or None
+_numpy = False
+
+
+def numpy_for(size):
+    # numpy if it's worth using for size items and installed, else None
+    global _numpy
+    if size < NUMPY_MIN_SIZE:
+        return None
+    if _numpy is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy = numpy
+    return _numpy
+
+
+class WeightedSampler(object):
+    ''' Draws media_ids by weight without replacement.
+
+    Weights live in a Fenwick (binary indexed) tree, so a draw is a single
+    O(log n) walk down the tree and removing the drawn item is an O(log n)
+    update; nothing is shuffled up front.  Building the tree is O(n), and
+    on big libraries with numpy available the weights and the tree are
+    computed with array math instead of Python loops.
+    '''
+    def __init__(self, media_ids, weights, rng):
+        self.logger = logging.getLogger()
+        self.rng = rng
+        self.media_ids = array('q', media_ids)
+        self.weights = array('q', weights)
+        self.size = len(self.media_ids)
+        self.tree = self._build_tree(self.weights)
+        self.total = sum(self.weights)
+        self.remaining = self.size
+        self._top_step = 1 << (self.size.bit_length() - 1) if self.size else 0
+
+    @staticmethod
+    def _build_tree(weights):
+        size = len(weights)
+        numpy = numpy_for(size)
+        if numpy is not None:
+            # tree[i] is the sum of the lowbit(i) weights ending at i
+            cumulative = numpy.zeros(size + 1, dtype=numpy.int64)
+            numpy.cumsum(numpy.frombuffer(weights, dtype=numpy.int64), out=cumulative[1:])
+            index = numpy.arange(size + 1, dtype=numpy.int64)
+            tree = cumulative - cumulative[index - (index & -index)]
+            return array('q', tree.tobytes())
+        tree = array('q', [0])
+        tree.extend(weights)
+        for i in range(1, size + 1):
+            parent = i + (i & -i)
+            if parent <= size:
+                tree[parent] += tree[i]
+        return tree
+
+    def __len__(self):
+        return self.remaining
+
+    def draw(self):
+        ''' Returns a media_id, or None once everything has been drawn. '''
+        if self.total <= 0:
+            return None
+        target = self.rng.randrange(self.total)
+        position = 0
+        step = self._top_step
+        while step:
+            next_position = position + step
+            if next_position <= self.size and self.tree[next_position] <= target:
+                position = next_position
+                target -= self.tree[next_position]
+            step >>= 1
+        self._remove(position)
+        return self.media_ids[position]
+
+    def draw_many(self, count):
+        drawn = list()
+        while len(drawn) < count:
+            media_id = self.draw()
+            if media_id is None:
+                break
+            drawn.append(media_id)
+        return drawn
+
+    def _remove(self, index):
+        weight = self.weights[index]
+        self.weights[index] = 0
+        self.total -= weight
+        self.remaining -= 1
+        i = index + 1
+        while i <= self.size:
+            self.tree[i] -= weight
+            i += i & -i
+
+    @classmethod
+    def from_db(cls, db, config, where, params, rng):
+        ''' Builds a sampler over the media rows matching where.
+
+        config.random_weights picks what's favored, 0 or missing leaves it out:
+          times_played: weight is divided by (1 + times_played) ** this
+          recent: just modified media is weighted 1 + this, halving the
+                  extra every recent_half_life_days
+          tags: {tag_name: multiplier}
+        '''
+        settings = config.random_weights
+        sql = '''SELECT media_id, times_played, mtime FROM media'''
+        if where:
+            sql += " WHERE " + where
+        media_ids = array('q')
+        times_played = array('q')
+        mtimes = array('q')
+        for (media_id, played, mtime) in db.db_read_iterator(sql, tuple(params)):
+            media_ids.append(media_id)
+            times_played.append(played or 0)
+            mtimes.append(mtime or 0)
+        tag_factors = dict()
+        for (tag_name, factor) in (settings.get("tags") or dict()).items():
+            for (media_id,) in db.db_read_iterator('''SELECT mt.media_id FROM media_tags mt, tags t
+                                                             WHERE mt.tag_id = t.tag_id AND t.tag_name = ?''', (tag_name,)):
+                tag_factors[media_id] = tag_factors.get(media_id, 1.0) * float(factor)
+        weights = cls.weigh(media_ids, times_played, mtimes, tag_factors,
+                            played_weight=float(settings.get("times_played") or 0),
+                            recent_weight=float(settings.get("recent") or 0),
+                            half_life_days=float(settings.get("recent_half_life_days") or 90),
+                            now=time.time())
+        logging.getLogger().debug("Weighted sampler built over %s media" % len(media_ids))
+        return cls(media_ids, weights, rng)
+
+    @staticmethod
+    def weigh(media_ids, times_played, mtimes, tag_factors, played_weight, recent_weight, half_life_days, now):
+        # Returns integer weights, never below 1 so everything still plays
+        numpy = numpy_for(len(media_ids))
+        if numpy is not None:
+            weights = numpy.ones(len(media_ids))
+            if played_weight:
+                weights /= (1.0 + numpy.frombuffer(times_played, dtype=numpy.int64)) ** played_weight
+            if recent_weight:
+                age_days = numpy.maximum(now - numpy.frombuffer(mtimes, dtype=numpy.int64), 0) / SECONDS_PER_DAY
+                weights *= 1.0 + recent_weight * 0.5 ** (age_days / half_life_days)
+            if tag_factors:
+                factors = numpy.array([ tag_factors.get(media_id, 1.0) for media_id in media_ids ])
+                weights *= factors
+            return array('q', numpy.maximum(numpy.rint(weights * WEIGHT_SCALE), 1).astype(numpy.int64).tobytes())
+        weights = array('q')
+        for (media_id, played, mtime) in zip(media_ids, times_played, mtimes):
+            weight = 1.0
+            if played_weight:
+                weight /= (1.0 + played) ** played_weight
+            if recent_weight:
+                age_days = max(now - mtime, 0) / SECONDS_PER_DAY
+                weight *= 1.0 + recent_weight * 0.5 ** (age_days / half_life_days)
+            weight *= tag_factors.get(media_id, 1.0)
+            weights.append(max(int(round(weight * WEIGHT_SCALE)), 1))
+        return weights
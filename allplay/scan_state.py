@@ -0,0 +1,108 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+from collections import defaultdict
+import logging
+import os
+import threading
+
+
+class ScanState(object):
+    ''' Persisted per-directory scan results used to skip unchanged subtrees.
+
+    Every directory the scanner lists gets a scan_state row keyed by
+    (mount_alias, path), path being relative to the mount ('' is the
+    mount itself).  A directory's mtime only changes when its direct
+    children are added, removed or renamed, so if the mtime matches the
+    last listing we can trust the recorded child directories and whether
+    it held media files directly, and only need to stat the children.
+    '''
+    def __init__(self, db):
+        self.db = db
+        self.logger = logging.getLogger()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.dirs = {}
+        self.children = defaultdict(set)
+        self.dirty = set()
+        self.removed = set()
+
+    def load(self):
+        self.dirs.clear()
+        self.children.clear()
+        self.dirty.clear()
+        self.removed.clear()
+        last_generation = 0
+        iterator = self.db.db_query_iterator('''SELECT mount_alias, path, parent, mtime, entry_count, has_media, scan_generation
+                                                FROM scan_state''')
+        for (mount_alias, path, parent, mtime, entry_count, has_media, scan_generation) in iterator:
+            self.dirs[(mount_alias, path)] = { "parent": parent,
+                                               "mtime": mtime,
+                                               "entry_count": entry_count,
+                                               "has_media": bool(has_media),
+                                               "scan_generation": scan_generation
+                                             }
+            if parent is not None:
+                self.children[(mount_alias, parent)].add(path)
+            last_generation = max(last_generation, scan_generation or 0)
+        self.generation = last_generation + 1
+        self.logger.debug("Loaded scan state for %s directories, generation %s" % (len(self.dirs), self.generation))
+
+    @staticmethod
+    def relative_path(parent, name):
+        return os.path.join(parent, name) if parent else name
+
+    @staticmethod
+    def parent_path(path):
+        if not path:
+            return None
+        return os.path.dirname(path)
+
+    def unchanged(self, mount_alias, path, mtime):
+        state = self.dirs.get((mount_alias, path))
+        return state is not None and state["mtime"] == mtime
+
+    def has_media(self, mount_alias, path):
+        return self.dirs[(mount_alias, path)]["has_media"]
+
+    def child_dirs(self, mount_alias, path):
+        return sorted(self.children.get((mount_alias, path), ()))
+
+    def record(self, mount_alias, path, mtime, entry_count, has_media, child_dirs):
+        # Called from scan worker threads after a directory has been listed.
+        key = (mount_alias, path)
+        with self.lock:
+            self.dirs[key] = { "parent": self.parent_path(path),
+                               "mtime": mtime,
+                               "entry_count": entry_count,
+                               "has_media": has_media,
+                               "scan_generation": self.generation
+                             }
+            current = set(self.relative_path(path, child) for child in child_dirs)
+            for gone in self.children.get(key, set()) - current:
+                self.removed.add((mount_alias, gone))
+            self.children[key] = current
+            self.dirty.add(key)
+
+    def save(self):
+        # Runs on the main thread once the scan workers are done.
+        with self.lock:
+            rows = list()
+            for (mount_alias, path) in self.dirty:
+                state = self.dirs[(mount_alias, path)]
+                rows.append((mount_alias, path, state["parent"], state["mtime"], state["entry_count"],
+                             int(state["has_media"]), state["scan_generation"]))
+            removed = list(self.removed)
+            for key in removed:
+                self.dirs.pop(key, None)
+                self.children.pop(key, None)
+            self.dirty.clear()
+            self.removed.clear()
+        self.db.sqlite_cursor.executemany('''INSERT OR REPLACE INTO scan_state
+                                             (mount_alias, path, parent, mtime, entry_count, has_media, scan_generation)
+                                             VALUES (?,?,?,?,?,?,?)''', rows)
+        # A directory that disappeared takes its whole recorded subtree with it
+        self.db.sqlite_cursor.executemany('''DELETE FROM scan_state
+                                             WHERE mount_alias = ?
+                                             AND (path = ? OR substr(path, 1, length(?) + 1) = ? || '/')''',
+                                          [ (mount_alias, path, path, path) for (mount_alias, path) in removed ])
+        self.db.sqlite_conn.commit()
+        self.logger.debug("Saved scan state: %s updated, %s removed" % (len(rows), len(removed)))
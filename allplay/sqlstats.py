@@ -0,0 +1,169 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import logging
+import re
+import sqlite3
+import time
+
+# Upper bounds of the latency histogram buckets in milliseconds, anything
+# slower lands in the last one
+HISTOGRAM_BOUNDS_MS = (0.1, 1, 10, 100, 1000)
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "REPLACE")
+
+
+class SqlStats(object):
+    ''' Per statement counts and latencies for one connection.
+
+    Statements are keyed by their SQL with the whitespace collapsed and
+    runs of ? placeholders folded together, so an IN list of any length
+    counts as the same statement.  The histogram and the slow query log
+    are per execute(), which steps to the first row so it already holds
+    most of the work for sorts and aggregates.  fetchone/fetchmany/fetchall
+    time and rows are added to the statement's totals; rows pulled by
+    iterating the cursor aren't timed or counted.
+    '''
+    def __init__(self, slow_query_ms=0):
+        self.logger = logging.getLogger()
+        self.slow_query_ms = slow_query_ms
+        self._keys = dict()
+        self.reset()
+
+    def reset(self):
+        self.statements = dict()
+        self.commits = 0
+        self.explained = set()
+        self.started = time.time()
+
+    def key(self, sql):
+        key = self._keys.get(sql)
+        if key is None:
+            if len(self._keys) > 2000:
+                self._keys.clear()
+            key = re.sub(r"\?(\s*,\s*\?)+", "?, ...", " ".join(sql.split()))
+            self._keys[sql] = key
+        return key
+
+    def record(self, key, seconds):
+        stats = self.statements.get(key)
+        if stats is None:
+            stats = self.statements[key] = { "count": 0, "rows": 0, "seconds": 0.0, "max_seconds": 0.0,
+                                             "histogram": [ 0 ] * (len(HISTOGRAM_BOUNDS_MS) + 1) }
+        stats["count"] += 1
+        stats["seconds"] += seconds
+        if seconds > stats["max_seconds"]:
+            stats["max_seconds"] = seconds
+        elapsed_ms = seconds * 1000
+        bucket = 0
+        while bucket < len(HISTOGRAM_BOUNDS_MS) and elapsed_ms > HISTOGRAM_BOUNDS_MS[bucket]:
+            bucket += 1
+        stats["histogram"][bucket] += 1
+
+    def is_slow(self, seconds):
+        return self.slow_query_ms > 0 and seconds * 1000 >= self.slow_query_ms
+
+    def log_slow(self, connection, key, sql, parameters, seconds):
+        self.logger.warning("Slow query (%.1f ms): %s" % (seconds * 1000, key))
+        # The plan only changes with the schema, show it once per statement
+        if key in self.explained or parameters is None or not sql.lstrip().upper().startswith(EXPLAINABLE):
+            return
+        self.explained.add(key)
+        try:
+            # A plain cursor, so the EXPLAIN isn't counted or timed itself
+            plan = sqlite3.Cursor(connection).execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+        except sqlite3.Error as err:
+            self.logger.warning("  Could not explain it: %s" % err)
+            return
+        for (node_id, parent_id, unused, detail) in plan:
+            self.logger.warning("  %s" % detail)
+
+    def summary(self, limit=15, order_by="seconds"):
+        ''' Returns the stats as printable lines, the most expensive statements first '''
+        total_count = sum(stats["count"] for stats in self.statements.values())
+        total_seconds = sum(stats["seconds"] for stats in self.statements.values())
+        lines = [ "%s statements (%s distinct) in %.3fs, %s commits since %s" % (
+                    total_count, len(self.statements), total_seconds, self.commits,
+                    time.strftime("%H:%M:%S", time.localtime(self.started))) ]
+        buckets = [ "<=%gms" % bound for bound in HISTOGRAM_BOUNDS_MS ] + [ ">%gms" % HISTOGRAM_BOUNDS_MS[-1] ]
+        lines.append("%8s %10s %9s %9s  %s" % ("count", "total ms", "avg ms", "max ms", " ".join("%7s" % b for b in buckets)))
+        ranked = sorted(self.statements.items(), key=lambda item: item[1][order_by], reverse=True)
+        for (key, stats) in ranked[:limit]:
+            lines.append("%8d %10.1f %9.3f %9.1f  %s" % (
+                stats["count"], stats["seconds"] * 1000, stats["seconds"] * 1000 / stats["count"],
+                stats["max_seconds"] * 1000, " ".join("%7d" % n for n in stats["histogram"])))
+            lines.append("         %s" % (key if len(key) <= 160 else key[:157] + "..."))
+        return lines
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    ''' sqlite3 connection that records SqlStats for everything run on it.
+
+    Pass as sqlite3.connect(..., factory=InstrumentedConnection).  Cursors
+    are InstrumentedCursors, including the ones the execute shortcuts use,
+    and commits are counted.
+    '''
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedConnection, self).__init__(*args, **kwargs)
+        self.stats = SqlStats()
+
+    def cursor(self, factory=None):
+        return super(InstrumentedConnection, self).cursor(factory or InstrumentedCursor)
+
+    def execute(self, sql, parameters=()):
+        # The C shortcuts make a plain cursor without going through cursor()
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        self.stats.commits += 1
+        start = time.perf_counter()
+        super(InstrumentedConnection, self).commit()
+        self.stats.record("COMMIT", time.perf_counter() - start)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        stats = self.connection.stats
+        self._stats_key = stats.key(sql)
+        start = time.perf_counter()
+        try:
+            return super(InstrumentedCursor, self).execute(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - start
+            stats.record(self._stats_key, elapsed)
+            if stats.is_slow(elapsed):
+                stats.log_slow(self.connection, self._stats_key, sql, parameters, elapsed)
+
+    def executemany(self, sql, seq_of_parameters):
+        stats = self.connection.stats
+        self._stats_key = stats.key(sql)
+        start = time.perf_counter()
+        try:
+            return super(InstrumentedCursor, self).executemany(sql, seq_of_parameters)
+        finally:
+            elapsed = time.perf_counter() - start
+            stats.record(self._stats_key, elapsed)
+            if stats.is_slow(elapsed):
+                stats.log_slow(self.connection, self._stats_key, sql, None, elapsed)
+
+    def _timed_fetch(self, fetch, *args):
+        start = time.perf_counter()
+        rows = fetch(*args)
+        key = getattr(self, "_stats_key", None)
+        if key is not None:
+            fetched = len(rows) if isinstance(rows, list) else int(rows is not None)
+            # Added to the statement's totals without counting it again
+            entry = self.connection.stats.statements.get(key)
+            if entry is not None:
+                entry["seconds"] += time.perf_counter() - start
+                entry["rows"] += fetched
+        return rows
+
+    def fetchone(self):
+        return self._timed_fetch(super(InstrumentedCursor, self).fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed_fetch(super(InstrumentedCursor, self).fetchmany, *args)
+
+    def fetchall(self):
+        return self._timed_fetch(super(InstrumentedCursor, self).fetchall)
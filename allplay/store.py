@@ -0,0 +1,166 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+import os
+
+
+class LibraryEntry(object):
+    ''' One library row, read like the old per-entry dict.
+
+    Mount aliases are interned to small ids shared by every entry and the
+    path is stored relative to its mount, so an entry costs a fixed size
+    slot record instead of a dict plus a full path string.
+    '''
+    __slots__ = ("media_id", "alias_id", "path", "mtime", "times_played", "media_size")
+    KEYS = ("media_id", "mount_alias", "path", "mtime", "times_played", "media_size")
+    _aliases = []
+    _alias_ids = {}
+
+    def __init__(self, media_id=None, mount_alias=None, path=None, mtime=None, times_played=0, media_size=None):
+        self.media_id = media_id
+        self.alias_id = self.intern_alias(mount_alias)
+        self.path = path
+        self.mtime = mtime
+        self.times_played = times_played
+        self.media_size = media_size
+
+    @classmethod
+    def intern_alias(cls, mount_alias):
+        alias_id = cls._alias_ids.get(mount_alias)
+        if alias_id is None:
+            alias_id = len(cls._aliases)
+            cls._aliases.append(mount_alias)
+            cls._alias_ids[mount_alias] = alias_id
+        return alias_id
+
+    @property
+    def mount_alias(self):
+        return self._aliases[self.alias_id]
+
+    def __getitem__(self, key):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key == "mount_alias":
+            self.alias_id = self.intern_alias(value)
+        elif key in self.KEYS:
+            setattr(self, key, value)
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.KEYS
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.KEYS else default
+
+    def keys(self):
+        return list(self.KEYS)
+
+    def items(self):
+        return [ (key, getattr(self, key)) for key in self.KEYS ]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class LibraryStore(MutableMapping):
+    ''' Compact replacement for the full path keyed library dict.
+
+    Entries live in one dict per mount alias keyed by the path relative to
+    the mount, plus a list that keeps the load order (the sort modes rely on
+    it).  Lookups by full path strip the mount prefix, so no full path
+    strings are kept around; iterating builds them on the fly.
+    '''
+    def __init__(self):
+        self._mounts = {}
+        self._entries = {}
+        self._order = []
+        self._stale = 0
+
+    def set_mount(self, mount_alias, mount_path):
+        alias_id = LibraryEntry.intern_alias(mount_alias)
+        self._mounts[alias_id] = mount_path
+        self._entries.setdefault(alias_id, {})
+
+    def set_sources(self, media_sources):
+        for mount_alias, mount_path in media_sources.items():
+            self.set_mount(mount_alias, mount_path)
+
+    def full_path(self, entry):
+        return os.path.join(self._mounts[entry.alias_id], entry.path)
+
+    def add(self, media_id, mount_alias, path, mtime, times_played, media_size):
+        entry = LibraryEntry(media_id, mount_alias, path, mtime, times_played, media_size)
+        entries = self._entries.setdefault(entry.alias_id, {})
+        if path in entries:
+            self._stale += 1
+        entries[path] = entry
+        self._order.append(entry)
+        return entry
+
+    def _split(self, full_path):
+        for alias_id, mount_path in self._mounts.items():
+            prefix = os.path.join(mount_path, '')
+            if full_path.startswith(prefix) and full_path[len(prefix):] in self._entries[alias_id]:
+                return (alias_id, full_path[len(prefix):])
+        raise KeyError(full_path)
+
+    def __getitem__(self, full_path):
+        (alias_id, path) = self._split(full_path)
+        return self._entries[alias_id][path]
+
+    def __setitem__(self, full_path, value):
+        mount_alias = value["mount_alias"]
+        path = value["path"]
+        if mount_alias not in LibraryEntry._alias_ids or LibraryEntry._alias_ids[mount_alias] not in self._mounts:
+            self.set_mount(mount_alias, os.path.dirname(full_path))
+        self.add(value.get("media_id"), mount_alias, path, value.get("mtime"),
+                 value.get("times_played", 0), value.get("media_size"))
+
+    def __delitem__(self, full_path):
+        (alias_id, path) = self._split(full_path)
+        del self._entries[alias_id][path]
+        self._stale += 1
+        if self._stale > len(self._order) // 2:
+            self._compact()
+
+    def _live(self, entry):
+        return self._entries[entry.alias_id].get(entry.path) is entry
+
+    def _compact(self):
+        self._order = [ entry for entry in self._order if self._live(entry) ]
+        self._stale = 0
+
+    def __iter__(self):
+        for entry in self._order:
+            if self._live(entry):
+                yield self.full_path(entry)
+
+    def entries(self):
+        for entry in self._order:
+            if self._live(entry):
+                yield entry
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._entries.values())
+
+    def __contains__(self, full_path):
+        try:
+            self._split(full_path)
+            return True
+        except KeyError:
+            return False
+
+    def clear(self):
+        for entries in self._entries.values():
+            entries.clear()
+        del self._order[:]
+        self._stale = 0
+
+    def __repr__(self):
+        return "LibraryStore(%s entries)" % len(self)
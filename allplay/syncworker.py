@@ -0,0 +1,362 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import logging
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from .journal import JournalGap
+from . import profiling
+
+# How often the thread looks for work between remote checks
+POLL_SECONDS = 5
+
+
+def with_backoff(func, attempts=5, delay=2, max_delay=60, stop=None):
+    ''' Calls func until it doesn't raise, at most attempts times.
+
+    Waits delay, then twice that and so on (up to max_delay, give or take
+    a quarter so machines don't retry in step) between attempts.  Returns
+    what func returns and raises the last error once the attempts run out,
+    or as soon as stop (a threading.Event) is set.
+    '''
+    logger = logging.getLogger()
+    for attempt in range(max(attempts, 1)):
+        try:
+            return func()
+        except (KeyboardInterrupt, SystemExit, JournalGap):
+            raise
+        except Exception as err:
+            if attempt + 1 >= attempts:
+                raise
+            pause = min(delay * 2 ** attempt, max_delay) * random.uniform(0.75, 1.25)
+            logger.warning("Sync failed (%s), retrying in %.0fs" % (err, pause))
+            if stop is not None:
+                if stop.wait(pause):
+                    raise
+            else:
+                time.sleep(pause)
+
+
+class SyncWorker(object):
+    ''' Syncs the db with S3 from a background thread.
+
+    With background_sync the Database opens without waiting on S3 and this
+    takes over: S3 is checked straight away and every sync_interval
+    seconds after.  Like the Watcher the thread only does network and file
+    work; anything touching the open db happens in safe_point(), which the
+    main loop calls between items.
+
+    In file mode a newer S3 db is downloaded next to the local one and
+    swapped in at a safe point.  That's automatic if nothing has changed
+    locally this session, otherwise (or always, with sync_apply: ask) the
+    user is asked, since the swap throws the local changes away.  Local
+    changes are uploaded once the db has been quiet for
+    sync_debounce_seconds.
+
+    In journal mode new journal objects are fetched in the background and
+    applied at the next safe point, and recorded changes are handed to the
+    thread to ship on the same debounce.
+
+    Transfers are retried with backoff.  At exit whatever is left is
+    uploaded by a detached allplay --sync-upload, so the terminal is free
+    straight away (sync_exit: handoff), or in the foreground
+    (sync_exit: wait).
+    '''
+    def __init__(self, config, db):
+        self.config = config
+        self.db = db
+        self.logger = logging.getLogger()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        self._status = dict()
+        # Handed from the thread to safe_point()
+        self._fetched = None
+        self._gap = False
+        self._shipped = list()
+        # Handed from safe_point() to the thread
+        self._outbox = list()
+        self._applied = dict()
+        self._origin = None
+        self._queued_time = time.time()
+        # File mode: the local db's mtime when it last matched S3, which
+        # is what S3 is compared with, and when it was last uploaded
+        self._remote_base = None
+        self._uploaded_mtime = None
+
+    @property
+    def mode(self):
+        return "journal" if self.db.journal is not None else "file"
+
+    def start(self):
+        if self.db.journal is not None:
+            (self._origin, shipped_seq) = self.db.journal.state()
+            self._applied = self.db.journal.applied()
+        self._remote_base = self.db.mtime_before_open or 0
+        self._uploaded_mtime = self.db.local_mtime()
+        self._thread = threading.Thread(target=self._run, name="allplay-sync", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        if self.db.journal is None:
+            self.db.s3_lease_acquire()
+        next_check = 0
+        while not self._stop.is_set():
+            if time.time() >= next_check:
+                self._check_remote()
+                next_check = time.time() + self.config.sync_interval
+            if self.db.journal is not None:
+                self._ship()
+            else:
+                self._upload_if_quiet()
+            self._wake.wait(POLL_SECONDS)
+            self._wake.clear()
+
+    def _set_status(self, name, text):
+        with self._lock:
+            self._status[name] = (text, time.time())
+
+    def _attempt(self, name, func):
+        # (True, result) or (False, None) once the retries are used up
+        self._set_status(name, "running")
+        try:
+            with profiling.phase("sync_" + name):
+                result = with_backoff(func, self.config.sync_retries, stop=self._stop)
+        except JournalGap:
+            raise
+        except Exception as err:
+            self._set_status(name, "failed: %s" % err)
+            return (False, None)
+        return (True, result)
+
+    def _check_remote(self):
+        with self._lock:
+            if self._fetched or self._gap:
+                # The last one hasn't been applied yet
+                return
+            applied = dict(self._applied)
+        if self.db.journal is None:
+            (ok, fetched) = self._attempt("download", lambda: self.db.s3_fetch(self._remote_base))
+            if ok:
+                self._set_status("download", "ready, applied at the next item" if fetched else "up to date")
+                with self._lock:
+                    self._fetched = fetched
+            return
+        try:
+            (ok, batches) = self._attempt("download", lambda: self.db.journal.fetch(applied, skip_origin=self._origin))
+        except JournalGap as gap:
+            self._set_status("download", "too far behind, starting over from a snapshot at the next item")
+            with self._lock:
+                self._gap = True
+            return
+        if ok:
+            count = sum(len(entries) for (origin, entries, last_seq) in batches)
+            self._set_status("download", "%s changes ready, applied at the next item" % count if count else "up to date")
+            with self._lock:
+                self._fetched = batches or None
+                for (origin, entries, last_seq) in batches:
+                    self._applied[origin] = last_seq
+
+    def _ship(self):
+        while not self._stop.is_set():
+            with self._lock:
+                if not self._outbox:
+                    return
+                (key, data, first_seq, last_seq) = self._outbox[0]
+            (ok, result) = self._attempt("upload", lambda: self.db.journal.store.put(key, data))
+            if not ok:
+                return
+            with self._lock:
+                self._outbox.pop(0)
+                self._shipped.append(last_seq)
+            self._set_status("upload", "shipped changes up to %s" % last_seq)
+
+    def _upload_if_quiet(self):
+        mtime = self.db.local_mtime()
+        if not self.db._s3_sync_enable or mtime is None or mtime == self._uploaded_mtime:
+            return
+        if time.time() - mtime < self.config.sync_debounce_seconds:
+            self._set_status("upload", "changes waiting for %ss of quiet" % self.config.sync_debounce_seconds)
+            return
+        with self._lock:
+            if self._fetched:
+                # S3 is newer, it's applied or turned down first
+                return
+        (ok, uploaded) = self._attempt("upload", lambda: self.db.local_to_s3(raise_errors=True))
+        if ok:
+            # Not retried when the lock or lease said no, nothing changes
+            # until there are more changes
+            self._uploaded_mtime = mtime
+            if uploaded:
+                self._remote_base = mtime
+            self._set_status("upload", "up to date" if uploaded else "not uploaded, see the log")
+
+    def safe_point(self, confirm):
+        ''' Applies what the thread has fetched, on the main thread between items.
+
+        confirm(question) asks the user, returning True for yes.  Returns
+        True when the db changed underneath the library, which should be
+        reloaded.
+        '''
+        # fetched stays set until it's dealt with, so the thread doesn't
+        # check S3 again against a base that's about to change
+        with self._lock:
+            (fetched, gap, shipped) = (self._fetched, self._gap, self._shipped)
+            self._shipped = list()
+        try:
+            if self.db.journal is not None:
+                return self._apply_journal(fetched, gap, shipped)
+            return self._apply_file(fetched, confirm)
+        finally:
+            with self._lock:
+                if self._fetched is fetched:
+                    self._fetched = None
+                if gap:
+                    self._gap = False
+
+    def _apply_journal(self, fetched, gap, shipped):
+        changed = False
+        for last_seq in shipped:
+            self.db.journal.mark_shipped(last_seq)
+        try:
+            if gap:
+                self.db.journal_rebootstrap()
+                changed = True
+            elif fetched:
+                changed = self.db.journal.apply_fetched(fetched) > 0
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.logger.warning("Error attempting to apply the change journal: %s" % sys.exc_info()[1])
+        self._queue_push()
+        with self._lock:
+            self._applied = self.db.journal.applied()
+        if changed:
+            self._set_status("download", "applied")
+        return changed
+
+    def _apply_file(self, fetched, confirm):
+        if not fetched:
+            return False
+        local_changes = self.db.local_changes()
+        if (self.config.sync_apply == "auto" and not local_changes) or confirm(
+                "A newer database was downloaded from S3, switch to it%s?" % (
+                    " and lose %s changes made here" % local_changes if local_changes else "")):
+            self.db.s3_apply_fetched(fetched)
+            self._remote_base = self._uploaded_mtime = self.db.local_mtime()
+            self._set_status("download", "applied")
+            return True
+        os.unlink(fetched[0])
+        # Only offer S3 copies newer than this one from here on
+        self._remote_base = time.time()
+        self._set_status("download", "kept the local database")
+        return False
+
+    def _queue_push(self):
+        # Recorded changes go to the thread once they've had time to pile up
+        with self._lock:
+            if self._outbox or time.time() - self._queued_time < self.config.sync_debounce_seconds:
+                return
+        objects = self.db.journal.pending_objects()
+        with self._lock:
+            self._outbox = objects
+            self._queued_time = time.time()
+        if objects:
+            self._wake.set()
+
+    def status(self):
+        ''' Printable lines for the DB menu '''
+        lines = [ "S3 sync (%s mode, in the background)" % self.mode ]
+        with self._lock:
+            for name in ("download", "upload"):
+                (text, when) = self._status.get(name, ("nothing yet", None))
+                lines.append("  %-8s %s%s" % (name + ":", text, time.strftime(" at %H:%M:%S", time.localtime(when)) if when else ""))
+            if self._outbox:
+                lines.append("  %s journal objects waiting to ship" % len(self._outbox))
+        if self.db.journal is not None:
+            lines.append("  %s changes not shipped yet" % self.db.journal.pending_count())
+        elif self.db.local_changes() > 0 and self.db.local_mtime() != self._uploaded_mtime:
+            lines.append("  local changes not uploaded yet")
+        return lines
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            if self._thread.is_alive():
+                self.logger.warning("S3 sync is still busy, leaving it behind")
+
+    def finish(self):
+        # From Database.__exit__ with the db still open
+        self.stop()
+        with self._lock:
+            (fetched, shipped) = (self._fetched, self._shipped)
+            (self._fetched, self._shipped) = (None, list())
+        if fetched and self.db.journal is None:
+            os.unlink(fetched[0])
+        if not self.db._s3_sync_enable:
+            return
+        if self.db.journal is not None:
+            for last_seq in shipped:
+                self.db.journal.mark_shipped(last_seq)
+            due = self.db.journal.pending_count() > 0
+        else:
+            due = self.db.local_changes() > 0 and self.db.local_mtime() != self._uploaded_mtime
+        if not due:
+            return
+        if self.config.sync_exit == "handoff" and self.handoff():
+            return
+        with profiling.phase("sync_upload"):
+            try:
+                if self.db.journal is not None:
+                    with_backoff(lambda: self.db.journal_finish(raise_errors=True), self.config.sync_retries)
+                else:
+                    with_backoff(lambda: self.db.local_to_s3(raise_errors=True), self.config.sync_retries)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                self.logger.warning("Giving up on uploading to S3: %s" % sys.exc_info()[1])
+
+    def handoff(self):
+        # Starts allplay --sync-upload detached, it waits for this allplay
+        # to let go of the db and its output goes to <db>.sync.log
+        log_path = self.db.local_database + ".sync.log"
+        package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        try:
+            with open(log_path, "a") as log_file:
+                subprocess.Popen([ sys.executable, "-m", "allplay", "--sync-upload" ], cwd=package_root,
+                                 stdin=subprocess.DEVNULL, stdout=log_file, stderr=subprocess.STDOUT,
+                                 start_new_session=True, close_fds=True)
+        except OSError as err:
+            self.logger.warning("Could not hand the S3 upload off, uploading now: %s" % err)
+            return False
+        self.logger.warning("Uploading to S3 in the background, see %s" % log_path)
+        return True
+
+
+def upload(config, db, wait=60):
+    ''' allplay --sync-upload: uploads once the allplay that handed off has exited '''
+    logger = logging.getLogger()
+    if not db.acquire_lock(wait):
+        logger.warning("%s is still in use after %ss, not uploading" % (db.local_database, wait))
+        return False
+    try:
+        if db.journal is not None:
+            db.open_connection()
+            try:
+                return with_backoff(lambda: db.journal_finish(raise_errors=True), config.sync_retries)
+            finally:
+                db.close_connection()
+        return with_backoff(lambda: db.local_to_s3(raise_errors=True), config.sync_retries)
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except:
+        logger.warning("Giving up on uploading to S3: %s" % sys.exc_info()[1])
+        return False
+    finally:
+        db.s3_lease_release()
+        db.lock.release()
@@ -0,0 +1,184 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import logging
+import re
+
+# Words, parentheses, or a run of anything else up to whitespace/parens
+TOKEN_RE = re.compile(r'\s*(?:(\()|(\))|([^\s()]+))')
+KEYWORDS = ("AND", "OR", "NOT")
+
+
+class TagQueryError(ValueError):
+    pass
+
+
+class TagQuery(object):
+    ''' A boolean tag search like "action AND NOT (horror OR gore*)".
+
+    AND, OR and NOT (any case) with parentheses; tags next to each other
+    are ANDed, so the old space separated "all of" input still works, and a
+    trailing * matches every tag starting with the prefix.  NOT binds
+    tightest, then AND, then OR.  The parsed tree is compiled into a single
+    parameterized condition on media, with each tag looked up through the
+    tags.tag_name index and media_tags' (tag_id, media_id) key.
+    '''
+    def __init__(self, text=None, aliases=None, tree=None):
+        self.logger = logging.getLogger()
+        self.text = text
+        self.aliases = aliases or dict()
+        if tree is None:
+            self._tokens = self.tokenize(text or "")
+            self._pos = 0
+            if not self._tokens:
+                raise TagQueryError("Empty tag query")
+            tree = self._parse_or()
+            if self._pos < len(self._tokens):
+                raise TagQueryError("Unexpected %s in tag query" % self._tokens[self._pos])
+        self.tree = tree
+
+    @classmethod
+    def from_tags(cls, tags, tag_andor="and"):
+        # The old list of tags plus "and"/"or"
+        nodes = [ ("tag", tag) for tag in tags ]
+        if len(nodes) == 1:
+            return cls(tree=nodes[0])
+        return cls(tree=("or" if tag_andor == "or" else "and", nodes))
+
+    @staticmethod
+    def tokenize(text):
+        tokens = list()
+        pos = 0
+        text = text.rstrip()
+        while pos < len(text):
+            match = TOKEN_RE.match(text, pos)
+            if match.group(1):
+                tokens.append("(")
+            elif match.group(2):
+                tokens.append(")")
+            else:
+                tokens.append(match.group(3))
+            pos = match.end()
+        return tokens
+
+    def _peek(self):
+        return self._tokens[self._pos] if self._pos < len(self._tokens) else None
+
+    def _take(self):
+        token = self._peek()
+        self._pos += 1
+        return token
+
+    def _is_keyword(self, token, keyword):
+        return token is not None and token.upper() == keyword
+
+    def _parse_or(self):
+        nodes = [ self._parse_and() ]
+        while self._is_keyword(self._peek(), "OR"):
+            self._take()
+            nodes.append(self._parse_and())
+        return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+    def _parse_and(self):
+        nodes = [ self._parse_not() ]
+        while True:
+            token = self._peek()
+            if self._is_keyword(token, "AND"):
+                self._take()
+            elif token is None or token == ")" or self._is_keyword(token, "OR"):
+                break
+            # Anything else is an implicit AND
+            nodes.append(self._parse_not())
+        return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+    def _parse_not(self):
+        if self._is_keyword(self._peek(), "NOT"):
+            self._take()
+            return ("not", self._parse_not())
+        return self._parse_term()
+
+    def _parse_term(self):
+        token = self._take()
+        if token is None:
+            raise TagQueryError("Tag query ends too early")
+        if token == "(":
+            node = self._parse_or()
+            if self._take() != ")":
+                raise TagQueryError("Missing ) in tag query")
+            return node
+        if token == ")" or token.upper() in KEYWORDS:
+            raise TagQueryError("Expected a tag but got %s" % token)
+        token = self.aliases.get(token, token)
+        if token.endswith("*"):
+            prefix = token.rstrip("*")
+            if not prefix:
+                raise TagQueryError("A wildcard needs a prefix, e.g. sci*")
+            return ("prefix", prefix)
+        return ("tag", token)
+
+    def to_sql(self):
+        ''' Returns (sql, params) for a WHERE condition on media '''
+        params = list()
+        sql = self._compile(self.tree, params)
+        return (sql, params)
+
+    def _compile(self, node, params):
+        kind = node[0]
+        if kind == "tag":
+            params.append(node[1])
+            return '''media.media_id IN (SELECT mt.media_id FROM media_tags mt
+                      WHERE mt.tag_id = (SELECT tag_id FROM tags WHERE tag_name = ?))'''
+        if kind == "prefix":
+            # A range on tag_name can use its index, LIKE/GLOB wouldn't
+            prefix = node[1]
+            params.extend([ prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1) ])
+            return '''media.media_id IN (SELECT mt.media_id FROM media_tags mt
+                      WHERE mt.tag_id IN (SELECT tag_id FROM tags WHERE tag_name >= ? AND tag_name < ?))'''
+        if kind == "not":
+            return "NOT " + self._compile(node[1], params)
+        joiner = " AND " if kind == "and" else " OR "
+        return "(" + joiner.join(self._compile(child, params) for child in node[1]) + ")"
+
+    def terms(self, node=None):
+        ''' Returns the (tag names, prefixes) used in the query '''
+        node = self.tree if node is None else node
+        tags = list()
+        prefixes = list()
+        if node[0] == "tag":
+            tags.append(node[1])
+        elif node[0] == "prefix":
+            prefixes.append(node[1])
+        elif node[0] == "not":
+            (tags, prefixes) = self.terms(node[1])
+        else:
+            for child in node[1]:
+                (child_tags, child_prefixes) = self.terms(child)
+                tags.extend(child_tags)
+                prefixes.extend(child_prefixes)
+        return (tags, prefixes)
+
+    def unknown_terms(self, db):
+        ''' Tags and prefixes that don't match any tag in the db '''
+        (tags, prefixes) = self.terms()
+        unknown = list()
+        if tags:
+            placeholders = ",".join("?" for _ in tags)
+            known = set(row[0] for row in db.db_query_qmark_iterator(
+                '''SELECT tag_name FROM tags WHERE tag_name IN (''' + placeholders + ')', tuple(tags)))
+            unknown.extend(tag for tag in tags if tag not in known)
+        for prefix in prefixes:
+            found = db.db_query_qmark_iterator('''SELECT 1 FROM tags WHERE tag_name >= ? AND tag_name < ? LIMIT 1''',
+                                               (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))).fetchone()
+            if found is None:
+                unknown.append(prefix + "*")
+        return unknown
+
+    def __str__(self):
+        return self.text if self.text is not None else self._format(self.tree)
+
+    def _format(self, node):
+        if node[0] == "tag":
+            return node[1]
+        if node[0] == "prefix":
+            return node[1] + "*"
+        if node[0] == "not":
+            return "NOT " + self._format(node[1])
+        return "(" + (" %s " % node[0].upper()).join(self._format(child) for child in node[1]) + ")"
@@ -1,16 +1,79 @@
 from __future__ import (absolute_import, division, print_function, unicode_literals)
+from collections import defaultdict
+import contextlib
 import logging
+from . import profiling
+
+
+class TagIndex(object):
+    ''' In memory media_id <-> tag name index, loaded with a single query.
+
+    Tags objects given an index read from it and keep it up to date in
+    add_tag/remove_tag, so checking a media's tags costs no SQL.
+    '''
+    def __init__(self, db):
+        self.db = db
+        self.logger = logging.getLogger()
+        self.loaded = False
+        self.media_tags = defaultdict(set)
+        self.tag_media = defaultdict(set)
+
+    @profiling.timed("tag_index_load")
+    def load(self):
+        self.media_tags.clear()
+        self.tag_media.clear()
+        sql = '''SELECT mt.media_id, t.tag_name
+                 FROM media_tags mt, tags t
+                 WHERE t.tag_id = mt.tag_id'''
+        for (media_id, tag_name) in self.db.db_query_iterator(sql):
+            self.media_tags[media_id].add(tag_name)
+            self.tag_media[tag_name].add(media_id)
+        self.loaded = True
+        self.logger.debug("Loaded tag index: %s tagged media, %s tags" % (len(self.media_tags), len(self.tag_media)))
+
+    def tags_for(self, media_id):
+        return sorted(self.media_tags.get(media_id, ()))
+
+    def media_with(self, tag):
+        return self.tag_media.get(tag, set())
+
+    def has_any(self, media_id, tags):
+        media_tags = self.media_tags.get(media_id)
+        return media_tags is not None and not media_tags.isdisjoint(tags)
+
+    def add(self, media_id, tag):
+        self.media_tags[media_id].add(tag)
+        self.tag_media[tag].add(media_id)
+
+    def remove(self, media_id, tag):
+        self.media_tags.get(media_id, set()).discard(tag)
+        self.tag_media.get(tag, set()).discard(media_id)
+        if media_id in self.media_tags and not self.media_tags[media_id]:
+            del self.media_tags[media_id]
+        if tag in self.tag_media and not self.tag_media[tag]:
+            del self.tag_media[tag]
+
+    def remove_media(self, media_id):
+        for tag in self.media_tags.pop(media_id, set()):
+            self.tag_media.get(tag, set()).discard(media_id)
+            if tag in self.tag_media and not self.tag_media[tag]:
+                del self.tag_media[tag]
+
 
 class Tags(object):
-    def __init__(self, config, db, media_id):
+    def __init__(self, config, db, media_id, index=None):
         self.db = db
         self.config = config
         self.logger = logging.getLogger()
         self.media_id = media_id
+        self.index = index
         self.tags = []
         self.get_tags()
 
     def get_tags(self):
+        if self.index is not None and self.index.loaded:
+            self.tags = self.index.tags_for(self.media_id)
+            return
         sql = '''SELECT t.tag_name
                  FROM tags t, media_tags mt
                  WHERE t.tag_id = mt.tag_id
@@ -43,6 +106,8 @@ class Tags(object):
         (assoc_rowcount, assoc_lastrowid) = self.db.db_insert(insert_associate_sql, (tag, self.media_id))
         if assoc_rowcount == 1:
             self.logger.debug("Successfully tagged media")
+            if self.index is not None:
+                self.index.add(self.media_id, tag)
             return True
         else:
             self.logger.debug("Failed to tag media_id %s with tag %s" % (self.media_id, tag))
@@ -58,6 +123,8 @@ class Tags(object):
         (rm_rowcount, rm_lastrowid) = self.db.db_insert(remove_tag_sql, (self.media_id, tag))
         if rm_rowcount == 1:
             self.logger.warning("Removed tag %s from media" % tag)
+            if self.index is not None:
+                self.index.remove(self.media_id, tag)
         else:
             self.logger.warning("Unable to remove tag %s from media" % tag)
             return False
@@ -77,3 +144,171 @@ class Tags(object):
             else:
                 self.logger.warning("Failed to delete orphaned tag %s" % tag)
         return True
+
+
+class BulkTags(object):
+    ''' Tag changes across many media at once.
+
+    The media are either a list of media_ids or a condition on the media
+    table (e.g. a LibraryCursor's where and params, see
+    Library.current_selection); with neither, everything.  They're
+    gathered into a temp table and each operation is a few set based
+    statements in a single transaction, with one orphaned tag cleanup at
+    the end instead of a commit and a count per media.  The TagIndex is
+    updated once the transaction commits.  Each operation returns how
+    many media_tags rows it changed.
+    '''
+    def __init__(self, config, db, index=None):
+        self.config = config
+        self.db = db
+        self.index = index
+        self.logger = logging.getLogger()
+
+    def add(self, tag, media_ids=None, where=None, params=()):
+        tag = self._tag_name(tag)
+        with self._transaction():
+            selected = self._select(media_ids, where, params)
+            tag_id = self._tag_id(tag, create=True)
+            self.db.sqlite_cursor.execute('''INSERT OR IGNORE INTO media_tags (tag_id, media_id)
+                                             SELECT ?, media_id FROM temp.bulk_media''', (tag_id,))
+            changed = self.db.sqlite_cursor.rowcount
+            self._delete_orphans([ tag_id ])
+        if self._index_loaded():
+            for media_id in selected:
+                self.index.add(media_id, tag)
+        self.logger.warning("Tagged %s of %s media with %s" % (changed, len(selected), tag))
+        return changed
+
+    def remove(self, tag, media_ids=None, where=None, params=()):
+        tag = self._tag_name(tag)
+        with self._transaction():
+            selected = self._select(media_ids, where, params)
+            tag_id = self._tag_id(tag)
+            changed = 0
+            if tag_id is not None:
+                self.db.sqlite_cursor.execute('''DELETE FROM media_tags
+                                                 WHERE tag_id = ?
+                                                 AND media_id IN (SELECT media_id FROM temp.bulk_media)''', (tag_id,))
+                changed = self.db.sqlite_cursor.rowcount
+                self._delete_orphans([ tag_id ])
+        if self._index_loaded():
+            for media_id in selected:
+                self.index.remove(media_id, tag)
+        self.logger.warning("Removed %s from %s media" % (tag, changed))
+        return changed
+
+    def rename(self, old_tag, new_tag, media_ids=None, where=None, params=()):
+        # Renaming across everything is a merge, otherwise only the selected
+        # media swap old_tag for new_tag
+        if media_ids is None and where is None:
+            return self.merge([ old_tag ], new_tag)
+        (old_tag, new_tag) = (self._tag_name(old_tag), self._tag_name(new_tag))
+        if old_tag == new_tag:
+            return 0
+        with self._transaction():
+            self._select(media_ids, where, params)
+            old_id = self._tag_id(old_tag)
+            if old_id is None:
+                return 0
+            moved = [ row[0] for row in self.db.sqlite_cursor.execute(
+                '''SELECT media_id FROM media_tags
+                   WHERE tag_id = ? AND media_id IN (SELECT media_id FROM temp.bulk_media)''', (old_id,)).fetchall() ]
+            new_id = self._tag_id(new_tag, create=True)
+            self.db.sqlite_cursor.execute('''INSERT OR IGNORE INTO media_tags (tag_id, media_id)
+                                             SELECT ?, media_id FROM media_tags
+                                             WHERE tag_id = ? AND media_id IN (SELECT media_id FROM temp.bulk_media)''',
+                                          (new_id, old_id))
+            self.db.sqlite_cursor.execute('''DELETE FROM media_tags
+                                             WHERE tag_id = ? AND media_id IN (SELECT media_id FROM temp.bulk_media)''',
+                                          (old_id,))
+            self._delete_orphans([ old_id, new_id ])
+        if self._index_loaded():
+            for media_id in moved:
+                self.index.remove(media_id, old_tag)
+                self.index.add(media_id, new_tag)
+        self.logger.warning("Renamed %s to %s on %s media" % (old_tag, new_tag, len(moved)))
+        return len(moved)
+
+    def merge(self, source_tags, target_tag):
+        ''' Moves every media tagged with any of source_tags to target_tag and deletes the sources '''
+        target_tag = self._tag_name(target_tag)
+        source_tags = [ tag for tag in set(self._tag_name(tag) for tag in source_tags) if tag != target_tag ]
+        with self._transaction():
+            source_ids = dict((tag, self._tag_id(tag)) for tag in source_tags)
+            source_ids = dict((tag, tag_id) for (tag, tag_id) in source_ids.items() if tag_id is not None)
+            if not source_ids:
+                return 0
+            changed = self.db.sqlite_cursor.execute('''SELECT COUNT(*) FROM media_tags WHERE tag_id IN (%s)'''
+                                                    % ",".join("?" for _ in source_ids), tuple(source_ids.values())).fetchone()[0]
+            target_id = self._tag_id(target_tag)
+            if target_id is None and len(source_ids) == 1:
+                # Plain rename, the tag keeps its id and its media_tags rows
+                self.db.sqlite_cursor.execute('''UPDATE tags SET tag_name = ? WHERE tag_id = ?''',
+                                              (target_tag, list(source_ids.values())[0]))
+            else:
+                if target_id is None:
+                    target_id = self._tag_id(target_tag, create=True)
+                placeholders = ",".join("?" for _ in source_ids)
+                self.db.sqlite_cursor.execute('''INSERT OR IGNORE INTO media_tags (tag_id, media_id)
+                                                 SELECT ?, media_id FROM media_tags WHERE tag_id IN (%s)''' % placeholders,
+                                              (target_id,) + tuple(source_ids.values()))
+                self.db.sqlite_cursor.execute('''DELETE FROM media_tags WHERE tag_id IN (%s)''' % placeholders,
+                                              tuple(source_ids.values()))
+                self._delete_orphans(list(source_ids.values()))
+        if self._index_loaded():
+            for tag in source_ids:
+                for media_id in list(self.index.media_with(tag)):
+                    self.index.remove(media_id, tag)
+                    self.index.add(media_id, target_tag)
+        self.logger.warning("Merged %s into %s (%s media tags)" % (", ".join(sorted(source_ids)), target_tag, changed))
+        return changed
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        if self.db.sqlite_conn.in_transaction:
+            self.db.sqlite_conn.commit()
+        self.db.sqlite_cursor.execute('''BEGIN''')
+        try:
+            yield
+            self.db.sqlite_conn.commit()
+        except:
+            self.db.sqlite_conn.rollback()
+            raise
+
+    def _select(self, media_ids, where, params):
+        # Fills temp.bulk_media with the selection, returns its media_ids
+        self.db.sqlite_cursor.execute('''CREATE TEMP TABLE IF NOT EXISTS bulk_media (media_id INTEGER PRIMARY KEY)''')
+        self.db.sqlite_cursor.execute('''DELETE FROM temp.bulk_media''')
+        if media_ids is not None:
+            self.db.sqlite_cursor.executemany('''INSERT OR IGNORE INTO temp.bulk_media (media_id) VALUES (?)''',
+                                              [ (media_id,) for media_id in media_ids ])
+        else:
+            sql = '''INSERT INTO temp.bulk_media (media_id) SELECT media_id FROM media'''
+            if where:
+                sql += " WHERE " + where
+            self.db.sqlite_cursor.execute(sql, tuple(params))
+        return [ row[0] for row in self.db.sqlite_cursor.execute('''SELECT media_id FROM temp.bulk_media''').fetchall() ]
+
+    def _tag_id(self, tag, create=False):
+        if create:
+            self.db.sqlite_cursor.execute('''INSERT OR IGNORE INTO tags (tag_name) VALUES (?)''', (tag,))
+        row = self.db.sqlite_cursor.execute('''SELECT tag_id FROM tags WHERE tag_name = ?''', (tag,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _delete_orphans(self, tag_ids):
+        self.db.sqlite_cursor.execute('''DELETE FROM tags
+                                         WHERE tag_id IN (%s)
+                                         AND NOT EXISTS (SELECT 1 FROM media_tags mt WHERE mt.tag_id = tags.tag_id)'''
+                                      % ",".join("?" for _ in tag_ids), tuple(tag_ids))
+        if self.db.sqlite_cursor.rowcount > 0:
+            self.logger.warning("Deleted %s orphaned tags" % self.db.sqlite_cursor.rowcount)
+
+    def _index_loaded(self):
+        return self.index is not None and self.index.loaded
+
+    @staticmethod
+    def _tag_name(tag):
+        tag = (tag or "").strip()
+        if not tag:
+            raise ValueError("Tag names can't be empty")
+        return tag
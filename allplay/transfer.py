@@ -0,0 +1,72 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import gzip
+import hashlib
+import os
+import shutil
+import threading
+
+# One S3 client per profile for the whole process, see client()
+_clients = dict()
+_clients_lock = threading.Lock()
+
+
+def client(profile=None):
+    ''' The S3 client for an AWS profile, created the first time it's needed.
+
+    Building a session reads the credentials and config files and a client
+    loads the service model, which adds up when every sync, lease check
+    and menu action makes its own.  Clients are thread safe, so the one
+    client is shared by everything in the process.  boto3 is imported here
+    rather than with the module, it's slow to import and only needed once
+    S3 is actually used.
+    '''
+    with _clients_lock:
+        s3 = _clients.get(profile)
+        if s3 is None:
+            import boto3
+            s3 = _clients[profile] = boto3.session.Session(profile_name=profile).client("s3")
+        return s3
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for block in iter(lambda: source.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def compress_file(source_path, target_path):
+    # sqlite files are mostly index and text pages, they compress 3-5x
+    with open(source_path, "rb") as source, gzip.open(target_path, "wb", compresslevel=6) as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+
+
+def decompress_file(source_path, target_path):
+    with gzip.open(source_path, "rb") as source, open(target_path, "wb") as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+
+
+def upload_compressed(upload, path):
+    # upload(gz_path) sends a gzipped copy of the file at path, made next to it
+    gz_path = path + ".gz"
+    try:
+        compress_file(path, gz_path)
+        upload(gz_path)
+    finally:
+        if os.path.exists(gz_path):
+            os.unlink(gz_path)
+
+
+def download_compressed(download, path, sha256=None):
+    # download(gz_path) fetches a gzipped file, which is unpacked to path
+    # and checked against sha256 if given
+    gz_path = path + ".gz"
+    try:
+        download(gz_path)
+        decompress_file(gz_path, path)
+    finally:
+        if os.path.exists(gz_path):
+            os.unlink(gz_path)
+    if sha256 is not None and sha256_file(path) != sha256:
+        raise ValueError("%s does not match its sha256, the download is damaged" % path)
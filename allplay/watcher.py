@@ -0,0 +1,268 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+# inotify(7) constants
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+IN_WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# Filesystems where inotify only sees changes made by this machine
+POLL_FILESYSTEMS = ("nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "afs", "ceph", "glusterfs", "davfs",
+                    "fuse.sshfs", "fuse.rclone", "fuse.s3fs", "fuse.glusterfs")
+
+
+class WatchEvent(object):
+    ''' A change to the top level of a media source.
+
+    action is one of "create", "delete" or "rename".  For renames
+    new_mount_alias/new_path hold the destination, which may be under a
+    different media source.
+    '''
+    def __init__(self, action, mount_alias, path, new_mount_alias=None, new_path=None):
+        self.action = action
+        self.mount_alias = mount_alias
+        self.path = path
+        self.new_mount_alias = new_mount_alias
+        self.new_path = new_path
+        self.time = time.time()
+
+    def __repr__(self):
+        if self.action == "rename":
+            return "WatchEvent(rename %s:%s -> %s:%s)" % (self.mount_alias, self.path, self.new_mount_alias, self.new_path)
+        return "WatchEvent(%s %s:%s)" % (self.action, self.mount_alias, self.path)
+
+
+class Watcher(object):
+    ''' Feeds create/delete/rename events for each media source into a queue.
+
+    Media entries are always top level names under a media source, so only
+    the top level of each source is watched.  Local filesystems use
+    inotify; network filesystems (and anything listed in
+    watch_poll_sources, or everything when inotify is unavailable) are
+    polled every watch_poll_interval seconds instead.  Events are consumed
+    from the main thread with pending_events(), which holds back creates
+    until they have settled for watch_settle_seconds so a directory that is
+    still being copied isn't classified as non media.
+    '''
+    def __init__(self, config):
+        self.config = config
+        self.logger = logging.getLogger()
+        self._lock = threading.Lock()
+        self._events = list()
+        self._stop = threading.Event()
+        self._threads = list()
+        self._inotify_fd = None
+        self._wakeup = None
+        self._watches = {}
+
+    def start(self):
+        poll_sources = dict()
+        inotify_sources = dict()
+        for path_alias, path in self.config.media_sources.items():
+            if path_alias in self.config.watch_poll_sources or self.mount_fstype(path) in POLL_FILESYSTEMS:
+                poll_sources[path_alias] = path
+            else:
+                inotify_sources[path_alias] = path
+        if inotify_sources:
+            try:
+                self._inotify_start(inotify_sources)
+            except OSError as err:
+                self.logger.warning("inotify unavailable, polling media sources instead: %s" % err)
+                poll_sources.update(inotify_sources)
+        for path_alias, path in poll_sources.items():
+            self.logger.debug("Polling %s (%s) every %ss" % (path_alias, path, self.config.watch_poll_interval))
+            self._spawn(self._poll_loop, path_alias, path)
+
+    def stop(self):
+        self._stop.set()
+        if self._wakeup is not None:
+            os.write(self._wakeup[1], b"x")
+        for thread in self._threads:
+            thread.join(timeout=5)
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+        if self._wakeup is not None:
+            for fd in self._wakeup:
+                os.close(fd)
+            self._wakeup = None
+
+    def pending_events(self, settle_seconds=None):
+        ''' Returns the events that are ready to apply, oldest first. '''
+        if settle_seconds is None:
+            settle_seconds = self.config.watch_settle_seconds
+        now = time.time()
+        with self._lock:
+            ready = list()
+            held = list()
+            for event in self._events:
+                if event.action == "create" and now - event.time < settle_seconds:
+                    held.append(event)
+                else:
+                    ready.append(event)
+            self._events = held
+        return ready
+
+    def _queue(self, event):
+        self.logger.debug("Queued %r" % event)
+        with self._lock:
+            if event.action == "create":
+                # A fresh write restarts the settle timer
+                self._events = [ queued for queued in self._events
+                                 if not (queued.action == "create"
+                                         and queued.mount_alias == event.mount_alias
+                                         and queued.path == event.path) ]
+            self._events.append(event)
+
+    def _spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    @staticmethod
+    def mount_fstype(path):
+        ''' Returns the filesystem type of the mount holding path, or None. '''
+        try:
+            with open("/proc/self/mounts") as mounts:
+                mount_table = [ line.split() for line in mounts ]
+        except (IOError, OSError):
+            return None
+        real_path = os.path.realpath(path)
+        best_match = ""
+        fstype = None
+        for fields in mount_table:
+            if len(fields) < 3:
+                continue
+            mount_point = fields[1].replace("\\040", " ")
+            prefix = mount_point.rstrip("/") + "/"
+            if (real_path == mount_point or real_path.startswith(prefix)) and len(mount_point) > len(best_match):
+                best_match = mount_point
+                fstype = fields[2]
+        return fstype
+
+    def _inotify_start(self, sources):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        for path_alias, path in sources.items():
+            wd = libc.inotify_add_watch(fd, os.fsencode(path), IN_WATCH_MASK | IN_ONLYDIR)
+            if wd < 0:
+                err = ctypes.get_errno()
+                self.logger.warning("Cannot watch %s, polling it instead: %s" % (path, os.strerror(err)))
+                self._spawn(self._poll_loop, path_alias, path)
+                continue
+            self._watches[wd] = (path_alias, path)
+        if not self._watches:
+            os.close(fd)
+            return
+        self._inotify_fd = fd
+        self._wakeup = os.pipe()
+        self._spawn(self._inotify_loop)
+
+    def _inotify_loop(self):
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self._inotify_fd, self._wakeup[0]], [], [])
+            if self._inotify_fd not in readable:
+                continue
+            try:
+                buf = os.read(self._inotify_fd, 64 * 1024)
+            except OSError as err:
+                self.logger.warning("Error reading inotify events: %s" % err)
+                return
+            self._inotify_dispatch(buf)
+
+    def _inotify_dispatch(self, buf):
+        moved_from = dict()
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, name_len = INOTIFY_EVENT.unpack_from(buf, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(buf[offset:offset + name_len].rstrip(b"\0"))
+            offset += name_len
+            if mask & IN_Q_OVERFLOW:
+                self.logger.warning("inotify queue overflowed, some changes will only be found by a rescan")
+                continue
+            if wd not in self._watches or mask & IN_IGNORED:
+                continue
+            path_alias, path = self._watches[wd]
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                self.logger.warning("Media source %s (%s) went away, no longer watching it" % (path_alias, path))
+                continue
+            if name.startswith('.'):
+                continue
+            if mask & IN_CREATE:
+                self._queue(WatchEvent("create", path_alias, name))
+            elif mask & IN_DELETE:
+                self._queue(WatchEvent("delete", path_alias, name))
+            elif mask & IN_MOVED_FROM:
+                moved_from[cookie] = (path_alias, name)
+            elif mask & IN_MOVED_TO:
+                if cookie in moved_from:
+                    (old_alias, old_name) = moved_from.pop(cookie)
+                    self._queue(WatchEvent("rename", old_alias, old_name, path_alias, name))
+                else:
+                    # Moved in from outside the media sources
+                    self._queue(WatchEvent("create", path_alias, name))
+        # Moved out of the media sources
+        for (path_alias, name) in moved_from.values():
+            self._queue(WatchEvent("delete", path_alias, name))
+
+    def _list_source(self, path):
+        # Inode plus mtime identifies an entry across a rename; the inode
+        # alone can be reused by something created right after a delete.
+        entries = dict()
+        for entry in os.scandir(path):
+            if not entry.name.startswith('.'):
+                entries[entry.name] = (entry.inode(), entry.stat(follow_symlinks=False).st_mtime_ns)
+        return entries
+
+    def _poll_loop(self, path_alias, path):
+        try:
+            last_mtime = os.stat(path).st_mtime_ns
+            known = self._list_source(path)
+        except OSError as err:
+            self.logger.warning("Cannot poll %s: %s" % (path, err))
+            return
+        while not self._stop.wait(self.config.watch_poll_interval):
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                if mtime == last_mtime:
+                    continue
+                current = self._list_source(path)
+            except OSError as err:
+                self.logger.warning("Error polling %s: %s" % (path, err))
+                continue
+            last_mtime = mtime
+            removed = dict((known[name], name) for name in set(known) - set(current))
+            for name in sorted(set(current) - set(known)):
+                if current[name] in removed:
+                    # Same entry under a new name
+                    self._queue(WatchEvent("rename", path_alias, removed.pop(current[name]), path_alias, name))
+                else:
+                    self._queue(WatchEvent("create", path_alias, name))
+            for name in removed.values():
+                self._queue(WatchEvent("delete", path_alias, name))
+            known = current
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+''' Compare the memory used by the old dict based library layout against
+allplay.store.LibraryStore for a synthetic set of rows.
+
+    python benchmarks/library_memory.py --entries 200000
+'''
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import argparse
+from collections import defaultdict
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from allplay.store import LibraryStore
+
+
+def synthetic_rows(entries, aliases):
+    for media_id in range(1, entries + 1):
+        yield (media_id,
+               aliases[media_id % len(aliases)],
+               "Some.Show.S%02dE%02d.1080p.WEB-DL.x264-GROUP.%07d.mkv" % (media_id % 20, media_id % 30, media_id),
+               "2024-01-%02d 12:34:56.789012" % (media_id % 28 + 1),
+               media_id % 7,
+               media_id * 1048576)
+
+
+def load_dict_layout(rows, media_sources):
+    # The layout Library used before LibraryStore
+    library = defaultdict()
+    library_list = []
+    for (media_id, mount_alias, path, mtime, times_played, media_size) in rows:
+        full_path = os.path.join(media_sources[mount_alias], path)
+        library_list.append(full_path)
+        library[full_path] = { "media_id": media_id,
+                               "mount_alias": mount_alias,
+                               "path": path,
+                               "mtime": mtime,
+                               "times_played": times_played,
+                               "media_size": media_size
+                             }
+    return (library, library_list)
+
+
+def load_store(rows, media_sources):
+    library = LibraryStore()
+    library.set_sources(media_sources)
+    for row in rows:
+        library.add(*row)
+    return library
+
+
+def measure(loader, entries, media_sources):
+    # Rows are materialized first so only the library structure is measured
+    rows = list(synthetic_rows(entries, sorted(media_sources)))
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    library = loader(rows, media_sources)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del library
+    return after - before
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Library memory benchmark")
+    parser.add_argument('--entries', type=int, default=100000, help='Number of synthetic library rows')
+    parser.add_argument('--json', action='store_true', help='Print machine readable results')
+    args = parser.parse_args()
+    media_sources = { "media1": "/mnt/nas/media1", "media2": "/mnt/nas/media2", "ex": "/home/user/example" }
+    results = { "entries": args.entries,
+                "dict_bytes": measure(load_dict_layout, args.entries, media_sources),
+                "store_bytes": measure(load_store, args.entries, media_sources) }
+    results["ratio"] = round(results["dict_bytes"] / float(results["store_bytes"]), 2)
+    if args.json:
+        print(json.dumps(results))
+    else:
+        print("entries:      %s" % results["entries"])
+        print("dict layout:  %.1f MB (%s bytes/entry)" % (results["dict_bytes"] / 1048576.0, results["dict_bytes"] // args.entries))
+        print("LibraryStore: %.1f MB (%s bytes/entry)" % (results["store_bytes"] / 1048576.0, results["store_bytes"] // args.entries))
+        print("ratio:        %sx" % results["ratio"])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+''' Time from launching allplay to its first "Media X of Y" line.
+
+Writes a synthetic library's database (see synthetic.py) and a config into
+a temporary HOME, then runs python -m allplay there a few times, killing
+it as soon as the first media line shows up.  The media files themselves
+aren't needed, allplay has already printed the line by the time it looks
+for them.  It also checks that importing allplay doesn't load any of the
+modules that are only meant to be imported when they're used.
+
+Exits with status 1 when the median startup is over --budget seconds or a
+lazy module got imported, so it can guard against startup regressions.
+
+    python benchmarks/startup.py --entries 10000 --budget 0.5
+    python benchmarks/startup.py --entries 100000 --runs 9 --json startup.json
+'''
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import argparse
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from synthetic import SyntheticLibrary
+from allplay.database import Database
+
+NON_MEDIA_TAG = "non.media"
+PACKAGE_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+MEDIA_LINE = re.compile(r"^Media \d+ of \d+")
+# Only imported on the paths that need them, never by a plain start
+LAZY_MODULES = ("boto3", "botocore", "tzlocal", "numpy")
+
+
+def write_home(home, synthetic):
+    # A HOME with .allplay/config and the library's db, returns the db path
+    config_dir = os.path.join(home, ".allplay")
+    os.makedirs(config_dir)
+    media_sources = synthetic.media_sources(os.path.join(home, "tree"))
+    for path in media_sources.values():
+        os.makedirs(path)
+    local_database = os.path.join(config_dir, "allplay.sqlite3")
+    with open(os.path.join(config_dir, "config"), "w") as config_file:
+        config_file.write("media_sources:\n")
+        for (mount_alias, path) in sorted(media_sources.items()):
+            config_file.write("  %s: %s\n" % (mount_alias, path))
+        config_file.write("local_database: %s\n" % local_database)
+        config_file.write("media_extensions: [mkv, mp4, avi]\n")
+        config_file.write("non_media_tag: %s\n" % NON_MEDIA_TAG)
+        config_file.write("default_exclusion_tags: [%s]\n" % NON_MEDIA_TAG)
+        # Startup rescans once the db is older than this, keep it out of the timing
+        config_file.write("local_scan_delay: 315360000\n")
+        config_file.write("media_handler: true\n")
+    with Database(local_database) as db:
+        db.s3_sync_toggle(enable=False)
+        synthetic.build_db(db, NON_MEDIA_TAG)
+        synthetic.add_tags(db)
+    return local_database
+
+
+def time_to_first_media(home, timeout):
+    # Seconds until allplay prints its first media line, None if it never does
+    env = dict(os.environ, HOME=home)
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "allplay"], cwd=PACKAGE_ROOT, env=env,
+                               stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               universal_newlines=True)
+    timer = threading.Timer(timeout, process.kill)
+    timer.start()
+    elapsed = None
+    try:
+        for line in process.stdout:
+            if MEDIA_LINE.match(line):
+                elapsed = time.perf_counter() - start
+                break
+            logging.getLogger().debug(line.rstrip())
+    finally:
+        timer.cancel()
+        process.kill()
+        process.wait()
+        process.stdout.close()
+    return elapsed
+
+
+def lazy_modules_imported():
+    # Which of LAZY_MODULES a bare import of allplay pulls in
+    code = "import sys, allplay.allplay; print(' '.join(m for m in %r if m in sys.modules))" % (LAZY_MODULES,)
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=PACKAGE_ROOT, universal_newlines=True)
+    return output.split()
+
+
+def median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    return ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description="allplay startup time")
+    parser.add_argument('--entries', type=int, default=10000, help='Top level media entries (default 10000)')
+    parser.add_argument('--mounts', type=int, default=2, help='Media sources to spread them over')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--runs', type=int, default=5, help='Timed launches, the median is checked (default 5)')
+    parser.add_argument('--budget', type=float, default=0.5,
+                        help='Fail when the median time to the first media line is over this many seconds (default 0.5)')
+    parser.add_argument('--timeout', type=float, default=60, help='Give up on a launch after this many seconds')
+    parser.add_argument('--keep', action='store_true', help='Keep the temp HOME')
+    parser.add_argument('--json', help='Write results as JSON to this file, - for stdout')
+    parser.add_argument('-v', '--verbose', action='store_true', help="Show allplay's output up to the media line")
+    args = parser.parse_args()
+    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG if args.verbose else logging.ERROR, format='%(message)s')
+
+    synthetic = SyntheticLibrary(entries=args.entries, mounts=args.mounts, seed=args.seed)
+    home = tempfile.mkdtemp(prefix="allplay-startup-")
+    try:
+        write_home(home, synthetic)
+        # Untimed, so the timed runs all start with compiled bytecode and a warm page cache
+        time_to_first_media(home, args.timeout)
+        times = list()
+        for run in range(args.runs):
+            elapsed = time_to_first_media(home, args.timeout)
+            if elapsed is None:
+                print("allplay never printed a media line, run with -v to see its output")
+                return 1
+            times.append(elapsed)
+            print("run %d: %.3fs" % (run + 1, elapsed))
+        imported = lazy_modules_imported()
+    finally:
+        if not args.keep:
+            shutil.rmtree(home, ignore_errors=True)
+        else:
+            print("Kept %s" % home)
+
+    result = { "entries": args.entries, "runs": [ round(elapsed, 6) for elapsed in times ],
+               "median": round(median(times), 6), "min": round(min(times), 6), "budget": args.budget,
+               "lazy_modules_imported": imported }
+    print("Median %.3fs, best %.3fs, budget %.3fs" % (result["median"], result["min"], args.budget))
+    if args.json:
+        if args.json == "-":
+            print(json.dumps(result, indent=2, sort_keys=True))
+        else:
+            with open(args.json, "w") as json_file:
+                json.dump(result, json_file, indent=2, sort_keys=True)
+    failed = False
+    if imported:
+        print("FAIL: importing allplay loads %s, they should only be imported where they're used" % ", ".join(imported))
+        failed = True
+    if result["median"] > args.budget:
+        print("FAIL: startup is over budget by %.3fs" % (result["median"] - args.budget))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
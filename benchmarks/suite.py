@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+''' Time allplay's scan, load, search and tag paths against a synthetic library.
+
+Builds a synthetic media tree (see synthetic.py) and runs the real Library
+code over it: the cold and unchanged rescans, ingest, media sizes, every
+populate_from_db* mode iterated to the end, tag searches, tag add/remove
+and the main loop's skip checks.  --db-only skips the filesystem and
+writes the rows straight into the database, which is the practical way to
+look at 1M entries.  Results can be written as JSON and compared against
+an earlier run.
+
+    python benchmarks/suite.py --entries 10000 --json before.json
+    python benchmarks/suite.py --entries 10000 --compare before.json
+    python benchmarks/suite.py --entries 1000000 --db-only
+'''
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import argparse
+import contextlib
+import gc
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from synthetic import SyntheticLibrary
+from allplay.config import Config
+from allplay.database import Database
+from allplay.library import Library
+from allplay.media import Media
+from allplay.tagquery import TagQuery
+from allplay.tags import Tags
+import allplay.sampler
+
+NON_MEDIA_TAG = "non.media"
+
+
+class Suite(object):
+    def __init__(self, args):
+        self.args = args
+        self.results = dict()
+        self.logger = logging.getLogger()
+
+    def timed(self, name, func, items=None):
+        # func returns the number of items it handled unless items is given
+        gc.collect()
+        start = time.perf_counter()
+        handled = func()
+        elapsed = time.perf_counter() - start
+        if items is None:
+            items = handled
+        result = { "seconds": round(elapsed, 6), "items": items }
+        if items:
+            result["us_per_item"] = round(elapsed / items * 1e6, 3)
+        self.results[name] = result
+        print("%-28s %10.3fs %10s items %12s us/item" % (name, elapsed, items, result.get("us_per_item", "-")))
+        return handled
+
+    def write_config(self, workdir, media_sources):
+        config_path = os.path.join(workdir, "config")
+        with open(config_path, "w") as config_file:
+            config_file.write("media_sources:\n")
+            for (mount_alias, path) in sorted(media_sources.items()):
+                config_file.write("  %s: %s\n" % (mount_alias, path))
+            config_file.write("local_database: %s\n" % os.path.join(workdir, "allplay.sqlite3"))
+            config_file.write("media_extensions: [mkv, mp4, avi]\n")
+            config_file.write("non_media_tag: %s\n" % NON_MEDIA_TAG)
+            config_file.write("default_exclusion_tags: [%s]\n" % NON_MEDIA_TAG)
+            config_file.write("scan_workers: %d\n" % self.args.scan_workers)
+            config_file.write("library_page_size: %d\n" % self.args.page_size)
+        return Config(config_path)
+
+    def run(self):
+        synthetic = SyntheticLibrary(entries=self.args.entries, mounts=self.args.mounts, dir_ratio=self.args.dir_ratio,
+                                     non_media_ratio=self.args.non_media_ratio, breadth=self.args.breadth,
+                                     depth=self.args.depth, files_per_dir=self.args.files_per_dir, seed=self.args.seed)
+        workdir = self.args.workdir or tempfile.mkdtemp(prefix="allplay-bench-")
+        os.makedirs(workdir, exist_ok=True)
+        try:
+            media_sources = synthetic.media_sources(os.path.join(workdir, "tree"))
+            if not self.args.db_only:
+                start = time.perf_counter()
+                synthetic.build_tree(os.path.join(workdir, "tree"))
+                print("Built the synthetic tree in %.1fs" % (time.perf_counter() - start))
+            else:
+                for path in media_sources.values():
+                    os.makedirs(path, exist_ok=True)
+            config = self.write_config(workdir, media_sources)
+            if os.path.exists(config.local_database):
+                os.unlink(config.local_database)
+            with Database(config.local_database) as db:
+                db.s3_sync_toggle(enable=False)
+                lib = Library(db)
+                if self.args.db_only:
+                    self.timed("db_generate", lambda: synthetic.build_db(db, NON_MEDIA_TAG), items=self.args.entries)
+                else:
+                    self.filesystem_benchmarks(config, db, lib)
+                synthetic.add_tags(db)
+                self.db_benchmarks(config, db, lib)
+                if not self.args.db_only:
+                    self.media_benchmarks(config, db, lib)
+            return self.report(synthetic, db)
+        finally:
+            if not self.args.keep and not self.args.workdir:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    def filesystem_benchmarks(self, config, db, lib):
+        def scan():
+            lib.scan_sources(config)
+            return len(lib.library_scanned) + len(lib.library_non_media)
+        self.timed("scan_cold", scan, items=self.args.entries)
+        self.timed("ingest", lambda: lib.scanned_to_library_and_db(config)["inserted"])
+        missing = db.db_query_iterator('''SELECT COUNT(*) FROM media WHERE media_size IS NULL''').fetchone()[0]
+        self.timed("update_missing_sizes", lambda: lib.update_missing_sizes(config), items=missing)
+        self.timed("scan_unchanged", scan, items=self.args.entries)
+        lib.scanned_to_library_and_db(config)
+
+    def iterate(self, lib):
+        count = 0
+        for full_path in lib.cursor:
+            count += 1
+            lib.cursor.release(full_path)
+        return count
+
+    def db_benchmarks(self, config, db, lib):
+        exclude = config.default_exclusion_tags
+        self.timed("tag_index_load", lambda: lib.tag_index.load() or len(lib.tag_index.media_tags))
+
+        def populate():
+            lib.populate_from_db(config, exclude_tags=exclude)
+            return self.iterate(lib)
+        self.timed("populate_random", populate)
+        for (sort_by, desc) in (("times_played", False), ("mtime", True), ("media_size", True)):
+            def populate_sort():
+                lib.populate_from_db_sort(config, sort_by=sort_by, desc=desc, exclude_tags=exclude)
+                return self.iterate(lib)
+            self.timed("populate_sort_%s" % sort_by, populate_sort)
+
+        def populate_weighted():
+            config.random_weights = { "times_played": 1, "recent": 2, "tags": { "favorite": 3 } }
+            try:
+                lib.populate_from_db(config, exclude_tags=exclude)
+                return self.iterate(lib)
+            finally:
+                config.random_weights = dict()
+        self.timed("populate_weighted", populate_weighted)
+
+        searches = (("search_strings", dict(search_strings=["expanse", "doctor.who"])),
+                    ("search_strings_and", dict(search_strings=["star", "1080p"], search_strings_andor="and")),
+                    ("search_ranked", dict(search_strings=["planet", "earth"], ranked=True)),
+                    ("search_tags_all", dict(tags=["scifi", "action"])),
+                    ("search_tags_any", dict(tags=["scifi", "action"], tag_andor="or")),
+                    ("search_tag_query", dict(tag_query=TagQuery("(scifi OR sci*) AND NOT horror"))))
+        for (name, kwargs) in searches:
+            def search():
+                lib.populate_from_db_search(config, exclude_tags=exclude, **kwargs)
+                return self.iterate(lib)
+            self.timed(name, search)
+
+        media_ids = [ row[0] for row in db.db_query_qmark_iterator('''SELECT media_id FROM media ORDER BY media_id LIMIT ?''',
+                                                                   (self.args.tag_ops,)) ]
+
+        def tag_add():
+            for media_id in media_ids:
+                Tags(config, db, media_id, lib.tag_index).add_tag("benchmark")
+            return len(media_ids)
+
+        def tag_remove():
+            # remove_tag prints the tag's remaining media count
+            with contextlib.redirect_stdout(io.StringIO()):
+                for media_id in media_ids:
+                    Tags(config, db, media_id, lib.tag_index).remove_tag("benchmark")
+            return len(media_ids)
+        self.timed("tag_add", tag_add)
+        self.timed("tag_remove", tag_remove)
+
+        def skip_path():
+            # The checks the main loop makes before building a Media, with a
+            # tag excluded in Python on top of the SQL exclusion
+            skip_tags = list(exclude) + [ "horror" ]
+            lib.populate_from_db(config, exclude_tags=exclude)
+            checked = 0
+            for full_path in lib.cursor:
+                checked += 1
+                if full_path in lib.library:
+                    lib.tag_index.has_any(lib.library[full_path]["media_id"], skip_tags)
+                lib.cursor.release(full_path)
+            return checked
+        self.timed("main_loop_skip", skip_path)
+
+    def media_benchmarks(self, config, db, lib):
+        def build_media():
+            lib.populate_from_db_sort(config, sort_by="mtime", desc=True, exclude_tags=config.default_exclusion_tags)
+            built = 0
+            for full_path in lib.cursor:
+                if built >= self.args.media_builds:
+                    break
+                Media(config, lib, db, full_path)
+                lib.cursor.release(full_path)
+                built += 1
+            return built
+        self.timed("media_build_cold", build_media)
+        self.timed("media_build_cached", build_media)
+
+    def report(self, synthetic, db):
+        try:
+            revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                      cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+        except OSError:
+            revision = None
+        report = { "meta": { "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                             "revision": revision,
+                             "python": platform.python_version(),
+                             "sqlite": sqlite3.sqlite_version,
+                             "platform": platform.platform(),
+                             "fts5": db.fts5_enabled,
+                             "numpy": allplay.sampler.numpy_for(allplay.sampler.NUMPY_MIN_SIZE) is not None,
+                             "db_only": self.args.db_only,
+                             "library": synthetic.settings() },
+                   "results": self.results }
+        if self.args.json:
+            if self.args.json == "-":
+                print(json.dumps(report, indent=2, sort_keys=True))
+            else:
+                with open(self.args.json, "w") as json_file:
+                    json.dump(report, json_file, indent=2, sort_keys=True)
+        if self.args.compare:
+            compare(self.args.compare, report)
+        return report
+
+
+def compare(base_path, report):
+    with open(base_path) as base_file:
+        base = json.load(base_file)
+    print("\nCompared with %s (revision %s):" % (base_path, base["meta"].get("revision")))
+    for (name, result) in sorted(report["results"].items()):
+        before = base["results"].get(name)
+        if before is None or not before["seconds"]:
+            print("%-28s %10.3fs      (new)" % (name, result["seconds"]))
+            continue
+        print("%-28s %10.3fs -> %10.3fs  %6.2fx" % (name, before["seconds"], result["seconds"],
+                                                   result["seconds"] / before["seconds"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="allplay benchmark suite")
+    parser.add_argument('--entries', type=int, default=10000, help='Top level media entries (default 10000)')
+    parser.add_argument('--mounts', type=int, default=2, help='Media sources to spread them over')
+    parser.add_argument('--dir-ratio', type=float, default=0.5, help='Fraction of entries that are directories')
+    parser.add_argument('--non-media-ratio', type=float, default=0.05, help='Fraction of directories with no media')
+    parser.add_argument('--breadth', type=int, default=2, help='Subdirectories per level in directory entries')
+    parser.add_argument('--depth', type=int, default=1, help='Subdirectory levels in directory entries')
+    parser.add_argument('--files-per-dir', type=int, default=4, help='Media files in each directory')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--scan-workers', type=int, default=8)
+    parser.add_argument('--page-size', type=int, default=500, help='library_page_size')
+    parser.add_argument('--tag-ops', type=int, default=1000, help='Media to add and remove a tag on')
+    parser.add_argument('--media-builds', type=int, default=200, help='Media objects to build')
+    parser.add_argument('--db-only', action='store_true', help='Skip the filesystem, generate the db directly')
+    parser.add_argument('--workdir', help='Build the tree and db here and keep them (default a temp dir)')
+    parser.add_argument('--keep', action='store_true', help='Keep the temp dir')
+    parser.add_argument('--json', help='Write results as JSON to this file, - for stdout')
+    parser.add_argument('--compare', metavar='JSON', help='Compare against results from an earlier --json run')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG if args.verbose else logging.ERROR, format='%(message)s')
+    Suite(args).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+''' Synthetic media libraries for the benchmarks.
+
+A SyntheticLibrary describes a set of top level media entries spread over
+a few media sources: single files, directories of media (nested to depth,
+with breadth subdirectories per level and files_per_dir media files in
+each) and non media directories.  The same description can be written out
+as a real tree, as a matching allplay database, or both.  Everything is
+driven by seed, so two runs with the same arguments build the same library.
+'''
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+SHOWS = ("Star.Trek", "The.Expanse", "Doctor.Who", "Planet_Earth", "Some-Documentary", "Movie.Night",
+         "Cooking.Show", "Nature.Walks", "Space.Race", "Old.Westerns", "Anime_Collection", "Home-Videos")
+TAGS = ("favorite", "action", "comedy", "drama", "horror", "scifi", "scifantasy", "documentary",
+        "kids", "anime", "western", "romance", "watched", "rewatch", "4k", "hdr")
+MB = 1048576
+
+
+class SyntheticLibrary(object):
+    def __init__(self, entries=10000, mounts=2, dir_ratio=0.5, non_media_ratio=0.05, breadth=2, depth=1,
+                 files_per_dir=4, tagged_ratio=0.5, seed=1):
+        self.entries = entries
+        self.mounts = mounts
+        self.dir_ratio = dir_ratio
+        self.non_media_ratio = non_media_ratio
+        self.breadth = breadth
+        self.depth = depth
+        self.files_per_dir = files_per_dir
+        self.tagged_ratio = tagged_ratio
+        self.seed = seed
+
+    def settings(self):
+        return dict((key, getattr(self, key)) for key in ("entries", "mounts", "dir_ratio", "non_media_ratio", "breadth",
+                                                          "depth", "files_per_dir", "tagged_ratio", "seed"))
+
+    def media_sources(self, root):
+        return dict(("media%d" % mount, os.path.join(root, "media%d" % mount)) for mount in range(1, self.mounts + 1))
+
+    def top_level(self):
+        ''' Yields (mount_alias, name, kind) with kind "file", "dir" or "non_media" '''
+        rng = random.Random(self.seed)
+        for index in range(self.entries):
+            mount_alias = "media%d" % (index % self.mounts + 1)
+            show = SHOWS[index % len(SHOWS)]
+            roll = rng.random()
+            if roll >= self.dir_ratio:
+                yield (mount_alias, "%s.%07d.1080p.WEB-DL.mkv" % (show, index), "file")
+            elif roll < self.dir_ratio * self.non_media_ratio:
+                yield (mount_alias, "%s.%07d.extras" % (show, index), "non_media")
+            else:
+                yield (mount_alias, "%s.S%02d.%07d" % (show, index % 20 + 1, index), "dir")
+
+    def directory_files(self, name):
+        ''' Yields the media files of a directory entry, relative to it '''
+        levels = [ "" ]
+        for level in range(self.depth + 1):
+            next_levels = list()
+            for rel_dir in levels:
+                for episode in range(self.files_per_dir):
+                    yield os.path.join(rel_dir, "%s.E%02d.mkv" % (name, episode + 1))
+                if level < self.depth:
+                    next_levels.extend(os.path.join(rel_dir, "Part%d" % part) for part in range(1, self.breadth + 1))
+            levels = next_levels
+
+    def file_size(self, index):
+        return (index % 50 + 1) * MB
+
+    def build_tree(self, root):
+        ''' Writes the library as sparse files under root, returns media_sources '''
+        media_sources = self.media_sources(root)
+        for path in media_sources.values():
+            os.makedirs(path, exist_ok=True)
+        for (index, (mount_alias, name, kind)) in enumerate(self.top_level()):
+            full_path = os.path.join(media_sources[mount_alias], name)
+            if kind == "file":
+                self._sparse_file(full_path, self.file_size(index))
+            elif kind == "non_media":
+                os.makedirs(full_path, exist_ok=True)
+                with open(os.path.join(full_path, "readme.txt"), "w") as readme:
+                    readme.write("not media\n")
+            else:
+                for rel_path in self.directory_files(name):
+                    file_path = os.path.join(full_path, rel_path)
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                    self._sparse_file(file_path, self.file_size(index))
+        return media_sources
+
+    @staticmethod
+    def _sparse_file(path, size):
+        with open(path, "wb") as media_file:
+            media_file.truncate(size)
+
+    def build_db(self, db, non_media_tag="non.media"):
+        ''' Fills an open allplay Database with the rows a scan would add '''
+        rows = list()
+        non_media = list()
+        for (index, (mount_alias, name, kind)) in enumerate(self.top_level()):
+            rows.append((mount_alias, name, 1600000000 + index * 60, index % 9))
+            if kind == "non_media":
+                non_media.append((mount_alias, name))
+        db.sqlite_cursor.executemany('''INSERT OR IGNORE INTO media (mount_alias, path, mtime, times_played)
+                                        VALUES (?,?,?,?)''', rows)
+        db.sqlite_cursor.execute('''INSERT OR IGNORE INTO tags (tag_name) VALUES (?)''', (non_media_tag,))
+        db.sqlite_cursor.executemany('''INSERT OR IGNORE INTO media_tags (tag_id, media_id)
+                                        SELECT t.tag_id, m.media_id FROM tags t, media m
+                                        WHERE t.tag_name = ? AND m.mount_alias = ? AND m.path = ?''',
+                                     [ (non_media_tag, mount_alias, name) for (mount_alias, name) in non_media ])
+        db.sqlite_conn.commit()
+
+    def add_tags(self, db):
+        ''' Gives tagged_ratio of the media one to three tags from TAGS '''
+        rng = random.Random(self.seed + 1)
+        db.sqlite_cursor.executemany('''INSERT OR IGNORE INTO tags (tag_name) VALUES (?)''', [ (tag,) for tag in TAGS ])
+        tag_ids = dict(db.sqlite_cursor.execute('''SELECT tag_name, tag_id FROM tags''').fetchall())
+        rows = list()
+        for (media_id,) in db.sqlite_cursor.execute('''SELECT media_id FROM media''').fetchall():
+            if rng.random() < self.tagged_ratio:
+                for tag in rng.sample(TAGS, rng.randint(1, 3)):
+                    rows.append((tag_ids[tag], media_id))
+        db.sqlite_cursor.executemany('''INSERT OR IGNORE INTO media_tags (tag_id, media_id) VALUES (?,?)''', rows)
+        db.sqlite_conn.commit()
+        return len(rows)
@@ -7,9 +7,9 @@ setup(name='allplay',
       author_email='cheeto@gmail.com',
       url='https://github.com/cheethoe/allplay',
       install_requires=['boto3>=1.37.9',
-                        'future>=1.0.0',
                         'tzlocal>=5.3.1',
                         'pyyaml>=6.0.2'],
+      extras_require={'fast': ['numpy']},
      packages=['allplay'],
      entry_points={
          'console_scripts': ['allplay=allplay.allplay:main']
@@ -0,0 +1,24 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from allplay.database import Database
+from allplay.journal import LocalStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    # Stands in for the S3 bucket, shared by every machine in a test
+    return LocalStore(str(tmp_path / "store"))
+
+
+@pytest.fixture
+def machine(tmp_path, store):
+    # machine("a") opens machine a's db in journal mode, pulling on enter
+    # and shipping (and snapshotting when due) on exit like allplay does
+    def open_machine(name, snapshot_every=100):
+        return Database(str(tmp_path / ("%s.sqlite3" % name)), journal_store=store, journal_snapshot_every=snapshot_every)
+    return open_machine
@@ -0,0 +1,23 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import os
+import time
+
+import pytest
+
+from allplay.database import Database
+
+
+@pytest.mark.parametrize("journal_mode", [ "wal", "delete" ])
+def test_age_is_from_before_the_open(tmp_path, journal_mode):
+    # Opening creates the -wal file, the startup rescan still has to see
+    # how long the db sat untouched
+    path = str(tmp_path / "a.sqlite3")
+    with Database(path, pragmas={ "journal_mode": journal_mode }) as db:
+        db.s3_sync_toggle(enable=False)
+    three_days_ago = time.time() - 3 * 86400
+    for name in os.listdir(str(tmp_path)):
+        os.utime(str(tmp_path / name), (three_days_ago, three_days_ago))
+    db = Database(path, pragmas={ "journal_mode": journal_mode })
+    db.s3_sync_toggle(enable=False)
+    with db:
+        assert db.local_db_age_sec() > 3 * 86400 - 120
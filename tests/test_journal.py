@@ -0,0 +1,173 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import json
+
+import pytest
+
+from allplay.config import Config
+from allplay.database import Database
+from allplay.journal import ChangeJournal, JournalGap, JOURNAL_PREFIX, MANIFEST_KEY, SNAPSHOT_PREFIX
+from allplay.library import Library
+from allplay.media import Media
+from allplay.tags import BulkTags
+
+
+def add_media(db, *paths):
+    db.sqlite_cursor.executemany('''INSERT INTO media (mount_alias, path, mtime, times_played) VALUES ('m', ?, 1, 0)''',
+                                 [ (path,) for path in paths ])
+    db.sqlite_conn.commit()
+
+
+def tag(db, path, tag_name):
+    media_id = db.sqlite_cursor.execute('''SELECT media_id FROM media WHERE path = ?''', (path,)).fetchone()[0]
+    BulkTags(None, db).add(tag_name, media_ids=[ media_id ])
+
+
+def play(db, path, times=1):
+    for _ in range(times):
+        db.sqlite_cursor.execute('''UPDATE media SET times_played = IFNULL(times_played, 0) + 1 WHERE path = ?''', (path,))
+    db.sqlite_conn.commit()
+
+
+def contents(db):
+    # Everything that replicates, by natural key since media_ids differ
+    cursor = db.sqlite_cursor
+    return { "media": cursor.execute('''SELECT mount_alias, path, times_played FROM media ORDER BY path''').fetchall(),
+             "tags": cursor.execute('''SELECT m.path, t.tag_name FROM media_tags mt
+                                       JOIN media m USING (media_id) JOIN tags t USING (tag_id)
+                                       ORDER BY 1, 2''').fetchall(),
+             "tag_names": [ row[0] for row in cursor.execute('''SELECT tag_name FROM tags ORDER BY 1''') ] }
+
+
+def seed(machine, *names):
+    # a starts the journal with three media, the others bootstrap from it
+    with machine("a") as a:
+        add_media(a, "x1", "x2", "x3")
+        tag(a, "x1", "fav")
+    for name in names:
+        with machine(name):
+            pass
+
+
+def test_changes_replicate_both_ways(machine, store):
+    seed(machine, "b")
+    with machine("b") as b:
+        assert [ row[1] for row in contents(b)["media"] ] == [ "x1", "x2", "x3" ]
+        add_media(b, "x4")
+        tag(b, "x4", "new")
+        play(b, "x1")
+    with machine("a") as a:
+        assert contents(a)["media"][0] == ("m", "x1", 1)
+        assert ("x4", "new") in contents(a)["tags"]
+        a.sqlite_cursor.execute('''DELETE FROM media WHERE path = 'x3' ''')
+        a.sqlite_conn.commit()
+        play(a, "x2", 2)
+        expected = contents(a)
+    with machine("b") as b:
+        assert contents(b) == expected
+    # Each machine ships under its own origin
+    origins = set(ChangeJournal.parse_key(key)[0] for key in store.list(JOURNAL_PREFIX))
+    assert len(origins) == 2
+
+
+def test_concurrent_plays_both_count(machine):
+    seed(machine, "b")
+    with machine("a") as a, machine("b") as b:
+        play(a, "x1")
+        play(b, "x1", 2)
+        play(b, "x2")
+    with machine("a") as a:
+        state_a = contents(a)
+    with machine("b") as b:
+        state_b = contents(b)
+    assert state_a == state_b
+    assert state_a["media"][:2] == [ ("m", "x1", 3), ("m", "x2", 1) ]
+
+
+def test_play_after_a_remote_play_counts_both(machine, store, tmp_path):
+    # A Media loaded before another machine's play is applied still adds
+    # its own play on top, and journals it
+    seed(machine, "b")
+    (tmp_path / "m").mkdir()
+    (tmp_path / "m" / "x1").write_bytes(b"")
+    (tmp_path / "config").write_text("media_sources: {m: %s}\n" % (tmp_path / "m"))
+    config = Config(str(tmp_path / "config"))
+    with machine("a") as a:
+        lib = Library(a)
+        lib.library.set_sources(config.media_sources)
+        row = a.sqlite_cursor.execute(lib.sql + ''' WHERE path = 'x1' ''').fetchone()
+        lib.library.add(*row)
+        media = Media(config, lib, a, str(tmp_path / "m" / "x1"))
+        with machine("b") as b:
+            play(b, "x1")
+        ChangeJournal(a, store).pull()
+        media.increment_times_played()
+        assert media.times_played == 2
+    with machine("b") as b:
+        assert contents(b)["media"][0] == ("m", "x1", 2)
+
+
+def test_tag_rename_and_delete_replay(machine):
+    seed(machine, "b")
+    with machine("a") as a:
+        tag(a, "x2", "old")
+        tag(a, "x3", "gone")
+    with machine("b") as b:
+        # b has its own "favorite" already, a's rename has to merge into it
+        tag(b, "x3", "favorite")
+    with machine("a") as a:
+        bulk = BulkTags(None, a)
+        bulk.rename("fav", "favorite")
+        bulk.rename("old", "older")
+        bulk.remove("gone")
+        expected = contents(a)
+    assert ("x1", "favorite") in expected["tags"] and ("x3", "favorite") in expected["tags"]
+    assert "gone" not in expected["tag_names"] and "fav" not in expected["tag_names"]
+    with machine("b") as b:
+        assert contents(b) == expected
+
+
+def test_gap_starts_over_from_a_snapshot(machine, store, tmp_path):
+    seed(machine, "b")
+    with machine("b") as b:
+        play(b, "x3")
+    # While b is away a snapshots on every exit, which compacts away the
+    # objects b would need to catch up
+    for path in ("y1", "y2", "y3"):
+        with machine("a", snapshot_every=1) as a:
+            add_media(a, path)
+            play(a, "x1")
+    b_path = str(tmp_path / "b.sqlite3")
+    with Database(b_path) as b:
+        b.s3_sync_toggle(enable=False)
+        with pytest.raises(JournalGap):
+            ChangeJournal(b, store).pull()
+        (origin, shipped_seq) = ChangeJournal(b, store).state()
+    with machine("b") as b:
+        # Adopted the snapshot, kept its own origin, and b's own earlier play is there
+        assert ChangeJournal(b, store).state()[0] == origin
+        assert ChangeJournal(b, store).state()[1] >= shipped_seq
+        state_b = contents(b)
+        play(b, "y1")
+    assert [ row[1] for row in state_b["media"] ] == [ "x1", "x2", "x3", "y1", "y2", "y3" ]
+    assert state_b["media"][0][2] == 3 and state_b["media"][2][2] == 1
+    with machine("a") as a:
+        assert contents(a)["media"][3] == ("m", "y1", 1)
+
+
+def test_snapshot_compacts_old_objects(machine, store):
+    seed(machine)
+    for path in ("y1", "y2"):
+        previous_objects = store.list(JOURNAL_PREFIX)
+        previous_snapshot = json.loads(store.get(MANIFEST_KEY)[0].decode("utf-8"))["key"]
+        with machine("a", snapshot_every=1) as a:
+            add_media(a, path)
+        manifest = json.loads(store.get(MANIFEST_KEY)[0].decode("utf-8"))
+        # The objects and snapshot the previous manifest covered are gone,
+        # what's left is the newest object and the new snapshot
+        objects = store.list(JOURNAL_PREFIX)
+        assert len(objects) == 1 and objects[0] not in previous_objects
+        assert manifest["key"] != previous_snapshot
+        assert store.list(SNAPSHOT_PREFIX) == sorted([ manifest["key"], MANIFEST_KEY ])
+    # A new machine still gets everything from the latest snapshot
+    with machine("c") as c:
+        assert [ row[1] for row in contents(c)["media"] ] == [ "x1", "x2", "x3", "y1", "y2" ]
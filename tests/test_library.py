@@ -0,0 +1,77 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import os
+import signal
+
+import pytest
+
+from allplay.config import Config
+from allplay.database import Database
+from allplay.library import Library, cancel_on_interrupt
+from allplay.watcher import WatchEvent
+
+
+@pytest.fixture
+def config(tmp_path):
+    (tmp_path / "m").mkdir()
+    (tmp_path / "config").write_text("media_sources: {m: %s}\nmedia_extensions: [mkv]\n" % (tmp_path / "m"))
+    return Config(str(tmp_path / "config"))
+
+
+@pytest.fixture
+def lib(tmp_path):
+    db = Database(str(tmp_path / "a.sqlite3"))
+    db.s3_sync_toggle(enable=False)
+    with db:
+        db.sqlite_cursor.executemany('''INSERT INTO media (mount_alias, path, mtime, times_played) VALUES ('m', ?, 1, 0)''',
+                                     [ ("star.wars",), ("star.trek",), ("dune",) ])
+        db.sqlite_conn.commit()
+        yield Library(db)
+
+
+def test_ranked_selection_survives_playback(lib, config):
+    if not lib.db.fts5_enabled:
+        pytest.skip("sqlite without FTS5")
+    lib.populate_from_db_search(config, search_strings=[ "star" ], ranked=True)
+    before = lib.current_selection()
+    assert sorted(before[0]) == [ 1, 2 ]
+    next(lib.cursor)
+    # The (bt) menu is only reachable once something has played
+    assert lib.current_selection() == before
+    assert lib.cursor.total() == 2
+
+
+def test_watcher_sizes_only_what_it_added(lib, config, tmp_path, monkeypatch):
+    # The seeded rows have no files, so they'd never get a size and used
+    # to be walked again on every create
+    probed = list()
+    missing_media_size = Library._missing_media_size
+    def recording(self, config, full_path):
+        probed.append(full_path)
+        return missing_media_size(self, config, full_path)
+    monkeypatch.setattr(Library, "_missing_media_size", recording)
+    (tmp_path / "m" / "new.mkv").write_bytes(b"x" * 10)
+    added = lib.apply_watch_events(config, [ WatchEvent("create", "m", "new.mkv") ])
+    assert added == [ str(tmp_path / "m" / "new.mkv") ]
+    assert probed == added
+    sizes = dict(lib.db.sqlite_cursor.execute('''SELECT path, media_size FROM media'''))
+    assert sizes == { "star.wars": None, "star.trek": None, "dune": None, "new.mkv": 10 }
+
+
+def test_ctrl_c_cancels_sizing_and_keeps_what_finished(lib, config, tmp_path, monkeypatch):
+    for name in ("star.wars", "star.trek", "dune"):
+        (tmp_path / "m" / name).write_bytes(b"x")
+    monkeypatch.setattr(config, "size_workers", 1)
+    monkeypatch.setattr(config, "size_batch_size", 1)
+    progress = list()
+    def interrupt_after_first(done, total):
+        progress.append((done, total))
+        os.kill(os.getpid(), signal.SIGINT)
+    with cancel_on_interrupt() as cancel:
+        lib.update_missing_sizes(config, progress=interrupt_after_first, cancel=cancel)
+    assert cancel.is_set() and progress == [ (1, 3) ]
+    assert signal.getsignal(signal.SIGINT) is signal.default_int_handler
+    sized = [ row[0] for row in lib.db.sqlite_cursor.execute('''SELECT media_size FROM media''') ]
+    assert sorted(sized, key=str) == [ 1, None, None ]
+    # The next run picks up the rest
+    lib.update_missing_sizes(config)
+    assert [ row[0] for row in lib.db.sqlite_cursor.execute('''SELECT media_size FROM media''') ] == [ 1, 1, 1 ]
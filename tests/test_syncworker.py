@@ -0,0 +1,94 @@
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import os
+import time
+
+import pytest
+
+from allplay import syncworker
+from allplay.config import Config
+from allplay.journal import ChangeJournal
+from test_journal import add_media, contents, play, seed
+
+
+def write_config(tmp_path, store, sync_exit="wait"):
+    home = tmp_path / "home"
+    (home / ".allplay").mkdir(parents=True)
+    config_path = home / ".allplay" / "config"
+    config_path.write_text("\n".join([ "media_sources: {m: %s}" % tmp_path,
+                                       "local_database: %s" % (tmp_path / "a.sqlite3"),
+                                       "sync_mode: journal",
+                                       "journal_store_path: %s" % store.root,
+                                       "sync_background: true",
+                                       "sync_exit: %s" % sync_exit,
+                                       "sync_interval: 1",
+                                       "sync_debounce_seconds: 1",
+                                       "sync_retries: 2", "" ]))
+    return (home, Config(str(config_path)))
+
+
+def wait_for(check, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        result = check()
+        if result:
+            return result
+        time.sleep(0.05)
+    pytest.fail("Timed out waiting")
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(syncworker, "POLL_SECONDS", 0.05)
+
+
+def background(machine, name):
+    db = machine(name)
+    db.background_sync = True
+    return db
+
+
+def test_safe_point_applies_and_ships(machine, store, tmp_path):
+    seed(machine, "b")
+    (home, config) = write_config(tmp_path, store)
+    with background(machine, "a") as a, background(machine, "b") as b:
+        a.sync_worker = syncworker.SyncWorker(config, a)
+        b.sync_worker = syncworker.SyncWorker(config, b)
+        a.sync_worker.start()
+        b.sync_worker.start()
+        play(a, "x1", 2)
+        add_media(a, "x4")
+        def shipped():
+            # Shipped objects are marked at a's next safe point
+            a.sync_worker.safe_point(None)
+            return a.journal.pending_count() == 0
+        # a's changes go out once they've been quiet for the debounce ...
+        wait_for(shipped)
+        # ... and b picks them up at a safe point, not before
+        assert contents(b)["media"][0] == ("m", "x1", 0)
+        wait_for(lambda: b.sync_worker.safe_point(None))
+        assert contents(b)["media"][0] == ("m", "x1", 2)
+        assert ("m", "x4", 0) in contents(b)["media"]
+        play(b, "x1")
+    with machine("a") as a:
+        assert contents(a)["media"][0] == ("m", "x1", 3)
+
+
+def test_exit_hands_the_upload_off(machine, store, tmp_path, monkeypatch):
+    seed(machine)
+    (home, config) = write_config(tmp_path, store, sync_exit="handoff")
+    monkeypatch.setenv("HOME", str(home))
+    with background(machine, "a") as a:
+        a.sync_worker = syncworker.SyncWorker(config, a)
+        a.sync_worker.start()
+        play(a, "x2")
+        (origin, shipped_seq) = a.journal.state()
+        # Not on the debounce yet, so it's left for exit
+        assert a.journal.pending_count() == 1
+    # The detached allplay --sync-upload ships it once this one let go
+    wait_for(lambda: ChangeJournal.local_state(config.local_database)[1] > shipped_seq, timeout=30)
+    # Only a hand-off logs there, a foreground upload would have blocked the exit instead
+    assert os.path.exists(config.local_database + ".sync.log")
+    with machine("b") as b:
+        assert contents(b)["media"][1] == ("m", "x2", 1)
+    with machine("a") as a:
+        assert ChangeJournal(a, store).pending_count() == 0